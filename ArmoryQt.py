@@ -71,6 +71,9 @@ if OS_MACOSX:
 if OS_WINDOWS:
    from _winreg import *
 
+# Rendered ledger rows kept around between createCombinedLedger calls
+LEDGER_ROW_CACHE_SIZE = 5000
+
 
 class ArmoryMainWindow(QMainWindow):
    """ The primary Armory window """
@@ -110,6 +113,7 @@ class ArmoryMainWindow(QMainWindow):
       self.sweepAfterScanList = []
       self.newWalletList = []
       self.newZeroConfSinceLastUpdate = []
+      self.zcDispatcher = ZeroConfDispatcher()
       self.lastBDMState = ['Uninitialized', None]
       self.lastSDMState = 'Uninitialized'
       self.doShutdown = False
@@ -1701,6 +1705,7 @@ class ArmoryMainWindow(QMainWindow):
          return False
 
       self.writeSetting('DateFormat', binary_to_hex(fmtStr))
+      self.ledgerRowCache.clear()
       return True
 
 
@@ -2613,9 +2618,12 @@ class ArmoryMainWindow(QMainWindow):
       # I need some linear lists for accessing by index
       self.walletIDList = []
       self.walletVisibleList = []
-      self.combinedLedger = []
+      self.combinedLedger = MergedLedger()
       self.ledgerSize = 0
       self.ledgerTable = []
+      self.ledgerBalances = {}
+      self.ledgerBalanceBlk = -1
+      self.ledgerRowCache = LRUCache(LEDGER_ROW_CACHE_SIZE)
 
       self.currBlockNum = 0
 
@@ -2638,6 +2646,7 @@ class ArmoryMainWindow(QMainWindow):
                if wo1 and not wo2:
                   prevWltPath = self.walletMap[wltID].walletPath
                   self.walletMap[wltID] = wltLoad
+                  TheScrAddrIndex.addWallet(wltLoad)
                   LOGWARN('First wallet is more useful than the second one...')
                   LOGWARN('     Wallet 1 (loaded):  %s', fpath)
                   LOGWARN('     Wallet 2 (skipped): %s', prevWltPath)
@@ -2649,6 +2658,7 @@ class ArmoryMainWindow(QMainWindow):
                # Update the maps/dictionaries
                self.walletMap[wltID] = wltLoad
                self.walletIndices[wltID] = len(self.walletMap)-1
+               TheScrAddrIndex.addWallet(wltLoad)
 
                # Maintain some linear lists of wallet info
                self.walletIDSet.add(wltID)
@@ -2813,6 +2823,7 @@ class ArmoryMainWindow(QMainWindow):
             else:
                self.cppLockboxWltMap[lbID].addNewScrAddress(scraddrReg)
                self.cppLockboxWltMap[lbID].addNewScrAddress(scraddrP2SH)
+            TheScrAddrIndex.addLockbox(lbID, lbObj)
 
             # Save the scrAddr histories again to make sure no rescan nexttime
             if TheBDM.getBDMState()=='BlockchainReady':
@@ -2835,6 +2846,7 @@ class ArmoryMainWindow(QMainWindow):
       else:
          del self.allLockboxes[index]
          self.reconstructLockboxMaps()
+         TheScrAddrIndex.removeOwner(lbID)
          writeLockboxesFile(self.allLockboxes, MULTISIG_FILE)
 
 
@@ -2928,17 +2940,13 @@ class ArmoryMainWindow(QMainWindow):
 
    #############################################################################
    def getWalletForAddr160(self, addr160):
-      for wltID, wlt in self.walletMap.iteritems():
-         if wlt.hasAddr(addr160):
-            return wltID
-      return ''
+      wltID = TheScrAddrIndex.getOwnerIn(Hash160ToScrAddr(addr160), \
+                                         self.walletMap)
+      return wltID or ''
 
    #############################################################################
    def getWalletForScrAddr(self, scrAddr):
-      for wltID, wlt in self.walletMap.iteritems():
-         if wlt.hasScrAddr(scrAddr):
-            return wltID
-      return ''
+      return TheScrAddrIndex.getOwnerIn(scrAddr, self.walletMap) or ''
 
    #############################################################################
    def getSettingOrSetDefault(self, settingName, defaultVal):
@@ -3136,49 +3144,75 @@ class ArmoryMainWindow(QMainWindow):
       if wltIDList==None:
          return
 
-      self.combinedLedger = []
-      totalFunds  = 0
-      spendFunds  = 0
-      unconfFunds = 0
       currBlk = 0xffffffff
       if TheBDM.isInitialized():
          currBlk = TheBDM.getTopBlockHeight()
 
+      # Every key ends with the tx hash and wallet ID so that no two entries
+      # tie, which the merged ledger needs to find them again.  The block
+      # number is used directly:  subtracting currBlk like the confirmation
+      # count does wouldn't change the order, and this way the keys don't
+      # go stale when a new block arrives.
+      def keyFuncNumConf(wltID, le):
+         return (le.getBlockNum(), le.getTxTime(), le.getTxHash(), \
+                 le.getValue(), wltID)
+
+      def keyFuncTxTime(wltID, le):
+         return (le.getTxTime(), le.getBlockNum(), le.getTxHash(), \
+                 le.getValue(), wltID)
+
+      def keyFuncWltName(wltID, le):
+         return (self.walletMap[wltID].labelName, wltID, le.getBlockNum(), \
+                 le.getTxHash())
+
+      def keyFuncComment(wltID, le):
+         return (self.getCommentForLE(wltID, le), wltID, le.getBlockNum(), \
+                 le.getTxHash())
+
+      def keyFuncAmount(wltID, le):
+         return (abs(le.getValue()), le.getBlockNum(), le.getTxHash(), wltID)
+
+      keyFuncMap = { LEDGERCOLS.NumConf: keyFuncNumConf,
+                     LEDGERCOLS.DateStr: keyFuncTxTime,
+                     LEDGERCOLS.WltName: keyFuncWltName,
+                     LEDGERCOLS.Comment: keyFuncComment,
+                     LEDGERCOLS.Amount:  keyFuncAmount }
+
+      # Names and comments can be edited from any number of dialogs, so
+      # those keys are recomputed every time;  the rest only sort the deltas
+      sortCol = self.sortLedgCol
+      if not sortCol in keyFuncMap:
+         sortCol = LEDGERCOLS.NumConf
+      sortDir = (self.sortLedgOrder == Qt.AscendingOrder)
+      stableKeys = not sortCol in (LEDGERCOLS.WltName, LEDGERCOLS.Comment)
+
+      if TheBDM.getBDMState()=='BlockchainReady':
+         cppWltMap = dict([(wltID, self.walletMap[wltID].cppWallet) \
+                                                for wltID in wltIDList])
+         changedIDs = self.combinedLedger.update(cppWltMap, sortCol, \
+                               keyFuncMap[sortCol], sortDir, stableKeys)
+      else:
+         self.combinedLedger.reset()
+         changedIDs = set(wltIDList)
+
+      # Balances only need to be re-read for wallets whose ledger changed,
+      # unless a new block could have matured some of their coins
+      if not currBlk==self.ledgerBalanceBlk:
+         self.ledgerBalances = {}
+         self.ledgerBalanceBlk = currBlk
+
+      totalFunds  = 0
+      spendFunds  = 0
+      unconfFunds = 0
       for wltID in wltIDList:
          wlt = self.walletMap[wltID]
-         id_le_pairs = [[wltID, le] for le in wlt.getTxLedger('Full')]
-         self.combinedLedger.extend(id_le_pairs)
-         totalFunds += wlt.getBalance('Total')
-         spendFunds += wlt.getBalance('Spendable')
-         unconfFunds += wlt.getBalance('Unconfirmed')
-
-
-      def keyFuncNumConf(x):
-         numConf = x[1].getBlockNum() - currBlk  # returns neg for reverse sort
-         txTime  = x[1].getTxTime() 
-         txhash  = x[1].getTxHash()
-         value   = x[1].getValue()
-         return (numConf, txTime, txhash, value)
-
-      def keyFuncTxTime(x):
-         numConf = x[1].getBlockNum() - currBlk  # returns neg for reverse sort
-         txTime  = x[1].getTxTime() 
-         txhash  = x[1].getTxHash()
-         value   = x[1].getValue()
-         return (txTime, numConf, txhash, value)
-
-      # Apply table sorting -- this is very fast
-      sortDir = (self.sortLedgOrder == Qt.AscendingOrder)
-      if self.sortLedgCol == LEDGERCOLS.NumConf:
-         self.combinedLedger.sort(key=keyFuncNumConf, reverse=sortDir)
-      if self.sortLedgCol == LEDGERCOLS.DateStr:
-         self.combinedLedger.sort(key=keyFuncTxTime, reverse=sortDir)
-      if self.sortLedgCol == LEDGERCOLS.WltName:
-         self.combinedLedger.sort(key=lambda x: self.walletMap[x[0]].labelName, reverse=sortDir)
-      if self.sortLedgCol == LEDGERCOLS.Comment:
-         self.combinedLedger.sort(key=lambda x: self.getCommentForLE(x[0],x[1]), reverse=sortDir)
-      if self.sortLedgCol == LEDGERCOLS.Amount:
-         self.combinedLedger.sort(key=lambda x: abs(x[1].getValue()), reverse=sortDir)
+         if wltID in changedIDs or not wltID in self.ledgerBalances:
+            self.ledgerBalances[wltID] = (wlt.getBalance('Total'), \
+                                          wlt.getBalance('Spendable'), \
+                                          wlt.getBalance('Unconfirmed'))
+         totalFunds  += self.ledgerBalances[wltID][0]
+         spendFunds  += self.ledgerBalances[wltID][1]
+         unconfFunds += self.ledgerBalances[wltID][2]
 
       self.ledgerSize = len(self.combinedLedger)
 
@@ -3209,7 +3243,8 @@ class ArmoryMainWindow(QMainWindow):
 
          # Finally, update the ledger table
          rmin,rmax = self.currLedgMin-1, self.currLedgMax
-         self.ledgerTable = self.convertLedgerToTable(self.combinedLedger[rmin:rmax])
+         self.ledgerTable = self.convertLedgerToTableCached( \
+                                    self.combinedLedger.getSlice(rmin, rmax))
          self.ledgerModel.ledger = self.ledgerTable
          self.ledgerModel.reset()
 
@@ -3233,7 +3268,7 @@ class ArmoryMainWindow(QMainWindow):
             for i in range(len(ledger)):
                lockboxTable.append([lbID, ledger[i]])
 
-         self.lockboxLedgTable = self.convertLedgerToTable(lockboxTable)
+         self.lockboxLedgTable = self.convertLedgerToTableCached(lockboxTable)
          self.lockboxLedgModel.ledger = self.lockboxLedgTable
          self.lockboxLedgModel.reset()
       except:
@@ -3244,7 +3279,8 @@ class ArmoryMainWindow(QMainWindow):
       commentSet = set([])
       lbox = self.allLockboxes[self.lockboxIDMap[lboxId]]
       for a160 in lbox.a160List:
-         wltID = self.getWalletForAddr160(a160)
+         wltID = TheScrAddrIndex.getOwnerIn(Hash160ToScrAddr(a160), \
+                                            self.walletMap)
          if wltID:
             commentSet.add(self.walletMap[wltID].getCommentForLE(le))
       return ' '.join(commentSet)
@@ -3330,10 +3366,48 @@ class ArmoryMainWindow(QMainWindow):
 
       return table2D
 
+   #############################################################################
+   def convertLedgerToTableCached(self, ledger):
+      """
+      Same as convertLedgerToTable, but reuses the rows rendered on earlier
+      calls.  Confirmations, wallet names and comments can change without
+      the entry changing, so those are refreshed on every call;  the rest
+      (sent-to-self amounts in particular) is only computed once per entry.
+      """
+      table2D = []
+      for wltID,le in ledger:
+         rowKey = (wltID, le.getTxHash(), le.getBlockNum(), le.isValid())
+         row = self.ledgerRowCache.get(rowKey)
+         if row is None:
+            rows = self.convertLedgerToTable([[wltID, le]])
+            if len(rows)==0:
+               continue
+            row = rows[0]
+            self.ledgerRowCache.put(rowKey, row)
+         else:
+            nConf = self.currBlockNum - le.getBlockNum()+1
+            if le.getBlockNum()>=0xffffffff:
+               nConf=0
+            row[LEDGERCOLS.NumConf] = nConf
+
+            wlt = self.walletMap.get(wltID)
+            if wlt:
+               row[LEDGERCOLS.WltName] = wlt.labelName
+               row[LEDGERCOLS.Comment] = self.getCommentForLE(wltID, le)
+            elif self.getLockboxByID(wltID):
+               row[LEDGERCOLS.Comment] = self.getCommentForLockboxTx(wltID, le)
+            else:
+               continue
+
+         table2D.append(row)
+
+      return table2D
+
 
    #############################################################################
    @TimeThisFunction
    def walletListChanged(self):
+      self.ledgerRowCache.clear()
       self.walletModel.reset()
       self.populateLedgerComboBox()
       self.createCombinedLedger()
@@ -3481,6 +3555,7 @@ class ArmoryMainWindow(QMainWindow):
 
       self.walletMap[newWltID] = newWallet
       self.walletIndices[newWltID] = len(self.walletMap)-1
+      TheScrAddrIndex.addWallet(newWallet)
 
       # Maintain some linear lists of wallet info
       self.walletIDSet.add(newWltID)
@@ -3507,6 +3582,7 @@ class ArmoryMainWindow(QMainWindow):
       del self.walletMap[wltID]
       del self.walletIndices[wltID]
       self.walletIDSet.remove(wltID)
+      TheScrAddrIndex.removeWallet(wltID)
       del self.walletIDList[idx]
       del self.walletVisibleList[idx]
 
@@ -6319,44 +6395,63 @@ class ArmoryMainWindow(QMainWindow):
       Function that looks at an incoming zero-confirmation transaction queue and
       determines if any incoming transactions were created by Armory. If so, the
       transaction will be passed along to a user notification queue.
+
+      Each tx is parsed once by the ZC dispatcher, which finds the wallets and
+      lockboxes it touches through the scrAddr index.  Only those get their
+      zero-conf ledgers rescanned, once each no matter how many of the new tx
+      hit them, and the ledger and models are refreshed once at the end.
       '''
-      while len(self.newZeroConfSinceLastUpdate)>0:
-         rawTx = self.newZeroConfSinceLastUpdate.pop()
-
-         # Iterate through the Python wallets and create a ledger entry for the
-         # transaction. If the transaction is for us, put it on the notification
-         # queue, create the combined ledger, and reset the Qt table model.
-         for wltID in self.walletMap.keys():
-            wlt = self.walletMap[wltID]
-            le = wlt.cppWallet.calcLedgerEntryForTxStr(rawTx)
-            if not le.getTxHash() == '\x00' * 32:
+      if len(self.newZeroConfSinceLastUpdate)==0:
+         return
+
+      rawTxList = self.newZeroConfSinceLastUpdate
+      self.newZeroConfSinceLastUpdate = []
+
+      affectedIDs, txOwnerList = self.zcDispatcher.dispatch(rawTxList)
+
+      cppWltMap = {}
+      for moneyID in affectedIDs:
+         if moneyID in self.walletMap:
+            cppWltMap[moneyID] = self.walletMap[moneyID].cppWallet
+         elif moneyID in self.cppLockboxWltMap:
+            cppWltMap[moneyID] = self.cppLockboxWltMap[moneyID]
+
+      zcLedgerMap = {}
+      for moneyID,cppWlt in cppWltMap.iteritems():
+         TheBDM.rescanWalletZeroConf(cppWlt, wait=True)
+         zcLedgerMap[moneyID] = dict([(le.getTxHash(), LedgerEntrySnapshot(le)) \
+                                          for le in cppWlt.getZeroConfLedger()])
+
+      notifyIn = self.getSettingOrSetDefault('NotifyBtcIn', not OS_MACOSX)
+      notifyOut = self.getSettingOrSetDefault('NotifyBtcOut', not OS_MACOSX)
+      wltChanged = False
+      lboxChanged = False
+      for txHash,ownerIDs in txOwnerList:
+         for moneyID in ownerIDs:
+            le = zcLedgerMap.get(moneyID, {}).get(txHash)
+            if le is None:
+               continue
+
+            # notifiedAlready = False, 
+            if moneyID in self.walletMap:
                LOGDEBUG('ZerConf tx for wallet: %s.  Adding to notify queue.' \
-                        % wltID)
-               notifyIn = self.getSettingOrSetDefault('NotifyBtcIn', \
-                                                      not OS_MACOSX)
-               notifyOut = self.getSettingOrSetDefault('NotifyBtcOut', \
-                                                       not OS_MACOSX)
+                        % moneyID)
                if (le.getValue() <= 0 and notifyOut) or \
                   (le.getValue() > 0 and notifyIn):
-                  # notifiedAlready = False, 
-                  self.notifyQueue.append([wltID, le, False])
-               self.createCombinedLedger()
-               self.walletModel.reset()
-
-         # Iterate through the C++ lockbox wallets and create a ledger entry for
-         # the transaction. If the transaction is for us, put it on the
-         # notification queue, create the combined ledger, and reset the Qt
-         # table models.
-         for lbID,cppWlt in self.cppLockboxWltMap.iteritems():
-            le = cppWlt.calcLedgerEntryForTxStr(rawTx)
-            if not le.getTxHash() == '\x00' * 32:
-               LOGDEBUG('ZerConf tx for LOCKBOX: %s' % lbID)
-               # notifiedAlready = False, 
-               self.notifyQueue.append([lbID, le, False])
-               self.createCombinedLedger()
-               self.walletModel.reset()
-               self.lockboxLedgModel.reset()
+                  self.notifyQueue.append([moneyID, le, False])
+               wltChanged = True
+            else:
+               LOGDEBUG('ZerConf tx for LOCKBOX: %s' % moneyID)
+               self.notifyQueue.append([moneyID, le, False])
+               lboxChanged = True
 
+      if wltChanged or lboxChanged:
+         self.createCombinedLedger()
+         self.walletModel.reset()
+      if wltChanged:
+         refreshWalletAddrStats(self.walletMap)
+      if lboxChanged:
+         self.lockboxLedgModel.reset()
 
    #############################################################################
    #############################################################################
@@ -6536,16 +6631,6 @@ class ArmoryMainWindow(QMainWindow):
 
 
             # If we have new zero-conf transactions, scan them and update ledger
-            if len(self.newZeroConfSinceLastUpdate)>0:
-               self.newZeroConfSinceLastUpdate.reverse()
-               for wltID in self.walletMap.keys():
-                  wlt = self.walletMap[wltID]
-                  TheBDM.rescanWalletZeroConf(wlt.cppWallet, wait=True)
-
-               for lbID,cppWlt in self.cppLockboxWltMap.iteritems():
-                  TheBDM.rescanWalletZeroConf(cppWlt, wait=True)
-                  
-
             self.checkNewZeroConf()
 
             # Trigger any notifications, if we have them...
@@ -6555,6 +6640,7 @@ class ArmoryMainWindow(QMainWindow):
 
                # This says "after scan", but works when new blocks appear, too
                TheBDM.updateWalletsAfterScan(wait=True)
+               refreshWalletAddrStats(self.walletMap)
 
                self.ledgerModel.reset()
 
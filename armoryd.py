@@ -95,10 +95,11 @@ import base64
 import json
 
 from twisted.cred.checkers import FilePasswordDB
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from twisted.web import server
 from twisted.internet.protocol import ClientFactory # REMOVE IN 0.93
 from txjsonrpc.auth import wrapResource
+from txjsonrpc import jsonrpclib
 from txjsonrpc.web import jsonrpc
 
 from armoryengine.ALL import *
@@ -119,6 +120,11 @@ class UniversalEncoder(json.JSONEncoder):
 
 ARMORYD_CONF_FILE = os.path.join(ARMORY_HOME_DIR, 'armoryd.conf')
 
+# JSON-RPC 2.0 batches:  error code for malformed calls, and how many calls
+# to run before letting the reactor flush the replies and do other work
+RPC_BATCH_INVALID_REQUEST = -32600
+RPC_BATCH_YIELD_EVERY = 50
+
 
 # Define some specific errors that can be thrown and caught
 class UnrecognizedCommand(Exception): pass
@@ -255,6 +261,7 @@ def addMultWallets(inWltPaths, inWltMap, inWltIDSet):
             if wo1 and not wo2:
                prevWltPath = inWltMap[wltID].walletPath
                inWltMap[wltID] = wltLoad
+               TheScrAddrIndex.addWallet(wltLoad)
                LOGWARN('First wallet is more useful than the second one...')
                LOGWARN('     Wallet 1 (loaded):  %s', aWlt)
                LOGWARN('     Wallet 2 (skipped): %s', prevWltPath)
@@ -267,6 +274,7 @@ def addMultWallets(inWltPaths, inWltMap, inWltIDSet):
             # Update the wallet structs.
             inWltMap[wltID] = wltLoad
             inWltIDSet.add(wltID)
+            TheScrAddrIndex.addWallet(wltLoad)
             newWltList.append(wltID)
       except:
          LOGEXCEPT('***WARNING: Unable to load wallet %s. Skipping.', aWlt)
@@ -294,6 +302,7 @@ def addMultLockboxes(inLBPaths, inLboxMap, inLBIDSet):
             else:
                inLboxMap[lbID] = curLB
                inLBIDSet.add(lbID)
+               TheScrAddrIndex.addLockbox(lbID, curLB)
                newLBList.append(lbID)
       except:
          LOGEXCEPT('***WARNING: Unable to load lockbox file %s. Skipping.', \
@@ -334,17 +343,137 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       self.serverLBIDSet = inLBIDSet               # set()
       self.serverLBCppWalletMap = inLBCppWalletMap # Dict
 
+      # Per-wallet/lockbox ledger indexes, created the first time a ledger
+      # is requested and refreshed after each new block
+      self.ledgerIndexes = {}
+
       self.armoryHomeDir = armoryHomeDir
       if wallet != None:
          wltID = wallet.uniqueIDB58
          if self.serverWltMap.get(wltID) == None:
             self.serverWltMap[wltID] = wallet
+            TheScrAddrIndex.addWallet(wallet)
 
       # If any variables rely on whether or not Testnet in a Box is running,
       # we'll set everything up here.
       self.addrByte = addrByte
 
 
+   #############################################################################
+   def render(self, request):
+      """
+      JSON-RPC 2.0 batch requests (a JSON array of calls) are handled here,
+      so a client can replace thousands of round-trips with one.  Anything
+      else goes to the regular txjsonrpc handler.
+      """
+      request.content.seek(0, 0)
+      content = request.content.read()
+      if not content.lstrip()[:1]=='[':
+         return jsonrpc.JSONRPC.render(self, request)
+
+      try:
+         callList = json.loads(content)
+      except ValueError:
+         callList = None
+
+      request.setHeader("content-type", "text/json")
+      if not isinstance(callList, list) or len(callList)==0:
+         errReply = self.getBatchReply(None, None, \
+                                       RPC_BATCH_INVALID_REQUEST, \
+                                       'Invalid batch request')
+         request.setHeader("content-length", str(len(errReply)))
+         request.write(errReply)
+         request.finish()
+      else:
+         self.renderBatch(callList, request)
+      return server.NOT_DONE_YET
+
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def renderBatch(self, callList, request):
+      """
+      Runs the calls in order and streams each reply out as soon as it is
+      ready.  Every RPC_BATCH_YIELD_EVERY calls we hand control back to the
+      reactor, which flushes what we've written so far and keeps the
+      heartbeat and other clients going during a big batch.  A batch of
+      nothing but notifications gets an empty reply, as JSON-RPC 2.0 says.
+      """
+      finished = []
+      request.notifyFinish().addBoth(finished.append)
+
+      isFirst = True
+      for i,call in enumerate(callList):
+         if i>0 and i % RPC_BATCH_YIELD_EVERY == 0:
+            yield task.deferLater(reactor, 0, lambda: None)
+         if finished:
+            # The client went away, don't bother with the rest
+            return
+
+         reply = yield self.runBatchCall(call)
+         if reply is None:
+            continue
+         request.write(('[' if isFirst else ',') + reply)
+         isFirst = False
+
+      if not finished:
+         if isFirst:
+            request.setHeader("content-length", "0")
+         else:
+            request.write(']')
+         request.finish()
+
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def runBatchCall(self, call):
+      """
+      Returns the serialized reply for one call of a batch, or None if the
+      call was a notification (no "id"), which gets no reply
+      """
+      if not isinstance(call, dict) or not isinstance(call.get('method'), \
+                                                       basestring):
+         defer.returnValue(self.getBatchReply(None, None, \
+                                              RPC_BATCH_INVALID_REQUEST, \
+                                              'Invalid request'))
+
+      callID = call.get('id')
+      params = call.get('params', [])
+      try:
+         function = self._getFunction(str(call['method']))
+      except jsonrpclib.Fault, f:
+         reply = self.getBatchReply(callID, None, f.faultCode, f.faultString)
+      else:
+         try:
+            if isinstance(params, dict):
+               params = dict([(str(k),v) for k,v in params.iteritems()])
+               result = yield defer.maybeDeferred(function, **params)
+            else:
+               result = yield defer.maybeDeferred(function, *params)
+            reply = self.getBatchReply(callID, result)
+         except Exception, e:
+            LOGERROR('Error in batched call to %s', call['method'])
+            reply = self.getBatchReply(callID, None, \
+                                       jsonrpclib.INTERNAL_ERROR, str(e))
+
+      defer.returnValue(reply if 'id' in call else None)
+
+
+   #############################################################################
+   def getBatchReply(self, callID, result, errCode=None, errMsg=None):
+      # JSON-RPC 2.0:  a reply has either "result" or "error", never both
+      reply = {'jsonrpc': '2.0', 'id': callID}
+      if errCode is None:
+         reply['result'] = result
+      else:
+         reply['error'] = {'code': errCode, 'message': errMsg}
+      try:
+         return json.dumps(reply, cls=UniversalEncoder)
+      except (TypeError, ValueError):
+         return self.getBatchReply(callID, None, jsonrpclib.INTERNAL_ERROR, \
+                                   'Cannot serialize output')
+
+
    #############################################################################
    @catchErrsForJSON
    def jsonrpc_receivedfromsigner(self, *sigBlock):
@@ -701,9 +830,41 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       A dictionary with the decoded raw transaction and relevant information.
       """
 
-      rawTx = None
       cppTx = TheBDM.getTxByHash(hex_to_binary(txHash, endianness))
-      if cppTx.isInitialized():
+      return self.getRawTxInfo(txHash, cppTx, verbose)
+
+
+   #############################################################################
+   @catchErrsForJSON
+   def jsonrpc_getrawtransactions(self, txHashList, verbose=0, \
+                                  endianness=BIGENDIAN):
+      """
+      DESCRIPTION:
+      Bulk version of getrawtransaction. All the transactions are fetched
+      from the blockchain in a single request.
+      PARAMETERS:
+      txHashList - A list of hex strings representing transaction IDs.
+      verbose - (Default=0) Integer indicating whether or not the results
+                should be more verbose.
+      endianness - (Default=BIGENDIAN) Indicates the endianness of the IDs.
+      RETURN:
+      A dictionary mapping each transaction ID to what getrawtransaction
+      would return for it.
+      """
+
+      txHashList = self.getBulkArgList(txHashList)
+      binHashList = [hex_to_binary(txHash, endianness) for txHash in txHashList]
+      cppTxList = self.getTxByHashBatch(binHashList)
+
+      retDict = {}
+      for txHash,cppTx in zip(txHashList, cppTxList):
+         retDict[txHash] = self.getRawTxInfo(txHash, cppTx, verbose)
+      return retDict
+
+
+   #############################################################################
+   def getRawTxInfo(self, txHash, cppTx, verbose):
+      if cppTx and cppTx.isInitialized():
          txBinary = cppTx.serialize()
          pyTx = PyTx().unserialize(txBinary)
          rawTx = binary_to_hex(pyTx.serialize())
@@ -803,7 +964,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
          try:
             self.sbdPassphrase = SecureBinaryData(str(passphrase))
             self.curWlt.unlock(securePassphrase=self.sbdPassphrase,
-                               tempKeyLifetime=int(timeout))
+                               tempKeyLifetime=int(timeout), lazy=True)
             retStr = 'Wallet %s has been unlocked.' % self.curWlt.uniqueIDB58
          finally:
             self.sbdPassphrase.destroy() # Ensure SBD is destroyed.
@@ -952,6 +1113,8 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       if pyBtcAddress == None:
          raise PrivateKeyNotFound
 
+      # The wallet was unlocked lazily, decrypt just this key
+      self.curWlt.unlockAddresses([addr160])
       return binary_to_hex(pyBtcAddress.serializePlainPrivateKey())
 
 
@@ -1027,25 +1190,60 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       The current wallet balance (BTC), or -1 if an error occurred.
       """
 
-      retVal = -1
+      addrList = [a.strip() for a in inB58.split(",")] 
+      balanceList = self.getAddrBalanceList(addrList, baltype)
+      return AmountToJSON(sum(balanceList))
+
+
+   #############################################################################
+   @catchErrsForJSON
+   def jsonrpc_getaddrbalances(self, addrList, baltype='spendable'):
+      """
+      DESCRIPTION:
+      Bulk version of getaddrbalance. The balances of all the addresses are
+      gathered with a single blockchain pass.
+      PARAMETERS:
+      addrList - A list (or comma-separated string) of Base58 addresses.
+      baltype - (Default=spendable) A string indicating the balance type to
+                retrieve.
+      RETURN:
+      A dictionary mapping each address to its balance (BTC).
+      """
+
+      addrList = self.getBulkArgList(addrList)
+      balanceList = self.getAddrBalanceList(addrList, baltype)
+      return dict([(addrStr, AmountToJSON(bal)) \
+                   for addrStr,bal in zip(addrList, balanceList)])
+
 
+   #############################################################################
+   def getAddrBalanceList(self, addrList, baltype):
+      """
+      Returns the balance of each address in addrList, in satoshis.  All the
+      registration checks go to the BDM in one request, and the UTXOs of
+      all the P2PKH addresses are collected with one scan.
+      """
       if not baltype in ['spendable','spend', 'unconf', 'unconfirmed', \
                          'ultimate','unspent', 'full']:
          raise BadInputError('Unrecognized getaddrbalance type: %s' % baltype) 
 
+      scrAddrList = [addrStr_to_scrAddr(addrStr) for addrStr in addrList]
+      isRegList = TheBDM.readPassthroughBatch( \
+                  [['scrAddrIsRegistered', scrAddr] for scrAddr in scrAddrList])
+      if isRegList is None or not all(isRegList):
+         raise BitcoindError('Address is not registered, requires rescan')
 
       topBlk = TheBDM.getTopBlockHeight()
-      addrList = [a.strip() for a in inB58.split(",")] 
-      retBalance = 0
-      for addrStr in addrList:
-      
-         if not TheBDM.scrAddrIsRegistered(addrStr_to_scrAddr(addrStr)):
-            raise BitcoindError('Address is not registered, requires rescan')
-
+      balanceMap = {}
+      a160List = []
+      for addrStr,scrAddr in zip(addrList, scrAddrList):
          atype,a160 = addrStr_to_hash160(addrStr)
-         if atype==ADDRBYTE:
+         if scrAddr in balanceMap:
+            continue
+         elif atype==ADDRBYTE:
             # Already checked it's registered, regardless if in a loaded wallet
-            utxoList = getUnspentTxOutsForAddr160List([a160], baltype, 0)
+            a160List.append(a160)
+            balanceMap[scrAddr] = 0
          elif atype==P2SHBYTE:
             # For P2SH, we'll require we have a loaded lockbox
             lbox = self.getLockboxByP2SHAddrStr(addrStr)
@@ -1055,12 +1253,18 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             # We simply grab the UTXO list for the lbox, both p2sh and multisig
             cppWallet = self.serverLBCppWalletMap[lbox.uniqueIDB58]
             utxoList = cppWallet.getSpendableTxOutList(topBlk, IGNOREZC)
+            balanceMap[scrAddr] = sumTxOutList(utxoList)
          else:
             raise NetworkIDError('Addr for the wrong network!')
 
-         retBalance += sumTxOutList(utxoList)
+      if a160List:
+         utxoList = getUnspentTxOutsForAddr160List(a160List, baltype, 0)
+         for utxo in utxoList:
+            recip = utxo.getRecipientScrAddr()
+            if recip in balanceMap:
+               balanceMap[recip] += utxo.getValue()
 
-      return AmountToJSON(retBalance)
+      return [balanceMap[scrAddr] for scrAddr in scrAddrList]
 
 
    #############################################################################
@@ -1149,6 +1353,53 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       return self.create_unsigned_transaction(scriptValuePairs)
 
 
+   #############################################################################
+   def getBulkArgList(self, argList):
+      """
+      The bulk calls take a JSON list, but a comma-separated string is more
+      convenient from the command line
+      """
+      if isinstance(argList, basestring):
+         argList = argList.split(',')
+      return [str(arg).strip() for arg in argList]
+
+
+   #############################################################################
+   def getTxByHashBatch(self, binHashList):
+      """
+      Returns a list with the C++ Tx for each hash (or None if TheBDM
+      doesn't have it), fetched in one BDM request
+      """
+      txList = TheBDM.readPassthroughBatch( \
+                           [['getTxByHash', binHash] for binHash in binHashList])
+      if txList is None:
+         return [None]*len(binHashList)
+      return txList
+
+
+   #############################################################################
+   def getLedgerIndex(self, b58ID, cppWallet):
+      ledgerIndex = self.ledgerIndexes.get(b58ID)
+      if ledgerIndex is None or not ledgerIndex.cppWallet is cppWallet:
+         ledgerIndex = WalletLedgerIndex(cppWallet)
+         self.ledgerIndexes[b58ID] = ledgerIndex
+      else:
+         # Nothing to copy unless the wallet changed outside of the
+         # heartbeat (rescans, imports), in which case we catch up here
+         ledgerIndex.refresh()
+      return ledgerIndex
+
+
+   #############################################################################
+   def refreshLedgerIndexes(self):
+      """
+      Called by the daemon after updateWalletsAfterScan, so that the first
+      ledger request after a new block doesn't have to catch up on its own
+      """
+      for ledgerIndex in self.ledgerIndexes.values():
+         ledgerIndex.refresh()
+
+
    #############################################################################
    @catchErrsForJSON
    def jsonrpc_getledgersimple(self, inB58ID, tx_count=10, from_tx=0):
@@ -1183,6 +1434,42 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       A ledger list with dictionary entries for each transaction.
       """
 
+      return self.getLedgerPage(inB58ID, tx_count, from_tx, simple)[0]
+
+
+   #############################################################################
+   @catchErrsForJSON
+   def jsonrpc_getledgerpage(self, inB58ID, tx_count=10, cursor='', \
+                             simple=False):
+      """
+      DESCRIPTION:
+      Get one page of a wallet or lockbox ledger, starting after a cursor
+      returned by a previous call. Walking a ledger this way doesn't skip or
+      repeat entries when new blocks come in between calls.
+      PARAMETERS:
+      inB58ID - The Base58 ID of the wallet or lockbox from which to obtain the
+                ledger. The wallet or lockbox must already be loaded.
+      tx_count - (Default=10) The number of entries to get.
+      cursor - (Default='') The "nextcursor" value from the previous page. An
+               empty cursor starts at the oldest entry.
+      simple - (Default=False) Flag indicating if the returned ledger should be
+               simple in format.
+      RETURN:
+      A dictionary with the ledger list ("ledger") and the cursor to pass in
+      to get the next page ("nextcursor"). Zero-confirmation entries are
+      repeated on every page until they are confirmed.
+      """
+
+      ledger, nextCursor = self.getLedgerPage(inB58ID, tx_count, 0, simple, \
+                                              str(cursor))
+      return { 'ledger' : ledger, 'nextcursor' : nextCursor }
+
+
+   #############################################################################
+   def getLedgerPage(self, inB58ID, tx_count, from_tx, simple, cursor=None):
+      """
+      Shared by getledger and getledgerpage.  Returns (ledgerList, nextCursor)
+      """
       final_le_list = []
       b58Type = 'wallet'
       self.b58ID = str(inB58ID)
@@ -1198,6 +1485,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                   'lockbox.' % self.b58ID
          LOGERROR(errMsg)
          final_le_list.append(errMsg)
+         nextCursor = ''
       else:
          # For now, lockboxes can only use C++ wallets, which use a different
          # set of calls and such. If we got back a Python wallet, convert it.
@@ -1206,57 +1494,51 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
          else:
             b58Type = 'lockbox'
 
-         # Do some setup to determine how many ledger entries we'll get and
-         # which entries we'll get.
-         tx_count = int(tx_count)
-         from_tx = int(from_tx)
-         ledgerEntries = ledgerWlt.getTxLedger()
-         sz = len(ledgerEntries)
-         lower = min(sz, from_tx)
-         upper = min(sz, from_tx+tx_count)
-         txSet = set([])
+         # Only the requested page is pulled out of the ledger index.  The
+         # tx, header and input data for the page comes from the tx facts
+         # cache, which gets whatever it's missing in a single BDM request.
+         ledgerIndex = self.getLedgerIndex(self.b58ID, ledgerWlt)
+         ledgerEntries, nextCursor = ledgerIndex.getPage(tx_count, from_tx, \
+                                                         cursor)
+         txFactsMap = TheTxFactsCache.getTxFactsBatch( \
+                              [le.getTxHash() for le in ledgerEntries])
+         topBlock = TheBDM.getTopBlockHeight()
 
          # Loop through all the potential ledger entries and create what we can.
-         for i in range(lower,upper):
+         for le in ledgerEntries:
             # Get the exact Tx we're looking for.
-            le = ledgerEntries[i]
             txHashBin = le.getTxHash()
             txHashHex = binary_to_hex(txHashBin, BIGENDIAN)
 
             # If the BDM doesn't have the C++ Tx & header, log errors.
-            cppTx = TheBDM.getTxByHash(txHashBin)
-            if not cppTx.isInitialized():
+            txFacts = txFactsMap.get(txHashBin)
+            if txFacts is None:
                LOGERROR('Tx hash not recognized by TheBDM: %s' % txHashHex)
+               continue
 
-            cppHead = TheBDM.getHeaderPtrForTx(cppTx)
-            if not cppHead.isInitialized():
+            if not txFacts.isConfirmed():
                LOGERROR('Header pointer is not available!')
-               headHashBin = ''
                headHashHex = ''
-               headtime    = 0
             else:
-               headHashBin = cppHead.getThisHash()
-               headHashHex = binary_to_hex(headHashBin, BIGENDIAN)
-               headtime    = cppHead.getTimestamp()
+               headHashHex = binary_to_hex(txFacts.blockHash, BIGENDIAN)
+            headtime = txFacts.blockTime
 
             # Get some more data.
             # amtCoins: amt of BTC transacted, always positive (how big are
             #           outputs minus change?)
             # netCoins: net effect on wallet (positive or negative)
             # feeCoins: how much fee was paid for this tx 
-            nconf = (TheBDM.getTopBlockHeader().getBlockHeight() - \
-                     le.getBlockNum()) + 1
+            nconf = (topBlock - le.getBlockNum()) + 1
             isToSelf = le.isSentToSelf()
             amtCoins = 0.0
             netCoins = le.getValue()
-            feeCoins = getFeeForTx(txHashBin)
-            scrAddrs = [cppTx.getTxOutCopy(i).getScrAddressStr() for i in \
-                       range(cppTx.getNumTxOut())]
+            feeCoins = txFacts.fee
+            scrAddrs = [out[0] for out in txFacts.outputs]
 
             # Find the first recipient and the change recipient.
             firstScrAddr = ''
             changeScrAddr = ''
-            if cppTx.getNumTxOut()==1:
+            if len(scrAddrs)==1:
                firstScrAddr = scrAddrs[0]
             elif isToSelf:
                # Sent-to-Self tx
@@ -1301,9 +1583,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
             # Get the address & amount from each TxIn.
             myinputs, otherinputs = [], []
-            for iin in range(cppTx.getNumTxIn()):
-               sender = TheBDM.getSenderScrAddr(cppTx.getTxInCopy(iin))
-               val    = TheBDM.getSentValue(cppTx.getTxInCopy(iin))
+            for sender,val in txFacts.inputs:
                addTo  = (myinputs if ledgerWlt.hasScrAddress(sender) else \
                          otherinputs)
                addTo.append( {'address': scrAddr_to_displayStr(sender, \
@@ -1313,9 +1593,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
             # Get the address & amount from each TxOut.
             myoutputs, otheroutputs = [], []
-            for iout in range(cppTx.getNumTxOut()):
-               recip = cppTx.getTxOutCopy(iout).getScrAddressStr()
-               val   = cppTx.getTxOutCopy(iout).getValue();
+            for recip,val in txFacts.outputs:
                addTo = (myoutputs if ledgerWlt.hasScrAddress(recip) else \
                         otheroutputs)
                addTo.append( {'address': scrAddr_to_displayStr(recip, \
@@ -1335,7 +1613,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                         'blockhash' :    headHashHex,
                         'confirmations': nconf,
                         'txtime' :       le.getTxTime(),
-                        'txsize' :       len(cppTx.serialize()),
+                        'txsize' :       txFacts.txSize,
                         'blocktime' :    headtime,
                         #'comment' :      ledgerWlt.getComment(txHashBin),
                         'firstrecip':    firstAddr,
@@ -1353,7 +1631,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             final_le_list.append(tx_info)
 
 
-      return final_le_list
+      return final_le_list, nextCursor
 
 
    #############################################################################
@@ -1373,17 +1651,21 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       # This does not use 'account's like in the Satoshi client
 
       final_tx_list = []
-      ledgerEntries = self.curWlt.getTxLedger('blk')
+      if not TheBDM.getBDMState()=='BlockchainReady':
+         return final_tx_list
 
-      sz = len(ledgerEntries)
-      lower = min(sz, from_tx)
-      upper = min(sz, from_tx+tx_count)
+      ledgerIndex = self.getLedgerIndex(self.curWlt.uniqueIDB58, \
+                                        self.curWlt.cppWallet)
+      ledgerEntries = ledgerIndex.getPage(tx_count, from_tx, \
+                                          withZeroConf=False)[0]
+      txFactsMap = TheTxFactsCache.getTxFactsBatch( \
+                              [le.getTxHash() for le in ledgerEntries])
+      topBlock = TheBDM.getTopBlockHeight()
 
       txSet = set([])
 
-      for i in range(lower,upper):
+      for le in ledgerEntries:
 
-         le = ledgerEntries[i]
          txHashBin = le.getTxHash()
          if txHashBin in txSet:
             continue
@@ -1391,36 +1673,33 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
          txSet.add(txHashBin)
          txHashHex = binary_to_hex(txHashBin, BIGENDIAN)
 
-         cppTx = TheBDM.getTxByHash(txHashBin)
-         if not cppTx.isInitialized():
+         txFacts = txFactsMap.get(txHashBin)
+         if txFacts is None:
             LOGERROR('Tx hash not recognized by TheBDM: %s' % txHashHex)
+            continue
 
-         #cppHead = cppTx.getHeaderPtr()
-         cppHead = TheBDM.getHeaderPtrForTx(cppTx)
-         if not cppHead.isInitialized:
+         if not txFacts.isConfirmed():
             LOGERROR('Header pointer is not available!')
 
-         blockIndex = cppTx.getBlockTxIndex()
-         blockHash  = binary_to_hex(cppHead.getThisHash(), BIGENDIAN)
+         blockIndex = txFacts.txIndex
+         blockHash  = binary_to_hex(txFacts.blockHash, BIGENDIAN)
          blockTime  = le.getTxTime()
          isToSelf   = le.isSentToSelf()
-         feeCoin   = getFeeForTx(txHashBin)
+         feeCoin   = txFacts.fee
          totalBalDiff = le.getValue()
-         nconf = TheBDM.getTopBlockHeader().getBlockHeight()-le.getBlockNum()+1
+         nconf = topBlock - le.getBlockNum() + 1
 
 
          # We have potentially change outputs on any outgoing transactions.
          # If sent-to-self, assume 1 change address (max chain idx), all others
          # are receives
          recipVals = []
-         for iout in range(cppTx.getNumTxOut()):
-            recip = CheckHash160(cppTx.getTxOutCopy(iout).getScrAddressStr())
-            val   = cppTx.getTxOutCopy(iout).getValue()
-            recipVals.append([recip,val])
+         for scrAddr,val in txFacts.outputs:
+            recipVals.append([CheckHash160(scrAddr),val])
 
-         if cppTx.getNumTxOut()==1:
+         if len(recipVals)==1:
             changeAddr160 = ""
-            targAddr160 = CheckHash160(cppTx.getTxOutCopy(0).getScrAddressStr())
+            targAddr160 = recipVals[0][0]
          elif isToSelf:
             selfamt,changeIdx = determineSentToSelfAmt(le, self.curWlt)
             if changeIdx==-1:
@@ -1620,7 +1899,53 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
       binhash = hex_to_binary(txHash, BIGENDIAN)
       tx = TheBDM.getTxByHash(binhash)
-      if not tx.isInitialized():
+      return self.getTxInfo(txHash, tx)
+
+
+   #############################################################################
+   @catchErrsForJSON
+   def jsonrpc_gettransactions(self, txHashList):
+      """
+      DESCRIPTION:
+      Bulk version of gettransaction. The transactions, and then all the
+      transactions they spend from, are each fetched from the blockchain in a
+      single request.
+      PARAMETERS:
+      txHashList - A list of hex strings representing transaction IDs.
+      RETURN:
+      A dictionary mapping each transaction ID to what gettransaction would
+      return for it.
+      """
+
+      if TheBDM.getBDMState() in ['Uninitialized', 'Offline']:
+         return {'Error': 'armoryd is offline'}
+
+      txHashList = self.getBulkArgList(txHashList)
+      binHashList = [hex_to_binary(txHash, BIGENDIAN) for txHash in txHashList]
+      txList = self.getTxByHashBatch(binHashList)
+
+      # Everything the inputs refer to, also in one request
+      prevHashSet = set()
+      for tx in txList:
+         if tx and tx.isInitialized():
+            for i in range(tx.getNumTxIn()):
+               prevHashSet.add(tx.getTxInCopy(i).getOutPoint().getTxHash())
+      prevHashList = list(prevHashSet)
+      prevTxMap = dict(zip(prevHashList, self.getTxByHashBatch(prevHashList)))
+
+      retDict = {}
+      for txHash,tx in zip(txHashList, txList):
+         retDict[txHash] = self.getTxInfo(txHash, tx, prevTxMap)
+      return retDict
+
+
+   #############################################################################
+   def getTxInfo(self, txHash, tx, prevTxMap=None):
+      """
+      Builds the gettransaction output for one tx.  Previous tx the inputs
+      spend from are looked up in prevTxMap first, then in TheBDM.
+      """
+      if not tx or not tx.isInitialized():
          return {'Error': 'transaction not found'}
 
       out = {}
@@ -1635,8 +1960,11 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       outputvalues = []
       for i in range(tx.getNumTxIn()): 
          op = tx.getTxInCopy(i).getOutPoint()
-         prevtx = TheBDM.getTxByHash(op.getTxHash())
-         if not prevtx.isInitialized():
+         if prevTxMap is not None and op.getTxHash() in prevTxMap:
+            prevtx = prevTxMap[op.getTxHash()]
+         else:
+            prevtx = TheBDM.getTxByHash(op.getTxHash())
+         if not prevtx or not prevtx.isInitialized():
             haveAllInputs = False
             txindata.append( { 'address': '00'*32, 
                                'value':   '-1',
@@ -1953,6 +2281,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                                                MULTISIG_FILE_NAME), True)
                writeLockboxesFile([lockbox], lbFilePath, False)
                self.serverLBMap[lbID] = lockbox
+               TheScrAddrIndex.addLockbox(lbID, lockbox)
 
                result = lockbox.toJSONMap()
 
@@ -2465,7 +2794,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                                   'not be unlocked. Signed transaction will ' \
                                   'not be created.'
             else:
-               self.curWlt.unlock(securePassphrase=passwd)
+               self.curWlt.unlock(securePassphrase=passwd, lazy=True)
                decrypted = True
          finally:
             passwd.destroy()
@@ -2546,17 +2875,13 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
    #############################################################################
    def getWalletForAddr160(self, addr160):
-      for wltID,wlt in self.serverWltMap.iteritems():
-         if wlt.hasAddr(addr160):
-            return wltID
-      return ''
+      wltID = TheScrAddrIndex.getOwnerIn(Hash160ToScrAddr(addr160), \
+                                         self.serverWltMap)
+      return wltID or ''
 
    #############################################################################
    def getWalletForScrAddr(self, scrAddr):
-      for wltID, wlt in self.serverWltMap.iteritems():
-         if wlt.hasScrAddr(scrAddr):
-            return wltID
-      return ''
+      return TheScrAddrIndex.getOwnerIn(scrAddr, self.serverWltMap) or ''
 
    ################################################################################
    # Get  the lock box ID if the p2shAddrString is found in one of the lockboxes
@@ -2661,8 +2986,10 @@ class Armory_Daemon(object):
 
       self.curWlt = None
       self.curLB = None
+      self.rpcServer = None
 
       self.newZeroConfSinceLastUpdate = []
+      self.zcDispatcher = ZeroConfDispatcher()
 
       # Check if armoryd is already running. If so, just execute the command,
       # otherwise prepare to act as the server.
@@ -2679,6 +3006,9 @@ class Armory_Daemon(object):
 
             #check wallet consistency every hour
             self.checkStep = 3600
+
+            #incremental checkers, by wallet path, for the hourly checks
+            self.walletCheckers = {}
                         
             ################################################################################
             # armoryd is still somewhat immature. We'll print a warning to let people know
@@ -2796,6 +3126,7 @@ class Armory_Daemon(object):
                                               self.wltIDSet, self.lbIDSet, \
                                               self.lboxCppWalletMap)
             secured_resource = self.set_auth(resource)
+            self.rpcServer = resource
 
             # This is LISTEN call for armory RPC server
             reactor.listenTCP(ARMORY_RPC_PORT, \
@@ -3027,18 +3358,80 @@ class Armory_Daemon(object):
    @AllowAsync
    def checkWallet(self):
       if self.lock.acquire(False):
-         wltStatus = PyBtcWalletRecovery().ProcessWallet(None, self.curWlt, \
-                                                         Mode=5)
-         if wltStatus != 0:
-            print 'Wallet consistency check failed in wallet %s!!!' \
-                   % (self.curWlt.uniqueIDB58)
-            print 'Aborting...'
-
-            quit()
-         else:
-            self.lastChecked = RightNow()
+         try:
+            wltStatus = PyBtcWalletRecovery().ProcessWallet(None, self.curWlt, \
+                                                            Mode=5)
+            if wltStatus != 0:
+               print 'Wallet consistency check failed in wallet %s!!!' \
+                      % (self.curWlt.uniqueIDB58)
+               print 'Aborting...'
+
+               quit()
+            else:
+               self.lastChecked = RightNow()
+         finally:
+            self.lock.release()
 
-      self.lock.release()
+
+   #############################################################################
+   @AllowAsync
+   def checkWalletIncremental(self):
+      """
+      The hourly check.  Runs on a background thread (with async=True) and
+      only verifies what changed in the wallet file since the last check.
+      If anything looks wrong, the full check is run on the reactor thread,
+      same as before, so it can repair the wallet or abort.
+      """
+      if not self.lock.acquire(False):
+         return
+
+      wlt = self.curWlt
+      try:
+         checker = self.walletCheckers.get(wlt.walletPath)
+         if checker is None:
+            checker = IncrementalWalletCheck(wlt.walletPath)
+            self.walletCheckers[wlt.walletPath] = checker
+
+         errors = checker.run()
+      except:
+         LOGEXCEPT('Incremental wallet check failed')
+         errors = ['Exception in incremental check']
+      finally:
+         self.lock.release()
+
+      if len(errors) == 0:
+         self.lastChecked = RightNow()
+      else:
+         LOGWARN('Incremental check of wallet %s found problems:', 
+                                                         wlt.uniqueIDB58)
+         for errStr in errors:
+            LOGWARN('   %s', errStr)
+         del self.walletCheckers[wlt.walletPath]
+         reactor.callFromThread(self.checkWallet)
+
+
+   #############################################################################
+   def rescanNewZeroConf(self):
+      """
+      Rescans the zero-conf ledgers of only the wallets and lockboxes touched
+      by the tx that came in since the last heartbeat, once each.  We had a
+      notification thing going in ArmoryQt using checkNewZeroConf() but we
+      don't need it here (yet), so the ZC list is simply cleared afterwards.
+      """
+      if len(self.newZeroConfSinceLastUpdate)==0:
+         return
+
+      rawTxList = self.newZeroConfSinceLastUpdate
+      self.newZeroConfSinceLastUpdate = []
+
+      affectedIDs = self.zcDispatcher.dispatch(rawTxList)[0]
+      for moneyID in affectedIDs:
+         if moneyID in self.WltMap:
+            TheBDM.rescanWalletZeroConf(self.WltMap[moneyID].cppWallet, \
+                                                                  wait=True)
+         elif moneyID in self.lboxCppWalletMap:
+            TheBDM.rescanWalletZeroConf(self.lboxCppWalletMap[moneyID], \
+                                                                  wait=True)
 
 
    #############################################################################
@@ -3058,8 +3451,8 @@ class Armory_Daemon(object):
          if TheBDM.getBDMState()=='BlockchainReady':
             #check wallet every checkStep seconds
             nextCheck = self.lastChecked + self.checkStep
-            if RightNow() >= nextCheck:
-               self.checkWallet()
+            if RightNow() >= nextCheck and not self.lock.locked():
+               self.checkWalletIncremental(async=True)
    
             # If there's a new block, use this to determine it affected our wallets.
             # NB: We may wish to alter this to reflect only the active wallet.
@@ -3072,21 +3465,7 @@ class Armory_Daemon(object):
             newBlks = TheBDM.readBlkFileUpdate(wait=True)
    
             # If we have new zero-conf transactions, scan them and update ledger
-            if len(self.newZeroConfSinceLastUpdate)>0:
-               self.newZeroConfSinceLastUpdate.reverse()
-               for wltID in self.WltMap.keys():
-                  wlt = self.WltMap[wltID]
-                  TheBDM.rescanWalletZeroConf(wlt.cppWallet, wait=True)
-   
-               for lbID,cppWlt in self.lboxCppWalletMap.iteritems():
-                  TheBDM.rescanWalletZeroConf(cppWlt, wait=True)
-                     
-            # We had a notification thing going in ArmoryQt using checkNewZeroConf()
-            # but we didn't need it here (yet), so I simply remove it and clear the
-            # ZC list as if we called it
-            #self.checkNewZeroConf()
-            #del self.newZeroConfSinceLastUpdate[:]
-            self.newZeroConfSinceLastUpdate = []
+            self.rescanNewZeroConf()
    
             if newBlks>0:
                self.latestBlockNum = TheBDM.getTopBlockHeight()
@@ -3097,6 +3476,8 @@ class Armory_Daemon(object):
                # update functions after new blocks come in.  "After scan" also
                # means after we've updated the blockchain with a new block.
                TheBDM.updateWalletsAfterScan(wait=True)
+               if self.rpcServer:
+                  self.rpcServer.refreshLedgerIndexes()
    
                # On very rare occasions, we could come across a new Tx in a block
                # instead of seeing it on the network first. Let's check for this
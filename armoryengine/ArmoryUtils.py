@@ -23,6 +23,7 @@ import hashlib
 import inspect
 import locale
 import logging
+import logging.handlers
 import math
 import multiprocessing
 import optparse
@@ -32,6 +33,7 @@ import random
 import signal
 import smtplib
 from struct import pack, unpack
+import itertools
 from itertools import izip
 #from subprocess import PIPE
 import sys
@@ -41,6 +43,7 @@ import traceback
 import shutil
 import base64
 import socket
+from collections import OrderedDict
 
 #from psutil import Popen
 import psutil
@@ -103,6 +106,8 @@ parser.add_option("--multisigfile",  dest="multisigFile",  default='DEFAULT', ty
 parser.add_option("--force-wallet-check", dest="forceWalletCheck", default=False, action="store_true", help="Force the wallet sanity check on startup")
 parser.add_option("--disable-modules", dest="disableModules", default=False, action="store_true", help="Disable looking for modules in the execution directory")
 parser.add_option("--disable-conf-permis", dest="disableConfPermis", default=False, action="store_true", help="Disable forcing permissions on bitcoin.conf")
+parser.add_option("--sig-workers",   dest="sigWorkers",  default=0,         type="int",          help="Sign/verify large transactions with this many threads (0 to disable)")
+parser.add_option("--async-log",     dest="asyncLog",    default=False,     action="store_true", help="Write the log file from a background thread")
 
 # Pre-10.9 OS X sometimes passes a process serial number as -psn_0_xxxxxx. Nuke!
 if sys.platform == 'darwin':
@@ -684,93 +689,158 @@ def execAndWait(cli_str, timeout=0, useStartInfo=True):
 # Want to get the line in which an error was triggered, but by wrapping
 # the logger function (as I will below), the displayed "file:linenum"
 # references the logger function, not the function that called it.
-# So I use traceback to find the file and line number two up in the
-# stack trace, and return that to be displayed instead of default
-# [Is this a hack?  Yes and no.  I see no other way to do this]
-def getCallerLine():
-   stkTwoUp = traceback.extract_stack()[-3]
-   filename,method = stkTwoUp[0], stkTwoUp[1]
-   return '%s:%d' % (os.path.basename(filename),method)
+# So we look up the frame two up from here (the caller of the LOG* method)
+# and return that to be displayed instead of default.  sys._getframe just
+# follows a pointer, where traceback.extract_stack() would walk the whole
+# stack and read the source line for every frame of it.
+def getCallerLine(depth=2):
+   frame = sys._getframe(depth)
+   return '%s:%d' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno)
 
+rootLogger = logging.getLogger('')
+
+# All the LOG* methods check the level first, so a disabled LOGDEBUG in a hot
+# loop costs one isEnabledFor call:  no caller lookup, no string formatting.
 # When there's an error in the logging function, it's impossible to find!
-# These wrappers will print the full stack so that it's possible to find
-# which line triggered the error
-def LOGDEBUG(msg, *a):
+# So print the full stack if the format string doesn't match its args.
+def logWithCallerLine(level, msg, a, excInfo=False):
    try:
       logstr = msg if len(a)==0 else (msg%a)
-      callerStr = getCallerLine() + ' - '
-      logging.debug(callerStr + logstr)
+      callerStr = getCallerLine(3) + ' - '
+      rootLogger.log(level, callerStr + logstr, exc_info=excInfo)
    except TypeError:
       traceback.print_stack()
       raise
 
+def LOGDEBUG(msg, *a):
+   if rootLogger.isEnabledFor(logging.DEBUG):
+      logWithCallerLine(logging.DEBUG, msg, a)
+
 def LOGINFO(msg, *a):
-   try:
-      logstr = msg if len(a)==0 else (msg%a)
-      callerStr = getCallerLine() + ' - '
-      logging.info(callerStr + logstr)
-   except TypeError:
-      traceback.print_stack()
-      raise
+   if rootLogger.isEnabledFor(logging.INFO):
+      logWithCallerLine(logging.INFO, msg, a)
+
 def LOGWARN(msg, *a):
-   try:
-      logstr = msg if len(a)==0 else (msg%a)
-      callerStr = getCallerLine() + ' - '
-      logging.warn(callerStr + logstr)
-   except TypeError:
-      traceback.print_stack()
-      raise
+   if rootLogger.isEnabledFor(logging.WARNING):
+      logWithCallerLine(logging.WARNING, msg, a)
+
 def LOGERROR(msg, *a):
-   try:
-      logstr = msg if len(a)==0 else (msg%a)
-      callerStr = getCallerLine() + ' - '
-      logging.error(callerStr + logstr)
-   except TypeError:
-      traceback.print_stack()
-      raise
+   if rootLogger.isEnabledFor(logging.ERROR):
+      logWithCallerLine(logging.ERROR, msg, a)
+
 def LOGCRIT(msg, *a):
-   try:
-      logstr = msg if len(a)==0 else (msg%a)
-      callerStr = getCallerLine() + ' - '
-      logging.critical(callerStr + logstr)
-   except TypeError:
-      traceback.print_stack()
-      raise
+   if rootLogger.isEnabledFor(logging.CRITICAL):
+      logWithCallerLine(logging.CRITICAL, msg, a)
+
 def LOGEXCEPT(msg, *a):
-   try:
-      logstr = msg if len(a)==0 else (msg%a)
-      callerStr = getCallerLine() + ' - '
-      logging.exception(callerStr + logstr)
-   except TypeError:
-      traceback.print_stack()
-      raise
+   if rootLogger.isEnabledFor(logging.ERROR):
+      logWithCallerLine(logging.ERROR, msg, a, excInfo=True)
+
+
+################################################################################
+class QueuedLogHandler(logging.Handler):
+   """
+   Hands records to another handler (usually the FileHandler) on a
+   background thread, so a slow disk never stalls the thread that logged:
+   the reactor, the BDM thread, etc.  Records are fully formatted before
+   they are queued, because their args and exc_info may not survive until
+   the writer gets to them.  stop() drains the queue, and is registered to
+   run at exit.
+   """
+   def __init__(self, targetHandler):
+      logging.Handler.__init__(self, targetHandler.level)
+      import Queue
+      self.target = targetHandler
+      self.queue  = Queue.Queue()
+      self.writerThread = threading.Thread(target=self.writeLoop,
+                                           name='QueuedLogHandler')
+      self.writerThread.daemon = True
+      self.writerThread.start()
+      import atexit
+      atexit.register(self.stop)
+
+   def emit(self, record):
+      try:
+         record.msg  = record.getMessage()
+         record.args = None
+         if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+         self.queue.put(record)
+      except Exception:
+         self.handleError(record)
+
+   def writeLoop(self):
+      while True:
+         record = self.queue.get()
+         if record is None:
+            break
+         self.target.handle(record)
+
+   def stop(self, timeout=5):
+      if self.writerThread.is_alive():
+         self.queue.put(None)
+         self.writerThread.join(timeout)
+      self.target.flush()
+
+   def flush(self):
+      self.target.flush()
 
 
 
 def chopLogFile(filename, size):
+   """
+   Cut the file down to its last <size> bytes (starting on a line boundary).
+   Only that tail is ever read, so this costs the same no matter how big the
+   file has grown, and nothing at all if it is under the limit already.
+   """
    if not os.path.exists(filename):
       print 'Log file doesn\'t exist [yet]'
       return
 
-   logfile = open(filename, 'r')
-   allLines = logfile.readlines()
-   logfile.close()
+   fileSize = os.path.getsize(filename)
+   if fileSize <= size:
+      return
 
-   nBytes,nLines = 0,0;
-   for line in allLines[::-1]:
-      nBytes += len(line)
-      nLines += 1
-      if nBytes>size:
-         break
+   with open(filename, 'rb') as fin:
+      fin.seek(fileSize - size)
+      fin.readline()  # skip the partial line we landed in
+      tailData = fin.read(size)
 
-   logfile = open(filename, 'w')
-   for line in allLines[-nLines:]:
-      logfile.write(line)
-   logfile.close()
+   tempFile = filename + '.chop'
+   with open(tempFile, 'wb') as fout:
+      fout.write(tailData)
+
+   if OS_WINDOWS:
+      os.remove(filename)
+   os.rename(tempFile, filename)
 
 
-# Cut down the log file to just the most recent 1 MB
-chopLogFile(ARMORY_LOG_FILE, 1024*1024)
+################################################################################
+class ChoppingFileHandler(logging.handlers.RotatingFileHandler):
+   """
+   Size-limited log file that stays a single file:  once it grows past
+   maxBytes it is chopped down to its last keepBytes with chopLogFile(),
+   instead of being renamed to numbered backups.  Runs while we are logging,
+   so a long-running armoryd doesn't leave a huge file for the next start.
+   """
+   def __init__(self, filename, maxBytes, keepBytes):
+      logging.handlers.RotatingFileHandler.__init__(self, filename, 
+                                                    maxBytes=maxBytes)
+      self.keepBytes = keepBytes
+
+   def doRollover(self):
+      if self.stream:
+         self.stream.close()
+         self.stream = None
+      chopLogFile(self.baseFilename, self.keepBytes)
+      self.stream = self._open()
+
+
+# Keep the most recent 1 MB, and let it grow to 2 MB before chopping again
+ARMORY_LOG_KEEP_BYTES = 1024*1024
+ARMORY_LOG_MAX_BYTES  = 2*1024*1024
+chopLogFile(ARMORY_LOG_FILE, ARMORY_LOG_KEEP_BYTES)
 
 
 # Now set loglevels
@@ -780,7 +850,6 @@ DEFAULT_FILE_LOGTHRESH    = logging.INFO
 DEFAULT_PPRINT_LOGLEVEL   = logging.DEBUG
 DEFAULT_RAWDATA_LOGLEVEL  = logging.DEBUG
 
-rootLogger = logging.getLogger('')
 if CLI_OPTIONS.doDebug or CLI_OPTIONS.netlog or CLI_OPTIONS.mtdebug:
    # Drop it all one level: console will see INFO, file will see DEBUG
    DEFAULT_CONSOLE_LOGTHRESH  -= 20
@@ -792,13 +861,19 @@ if CLI_OPTIONS.logDisable:
 
 
 DateFormat = '%Y-%m-%d %H:%M'
-logging.getLogger('').setLevel(logging.DEBUG)
+# The root level is what the LOG* methods check before doing any work, so
+# it has to let through everything that at least one handler wants
+rootLogger.setLevel(min(DEFAULT_FILE_LOGTHRESH, DEFAULT_CONSOLE_LOGTHRESH))
 fileFormatter  = logging.Formatter('%(asctime)s (%(levelname)s) -- %(message)s', \
                                      datefmt=DateFormat)
-fileHandler = logging.FileHandler(ARMORY_LOG_FILE)
+fileHandler = ChoppingFileHandler(ARMORY_LOG_FILE, ARMORY_LOG_MAX_BYTES,
+                                                   ARMORY_LOG_KEEP_BYTES)
 fileHandler.setLevel(DEFAULT_FILE_LOGTHRESH)
 fileHandler.setFormatter(fileFormatter)
-logging.getLogger('').addHandler(fileHandler)
+if CLI_OPTIONS.asyncLog:
+   logging.getLogger('').addHandler(QueuedLogHandler(fileHandler))
+else:
+   logging.getLogger('').addHandler(fileHandler)
 
 consoleFormatter = logging.Formatter('(%(levelname)s) %(message)s')
 consoleHandler = logging.StreamHandler()
@@ -822,21 +897,21 @@ class stringAggregator(object):
 # Do this by swapping out sys.stdout temporarily, execute theObj.pprint()
 # then set sys.stdout back to the original.
 def LOGPPRINT(theObj, loglevel=DEFAULT_PPRINT_LOGLEVEL):
+   if not rootLogger.isEnabledFor(loglevel):
+      return
    sys.stdout = stringAggregator()
    theObj.pprint()
    printedStr = sys.stdout.getStr()
    sys.stdout = sys.__stdout__
-   stkOneUp = traceback.extract_stack()[-2]
-   filename,method = stkOneUp[0], stkOneUp[1]
-   methodStr  = '(PPRINT from %s:%d)\n' % (filename,method)
+   methodStr  = '(PPRINT from %s)\n' % getCallerLine()
    logging.log(loglevel, methodStr + printedStr)
 
 # For super-debug mode, we'll write out raw data
 def LOGRAWDATA(rawStr, loglevel=DEFAULT_RAWDATA_LOGLEVEL):
+   if not rootLogger.isEnabledFor(loglevel):
+      return
    dtype = isLikelyDataType(rawStr)
-   stkOneUp = traceback.extract_stack()[-2]
-   filename,method = stkOneUp[0], stkOneUp[1]
-   methodStr  = '(PPRINT from %s:%d)\n' % (filename,method)
+   methodStr  = '(PPRINT from %s)\n' % getCallerLine()
    pstr = rawStr[:]
    if dtype==DATATYPE.Binary:
       pstr = binary_to_hex(rawStr)
@@ -1654,6 +1729,47 @@ def enum(*sequential, **named):
    enums = dict(zip(sequential, range(len(sequential))), **named)
    return type('Enum', (), enums)
 
+
+################################################################################
+class LRUCache(object):
+   """
+   Bounded dict that evicts the least-recently-used entry once it holds
+   maxSize entries.  Both get() and put() count as a use.  Not thread-safe
+   by itself;  callers sharing one across threads should lock around it.
+   """
+   def __init__(self, maxSize=1000):
+      self.maxSize = maxSize
+      self.data    = OrderedDict()
+
+   def __len__(self):
+      return len(self.data)
+
+   def __contains__(self, key):
+      return key in self.data
+
+   def get(self, key, default=None):
+      try:
+         value = self.data.pop(key)
+      except KeyError:
+         return default
+      self.data[key] = value
+      return value
+
+   def put(self, key, value=True):
+      self.data.pop(key, None)
+      self.data[key] = value
+      while len(self.data) > self.maxSize:
+         self.data.popitem(last=False)
+
+   def pop(self, key, default=None):
+      return self.data.pop(key, default)
+
+   def keys(self):
+      return self.data.keys()
+
+   def clear(self):
+      self.data.clear()
+
 DATATYPE = enum("Binary", 'Base58', 'Hex')
 
 
@@ -2422,6 +2538,27 @@ class FiniteField(object):
       baddinv = self.powinv(b)
       return self.mult(a,baddinv)
 
+   def batchinv(self,vals):
+      """
+      Inverts every element of vals using a single modular inversion
+      (Montgomery's trick).  Zeros have no inverse and come back as zero,
+      without spoiling the rest of the batch.
+      """
+      prefix = []
+      acc = 1
+      for v in vals:
+         prefix.append(acc)
+         if v % self.prime:
+            acc = (acc*v) % self.prime
+
+      accinv = self.powinv(acc)
+      out = [0]*len(vals)
+      for i in range(len(vals)-1,-1,-1):
+         if vals[i] % self.prime:
+            out[i] = (accinv*prefix[i]) % self.prime
+            accinv = (accinv*vals[i]) % self.prime
+      return out
+
    def mtrxrmrowcol(self,mtrx,r,c):
       if not len(mtrx) == len(mtrx[0]):
          LOGERROR('Must be a square matrix!')
@@ -2498,9 +2635,8 @@ def SplitSecret(secret, needed, pieces, nbytes=None, use_random_x=False):
       LOGERROR('You must create more pieces than needed to reconstruct!')
       raise FiniteFieldError
 
-   if needed==1 or needed>8:
-      LOGERROR('Can split secrets into parts *requiring* at most 8 fragments')
-      LOGERROR('You can break it into as many optional fragments as you want')
+   if needed<2:
+      LOGERROR('Splitting a secret requires at least 2 fragments to restore')
       raise FiniteFieldError
 
 
@@ -2512,11 +2648,11 @@ def SplitSecret(secret, needed, pieces, nbytes=None, use_random_x=False):
       lasthmac = HMAC512(lasthmac, 'splitsecrets')[:nbytes]
       othernum.append(binary_to_int(lasthmac))
 
+   # The secret is the leading coefficient:  a*x^(M-1) + c0*x^(M-2) + ...
    def poly(x):
-      polyout = ff.mult(a, ff.power(x,needed-1))
-      for i,e in enumerate(range(needed-2,-1,-1)):
-         term = ff.mult(othernum[i], ff.power(x,e))
-         polyout = ff.add(polyout, term)
+      polyout = a
+      for coeff in othernum[:needed-1]:
+         polyout = (polyout*x + coeff) % ff.prime
       return polyout
 
    for i in range(pieces):
@@ -2530,22 +2666,47 @@ def SplitSecret(secret, needed, pieces, nbytes=None, use_random_x=False):
 
 ################################################################################
 def ReconstructSecret(fragments, needed, nbytes):
+   return ReconstructSecretBatch([fragments[:needed]], nbytes)[0]
 
+
+################################################################################
+def ReconstructSecretBatch(fragSubsets, nbytes):
+   """
+   Recovers the secret from each list of [x,y] fragments in fragSubsets.
+
+   SplitSecret stores the secret as the leading coefficient of the
+   polynomial, which by Lagrange interpolation over the M points is
+      sum_i( y_i / prod_{j!=i}(x_i - x_j) )
+   so no matrix inversion is needed.  The denominators of every subset are
+   inverted together with one modular inversion, which makes checking all
+   the subsets of a backup about as cheap as checking one.
+   """
    ff = FiniteField(nbytes)
-   pairs = fragments[:needed]
-   m = []
-   v = []
-   for x,y in pairs:
-      x = binary_to_int(x, BIGENDIAN)
-      y = binary_to_int(y, BIGENDIAN)
-      m.append([])
-      for i,e in enumerate(range(needed-1,-1,-1)):
-         m[-1].append( ff.power(x,e) )
-      v.append(y)
 
-   minv = ff.mtrxinv(m)
-   outvect = ff.mtrxmultvect(minv,v)
-   return int_to_binary(outvect[0], nbytes, BIGENDIAN)
+   subsetPoints = []
+   denoms = []
+   for frags in fragSubsets:
+      points = [(binary_to_int(x, BIGENDIAN), binary_to_int(y, BIGENDIAN)) \
+                                                            for x,y in frags]
+      for i,(xi,yi) in enumerate(points):
+         denom = 1
+         for j,(xj,yj) in enumerate(points):
+            if not i==j:
+               denom = (denom * (xi-xj)) % ff.prime
+         denoms.append(denom)
+      subsetPoints.append(points)
+
+   invs = ff.batchinv(denoms)
+
+   secrets = []
+   k = 0
+   for points in subsetPoints:
+      secret = 0
+      for x,y in points:
+         secret = (secret + y*invs[k]) % ff.prime
+         k += 1
+      secrets.append(int_to_binary(secret, nbytes, BIGENDIAN))
+   return secrets
 
 
 ################################################################################
@@ -2565,20 +2726,13 @@ def createTestingSubsets( fragIndices, M, maxTestCount=20):
       LOGINFO('Test reconstruct %s-of-N, with %s fragments' % (M, numIdx))
       subs = []
 
-      # Compute the number of possible subsets.  This is stable because we
-      # shouldn't ever have more than 12 fragments
+      # Compute the number of possible subsets
       fact = math.factorial
       numCombo = fact(numIdx) / ( fact(M) * fact(numIdx-M) )
 
       if numCombo <= maxTestCount:
          LOGINFO('Testing all %s combinations...' % numCombo)
-         for x in xrange(2**numIdx):
-            bits = int_to_bitset(x)
-            if not bits.count('1') == M:
-               continue
-
-            subs.append(tuple([fragIndices[i] for i,b in enumerate(bits) if b=='1']))
-
+         subs = list(itertools.combinations(fragIndices, M))
          return (False, sorted(subs))
       else:
          LOGINFO('#Subsets > %s, will need to randomize' % maxTestCount)
@@ -2604,12 +2758,9 @@ def testReconstructSecrets(fragMap, M, maxTestCount=20):
    nBytes = len(fragMap[fragKeys[0]][1])
    LOGINFO('Testing %d-byte fragments' % nBytes)
 
-   testResults = []
-   for subset in subs:
-      fragSubset = [fragMap[i][:] for i in subset]
-
-      recon = ReconstructSecret(fragSubset, M, nBytes)
-      testResults.append((subset, recon))
+   fragSubsets = [[fragMap[i][:] for i in subset] for subset in subs]
+   recons = ReconstructSecretBatch(fragSubsets, nBytes)
+   testResults = zip(subs, recons)
 
    return isRandom, testResults
 
@@ -6,6 +6,7 @@
 #                                                                              #
 ################################################################################
 import Queue
+import itertools
 import os.path
 
 from armoryengine.ArmoryUtils import *
@@ -47,6 +48,9 @@ BDMINPUTTYPE  = enum('RegisterAddr', \
                      'AddrBookRequested', \
                      'BlockAtHeightRequested', \
                      'HeaderAtHeightRequested', \
+                     'InvFilterRequested', \
+                     'TxDataBatchRequested', \
+                     'PassthroughBatch', \
                      'ForceRebuild', \
                      'RescanRequested', \
                      'WalletRecoveryScan', \
@@ -58,6 +62,50 @@ BDMINPUTTYPE  = enum('RegisterAddr', \
                      'Reset', \
                      'Shutdown')
 
+# Requests that only read the block/tx store.  These don't go through the
+# input queue:  they are served by the reader thread, so a lookup doesn't
+# wait behind every queued scan.  It still can't run while the BDM thread
+# is inside a C++ call, see cppLock
+BDM_READ_INPUTS = (BDMINPUTTYPE.HeaderRequested, \
+                   BDMINPUTTYPE.TxRequested, \
+                   BDMINPUTTYPE.BlockRequested, \
+                   BDMINPUTTYPE.AddrBookRequested, \
+                   BDMINPUTTYPE.BlockAtHeightRequested, \
+                   BDMINPUTTYPE.HeaderAtHeightRequested, \
+                   BDMINPUTTYPE.InvFilterRequested, \
+                   BDMINPUTTYPE.TxDataBatchRequested, \
+                   BDMINPUTTYPE.PassthroughBatch)
+
+# C++ BDM methods that are safe to "passthrough" on the read path
+BDM_READONLY_PASSTHRU = frozenset(['getTopBlockHeight', \
+                                   'getTopBlockHeader', \
+                                   'getTopBlockHash', \
+                                   'getHeaderByHeight', \
+                                   'getHeaderByHash', \
+                                   'getHeaderPtrForTx', \
+                                   'getTxByHash', \
+                                   'hasHeaderWithHash', \
+                                   'hasTxWithHash', \
+                                   'getMainBlockFromDB', \
+                                   'getPrevTx', \
+                                   'getSentValue', \
+                                   'getSenderScrAddr', \
+                                   'missingBlockHashes', \
+                                   'scrAddrIsRegistered'])
+
+# Long-running inputs.  Reads issued after one of these are queued do not
+# wait for it to finish (see the read-your-writes note in __submitInput)
+BDM_SCAN_INPUTS = (BDMINPUTTYPE.RescanRequested, \
+                   BDMINPUTTYPE.WalletRecoveryScan, \
+                   BDMINPUTTYPE.GoOnlineRequested, \
+                   BDMINPUTTYPE.ForceRebuild)
+
+# Wallet scans are done this many blocks at a time, and between the pieces
+# the BDM thread hands cppLock to the reader thread for up to
+# BDM_READ_TURN_SECONDS if any reads are waiting
+BDM_SCAN_CHUNK_BLOCKS = 2016
+BDM_READ_TURN_SECONDS = 0.5
+
 def newTheBDM(isOffline=False, blocking=False):
    global TheBDM
    TheBDM = BlockDataManagerThread(isOffline=isOffline, blocking=blocking)
@@ -98,14 +146,24 @@ class BlockDataManagerThread(threading.Thread):
       you pass wait=False explicitly to one of those calls).
 
       Any calls that retrieve data from the BDM should block, even if you
-      technically can specify wait=False.  This is because the class was 
-      not designed to maintain organization of output data asynchronously.  
-      So a call like TheBDM.getTopBlockHeader() will always block, and you
-      should check the BDM state if you want to make sure it returns 
-      immediately.  Since there is only one main thread, There is really no
-      way for a rescan to be started between the time you check the state
-      and the time you call the method (so if you want to access the BDM 
-      from multiple threads, this class will need some redesign).
+      technically can specify wait=False.  So a call like
+      TheBDM.getTopBlockHeader() will always block.  Every request carries
+      its own ID and gets its own reply slot, so any number of threads can
+      be waiting on the BDM at once without getting each other's replies.
+
+      Read-only lookups (headers, tx, blocks, top block, address books and
+      the methods in BDM_READONLY_PASSTHRU) skip the input queue entirely.
+      They are answered by a single reader thread, so they don't wait for
+      every input queued ahead of them.  The C++ calls themselves are never
+      concurrent:  SWIG releases the GIL during them, and the C++ side
+      shares buffers (the LevelDB interface's last-read value, the
+      zero-conf and registered-scrAddr maps) between all callers.  So the
+      reader thread and the BDM thread both hold self.cppLock around
+      anything that touches self.bdm.  Wallet scans are split into pieces,
+      and the BDM thread lets waiting reads through between them, so a
+      lookup doesn't sit behind a whole-chain scan either.  The one-shot
+      C++ calls (initial load, forced rescans and rebuilds) can't be split
+      up, and reads still wait for those.
        
 
    This serves as a layer between the GUI and the Blockchain utilities.
@@ -186,15 +244,37 @@ class BlockDataManagerThread(threading.Thread):
 
       self.bdm = Cpp.BlockDataManager().getBDM()
 
-      # These are for communicating with the master (GUI) thread
+      # These are for communicating with the master (GUI) thread.  Every
+      # request gets its own ID and its own reply slot, so replies can't be
+      # handed to the wrong caller when several threads are waiting
       self.inputQueue  = Queue.Queue()
-      self.outputQueue = Queue.Queue()
+      self.readQueue   = Queue.Queue()
+      self.replySlots  = {}
+      self.replyLock   = threading.Lock()
+      self.submitLock  = threading.Lock()
+      self.requestIDs  = itertools.count(1)
+
+      # Reads wait for earlier non-scan inputs from the same thread
+      self.cppLock      = threading.Lock()
+      self.readTurn     = threading.Condition(threading.Lock())
+      self.readsWaiting = 0
+      self.inputDone    = threading.Condition(threading.Lock())
+      self.lastDoneID   = 0
+      self.threadLocal  = threading.local()
+      self.readerThread = None
 
       # Flags
       self.startBDM      = False
       self.doShutdown    = False
       self.aboutToRescan = False
-      self.errorOut      = 0
+      self.currentID     = 0
+
+      # Bumped whenever block data we handed out may have been undone.
+      # reorgBranchHeights[n] is the last height known to still be valid
+      # after reorg number n+1, so callers that missed a few can find the
+      # deepest one since they last looked
+      self.reorgCount         = 0
+      self.reorgBranchHeights = []
 
       self.setBlocking(blocking)
 
@@ -228,6 +308,12 @@ class BlockDataManagerThread(threading.Thread):
       except RuntimeError:
          LOGWARN("Attempt to start singleton TheBDM that has already been started.")
          pass
+
+      if self.readerThread is None:
+         self.readerThread = threading.Thread(target=self.readerLoop,
+                                              name='BDMReader')
+         self.readerThread.setDaemon(True)
+         self.readerThread.start()
       
    #############################################################################
    @ActLikeASingletonBDM
@@ -246,16 +332,17 @@ class BlockDataManagerThread(threading.Thread):
       unless you add 'waitForReturn=False' to the arg list.  i.e. all
       calls that "passthrough" will always block unless you explicitly
       tell it not to.
+
+      Methods listed in BDM_READONLY_PASSTHRU go to the reader thread
+      instead, so they don't queue up behind other inputs.
       '''
 
-      
-      rndID = int(random.uniform(0,100000000)) 
       if not hasattr(self.bdm, name):
          LOGERROR('No BDM method: %s', name)
          raise AttributeError
       else:
          def passthruFunc(*args, **kwargs):
-            #LOGDEBUG('External thread requesting: %s (%d)', name, rndID)
+            #LOGDEBUG('External thread requesting: %s', name)
             waitForReturn = True
             if len(kwargs)>0 and \
                kwargs.has_key('wait') and \
@@ -270,49 +357,124 @@ class BlockDataManagerThread(threading.Thread):
                kwargs['calledFromBDM']:
                   return getattr(self.bdm, name)(*args)
 
-            self.inputQueue.put([BDMINPUTTYPE.Passthrough, rndID, waitForReturn, name] + list(args))
-            
+            if name in BDM_READONLY_PASSTHRU:
+               return self.submitRead(BDMINPUTTYPE.Passthrough, 
+                                      self.mtWaitSec, name, *args)
+
+            reqID = self.submitInput(BDMINPUTTYPE.Passthrough, waitForReturn, 
+                                     name, *args)
 
             if waitForReturn:
                try:
-                  out = self.outputQueue.get(True, self.mtWaitSec)
-                  return out
+                  return self.getReply(reqID, self.mtWaitSec)
                except Queue.Empty:
                   LOGERROR('BDM was not ready for your request!  Waited %d sec.' % self.mtWaitSec)
                   LOGERROR('  getattr   name: %s', name)
                   LOGERROR('BDM currently doing: %s (%d)', self.currentActivity,self.currentID )
-                  LOGERROR('Waiting for completion: ID= %d', rndID)
+                  LOGERROR('Waiting for completion: ID= %d', reqID)
                   LOGERROR('Direct traceback')
                   traceback.print_stack()
-                  self.errorOut += 1
                   LOGEXCEPT('Traceback:')
          return passthruFunc
 
 
+   #############################################################################
+   @ActLikeASingletonBDM
+   def submitInput(self, cmd, expectOutput, *args):
+      """
+      Put a request on the BDM thread's input queue and return its ID.  If
+      expectOutput is True, a reply slot is created for the ID before the
+      request is queued;  collect the reply with getReply(reqID).
+
+      IDs are allocated and queued under one lock, so the BDM thread sees
+      them in increasing order.  Unless the request is a scan, the calling
+      thread remembers the ID:  its later reads wait until the BDM thread
+      is past it, so a thread always reads its own writes.
+      """
+      with self.submitLock:
+         reqID = self.requestIDs.next()
+         if expectOutput:
+            with self.replyLock:
+               self.replySlots[reqID] = Queue.Queue(1)
+         self.inputQueue.put([cmd, reqID, expectOutput] + list(args))
+
+      if not cmd in BDM_SCAN_INPUTS:
+         self.threadLocal.lastWriteID = reqID
+      return reqID
+
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def submitRead(self, cmd, timeout, *args):
+      """
+      Queue a read-only request for the reader thread and block until its
+      reply arrives.  Returns None if it doesn't arrive within timeout sec.
+      """
+      reqID = self.requestIDs.next()
+      barrierID = getattr(self.threadLocal, 'lastWriteID', 0)
+      with self.replyLock:
+         self.replySlots[reqID] = Queue.Queue(1)
+      self.readQueue.put([cmd, reqID, barrierID] + list(args))
+
+      try:
+         return self.getReply(reqID, timeout)
+      except Queue.Empty:
+         LOGERROR('Waited %s sec for %s (%d).  Abort', str(timeout), 
+                                          self.getBDMInputName(cmd), reqID)
+         return None
+
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def getReply(self, reqID, timeout):
+      """
+      Block until the reply for reqID shows up.  The slot is dropped whether
+      or not we got it, so a late reply is simply discarded by postReply
+      instead of being picked up by the next caller.
+      """
+      try:
+         with self.replyLock:
+            slot = self.replySlots[reqID]
+         return slot.get(True, timeout)
+      finally:
+         with self.replyLock:
+            self.replySlots.pop(reqID, None)
+
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def postReply(self, reqID, output):
+      with self.replyLock:
+         slot = self.replySlots.get(reqID)
+
+      if slot is None:
+         LOGWARN('Dropping BDM reply for request %d (caller gave up)', reqID)
+      else:
+         slot.put(output)
+
    
    #############################################################################
    @ActLikeASingletonBDM
-   def waitForOutputIfNecessary(self, expectOutput, rndID=0):
-      # The get() command will block until the thread puts something there.
-      # We don't always expect output, but we use this method to 
-      # replace inputQueue.join().  The reason for doing it is so 
-      # that we can guarantee that BDM thread knows whether we are waiting
-      # for output or not, and any additional requests put on the inputQueue
-      # won't extend our wait time for this request
+   def waitForOutputIfNecessary(self, expectOutput, reqID=0):
+      # The get() command will block until the thread puts something in the
+      # reply slot for this request.  We don't always expect output, but we 
+      # use this method to replace inputQueue.join().  The reason for doing 
+      # it is so that we can guarantee that BDM thread knows whether we are 
+      # waiting for output or not, and any additional requests put on the 
+      # inputQueue won't extend our wait time for this request
       if expectOutput:
          try:
-            return self.outputQueue.get(True, self.mtWaitSec)
+            return self.getReply(reqID, self.mtWaitSec)
          except Queue.Empty:
             stkOneUp = traceback.extract_stack()[-2]
             filename,method = stkOneUp[0], stkOneUp[1]
             LOGERROR('Waiting for BDM output that didn\'t come after %ds.' % self.mtWaitSec)
             LOGERROR('BDM state is currently: %s', self.getBDMState())
-            LOGERROR('Called from: %s:%d (%d)', os.path.basename(filename), method, rndID)
+            LOGERROR('Called from: %s:%d (%d)', os.path.basename(filename), method, reqID)
             LOGERROR('BDM currently doing: %s (%d)', self.currentActivity, self.currentID)
             LOGERROR('Direct traceback')
             traceback.print_stack()
             LOGEXCEPT('Traceback:')
-            self.errorOut += 1
       else:
          return None
       
@@ -343,9 +505,8 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.Reset, rndID, expectOutput] )
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      reqID = self.submitInput(BDMINPUTTYPE.Reset, expectOutput)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
    #############################################################################
    @ActLikeASingletonBDM
@@ -433,9 +594,8 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.Shutdown, rndID, expectOutput])
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      reqID = self.submitInput(BDMINPUTTYPE.Shutdown, expectOutput)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
    #############################################################################
    @ActLikeASingletonBDM
@@ -473,16 +633,19 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-
+      reqID = None
       if goOnline:
          if TheBDM.getBDMState() in ('Offline','Uninitialized'):
-            self.inputQueue.put([BDMINPUTTYPE.GoOnlineRequested, rndID, expectOutput])
+            reqID = self.submitInput(BDMINPUTTYPE.GoOnlineRequested, expectOutput)
       else:
          if TheBDM.getBDMState() in ('Scanning','BlockchainReady'):
-            self.inputQueue.put([BDMINPUTTYPE.GoOfflineRequested, rndID, expectOutput])
+            reqID = self.submitInput(BDMINPUTTYPE.GoOfflineRequested, expectOutput)
 
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      # Nothing was queued, so there is no reply to wait for
+      if reqID is None:
+         return None
+
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
    
    #############################################################################
    @ActLikeASingletonBDM
@@ -505,9 +668,8 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.ReadBlkUpdate, rndID, expectOutput])
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      reqID = self.submitInput(BDMINPUTTYPE.ReadBlkUpdate, expectOutput)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
       
 
    #############################################################################
@@ -516,6 +678,22 @@ class BlockDataManagerThread(threading.Thread):
       return self.blkMode==BLOCKCHAINMODE.Full and self.bdm.isInitialized()
 
 
+   #############################################################################
+   @ActLikeASingletonBDM
+   def getLastReorg(self, sinceCount=None):
+      """
+      Returns (reorgCount, branchHeight).  Anything cached from blocks above
+      branchHeight is stale once reorgCount changes.  Pass the reorgCount
+      seen last time as sinceCount to get the lowest branch point of all the
+      reorgs since then, not just the latest one.  A reset of the BDM counts
+      as a reorg all the way down (branchHeight=-1).
+      """
+      if sinceCount is None:
+         sinceCount = self.reorgCount - 1
+      branchHeights = self.reorgBranchHeights[max(sinceCount, 0):]
+      return (self.reorgCount, min(branchHeights) if branchHeights else -1)
+
+
    #############################################################################
    @ActLikeASingletonBDM
    def isDirty(self):
@@ -532,10 +710,9 @@ class BlockDataManagerThread(threading.Thread):
 
       self.aboutToRescan = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.RescanRequested, rndID, expectOutput, scanType])
+      reqID = self.submitInput(BDMINPUTTYPE.RescanRequested, expectOutput, scanType)
       LOGINFO('Blockchain rescan requested')
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
 
    #############################################################################
@@ -560,9 +737,8 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.UpdateWallets, rndID, expectOutput])
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      reqID = self.submitInput(BDMINPUTTYPE.UpdateWallets, expectOutput)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
 
    #############################################################################
@@ -586,10 +762,9 @@ class BlockDataManagerThread(threading.Thread):
 
       self.aboutToRescan = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.WalletRecoveryScan, rndID, expectOutput, pywlt])
+      reqID = self.submitInput(BDMINPUTTYPE.WalletRecoveryScan, expectOutput, pywlt)
       LOGINFO('Wallet recovery scan requested')
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
 
 
@@ -621,26 +796,15 @@ class BlockDataManagerThread(threading.Thread):
       """
       All calls that retrieve blockchain data are blocking calls.  You have 
       no choice in the matter!
-      """
-      #if not self.__checkBDMReadyToServeData():
-         #return None
-
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.TxRequested, rndID, True, txHash])
 
-      try:
-         result = self.outputQueue.get(True, 10)
-         if result==None:
-            LOGERROR('Requested tx does not exist:\n%s', binary_to_hex(txHash))
-         return result
-      except Queue.Empty:
-         LOGERROR('Waited 10s for tx to be returned.  Abort')
-         LOGERROR('ID: getTxByHash (%d)', rndID)
-         return None
-         #LOGERROR('Going to block until we get something...')
-         #return self.outputQueue.get(True)
-         
-      return None
+      These are served by the reader thread, so they don't queue up behind
+      other inputs, but they do wait for a C++ call in progress on the BDM
+      thread (such as a rescan) to finish.
+      """
+      result = self.submitRead(BDMINPUTTYPE.TxRequested, 10, txHash)
+      if result==None:
+         LOGERROR('Requested tx does not exist:\n%s', binary_to_hex(txHash))
+      return result
 
 
    ############################################################################
@@ -650,25 +814,11 @@ class BlockDataManagerThread(threading.Thread):
       All calls that retrieve blockchain data are blocking calls.  You have 
       no choice in the matter!
       """
-      #if not self.__checkBDMReadyToServeData():
-         #return None
-
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.HeaderRequested, rndID, True, headHash])
-
-      try:
-         result = self.outputQueue.get(True, 10)
-         if result==None:
-            LOGERROR('Requested header does not exist:\n%s', \
-                                          binary_to_hex(headHash))
-         return result
-      except Queue.Empty:
-         LOGERROR('Waited 10s for header to be returned.  Abort')
-         LOGERROR('ID: getTxByHash (%d)', rndID)
-         #LOGERROR('Going to block until we get something...')
-         #return self.outputQueue.get(True)
-
-      return None
+      result = self.submitRead(BDMINPUTTYPE.HeaderRequested, 10, headHash)
+      if result==None:
+         LOGERROR('Requested header does not exist:\n%s', \
+                                       binary_to_hex(headHash))
+      return result
 
 
    #############################################################################
@@ -682,25 +832,11 @@ class BlockDataManagerThread(threading.Thread):
       way as it is in the blkXXXX.dat files (including magic bytes and 
       block 4-byte block size)
       """
-      #if not self.__checkBDMReadyToServeData():
-         #return None
-
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.BlockRequested, rndID, True, headHash])
-
-      try:
-         result = self.outputQueue.get(True, 10)
-         if result==None:
-            LOGERROR('Requested block does not exist:\n%s', \
-                                          binary_to_hex(headHash))
-         return result
-      except Queue.Empty:
-         LOGERROR('Waited 10s for block to be returned.  Abort')
-         LOGERROR('ID: getTxByHash (%d)', rndID)
-         #LOGERROR('Going to block until we get something...')
-         #return self.outputQueue.get(True)
-
-      return None
+      result = self.submitRead(BDMINPUTTYPE.BlockRequested, 10, headHash)
+      if result==None:
+         LOGERROR('Requested block does not exist:\n%s', \
+                                       binary_to_hex(headHash))
+      return result
 
 
    #############################################################################
@@ -710,22 +846,83 @@ class BlockDataManagerThread(threading.Thread):
       Address books are constructed from Blockchain data, which means this 
       must be a blocking method.  
       """
-      rndID = int(random.uniform(0,100000000)) 
       if isinstance(wlt, PyBtcWallet):
-         self.inputQueue.put([BDMINPUTTYPE.AddrBookRequested, rndID, True, wlt.cppWallet])
+         cppWlt = wlt.cppWallet
       elif isinstance(wlt, Cpp.BtcWallet):
-         self.inputQueue.put([BDMINPUTTYPE.AddrBookRequested, rndID, True, wlt])
+         cppWlt = wlt
+      else:
+         LOGERROR('Unrecognized object passed to getAddressBook')
+         return None
 
-      try:
-         result = self.outputQueue.get(True, self.mtWaitSec)
-         return result
-      except Queue.Empty:
-         LOGERROR('Waited %ds for addrbook to be returned.  Abort' % self.mtWaitSec)
-         LOGERROR('ID: getTxByHash (%d)', rndID)
-         #LOGERROR('Going to block until we get something...')
-         #return self.outputQueue.get(True)
+      return self.submitRead(BDMINPUTTYPE.AddrBookRequested, 
+                             self.mtWaitSec, cppWlt)
 
-      return None
+   #############################################################################
+   @ActLikeASingletonBDM
+   def filterUnknownInventory(self, invList):
+      """
+      Takes a list of [invType, hash] pairs from an inv message and returns
+      the ones for blocks and tx the BDM doesn't have yet.  The whole list
+      is checked in a single round-trip to the reader thread, instead of
+      one hasHeaderWithHash/hasTxWithHash hop per entry.
+
+      While the BDM is scanning we can't do anything with new data anyway,
+      so nothing is reported as unknown.
+      """
+      if len(invList)==0 or self.getBDMState()=='Scanning':
+         return []
+
+      result = self.submitRead(BDMINPUTTYPE.InvFilterRequested, 
+                               self.mtWaitSec, invList)
+      if not isinstance(result, list):
+         LOGERROR('Could not filter inventory list (%d entries)', len(invList))
+         return []
+      return result
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def getTxDataBatch(self, txHashList, withSenders=False):
+      """
+      Fetches everything needed to display a page of ledger entries in one
+      round-trip to the reader thread, instead of separate getTxByHash,
+      getHeaderPtrForTx and getSentValue hops for every tx.
+
+      Returns a dict txHash -> [cppTx, cppHeader, fee, senders].  senders is
+      a list of [senderScrAddr, sentValue] for each TxIn if withSenders is
+      set, and None otherwise.  Unknown hashes are left out of the dict.
+      """
+      if len(txHashList)==0:
+         return {}
+
+      result = self.submitRead(BDMINPUTTYPE.TxDataBatchRequested, 
+                               self.mtWaitSec, txHashList, withSenders)
+      if not isinstance(result, dict):
+         LOGERROR('Could not get tx data for %d tx', len(txHashList))
+         return {}
+      return result
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def readPassthroughBatch(self, callList):
+      """
+      Runs a list of [methodName, arg1, arg2, ...] calls on the C++ BDM in a
+      single round-trip to the reader thread, and returns the list of
+      results in the same order.  Only methods in BDM_READONLY_PASSTHRU can
+      be batched this way.  Returns None if the request failed.
+      """
+      for call in callList:
+         if not call[0] in BDM_READONLY_PASSTHRU:
+            raise AttributeError('Cannot batch BDM method: %s' % call[0])
+
+      if len(callList)==0:
+         return []
+
+      result = self.submitRead(BDMINPUTTYPE.PassthroughBatch, 
+                               self.mtWaitSec, callList)
+      if not isinstance(result, list):
+         LOGERROR('Batch of %d BDM reads failed', len(callList))
+         return None
+      return result
 
    #############################################################################
    @ActLikeASingletonBDM
@@ -734,9 +931,8 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.ZeroConfTxToInsert, rndID, expectOutput, rawTx, timeRecv])
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      reqID = self.submitInput(BDMINPUTTYPE.ZeroConfTxToInsert, expectOutput, rawTx, timeRecv)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
       
    #############################################################################
    @ActLikeASingletonBDM
@@ -763,10 +959,9 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.RegisterAddr, rndID, expectOutput, scrAddr, True])
+      reqID = self.submitInput(BDMINPUTTYPE.RegisterAddr, expectOutput, scrAddr, True)
 
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
 
 
@@ -786,11 +981,10 @@ class BlockDataManagerThread(threading.Thread):
       if not wait==False and (self.alwaysBlock or wait==True):
          expectOutput = True
 
-      rndID = int(random.uniform(0,100000000)) 
-      self.inputQueue.put([BDMINPUTTYPE.RegisterAddr, rndID, expectOutput, \
-                           scrAddr, [firstTime, firstBlk, lastTime, lastBlk]])
+      reqID = self.submitInput(BDMINPUTTYPE.RegisterAddr, expectOutput, \
+                               scrAddr, [firstTime, firstBlk, lastTime, lastBlk])
 
-      return self.waitForOutputIfNecessary(expectOutput, rndID)
+      return self.waitForOutputIfNecessary(expectOutput, reqID)
 
          
    #############################################################################
@@ -923,6 +1117,59 @@ class BlockDataManagerThread(threading.Thread):
 
 
 
+   #############################################################################
+   @ActLikeASingletonBDM
+   def __yieldToReaders(self):
+      """
+      Called by the BDM thread, holding self.cppLock, between the pieces of
+      a long input.  If the reader thread is waiting for the lock, give it
+      up until the reads run out or BDM_READ_TURN_SECONDS have passed.
+      """
+      with self.readTurn:
+         if self.readsWaiting==0:
+            return
+
+      self.cppLock.release()
+      try:
+         endTime = time.time() + BDM_READ_TURN_SECONDS
+         with self.readTurn:
+            while not self.doShutdown:
+               timeLeft = endTime - time.time()
+               if timeLeft <= 0:
+                  break
+               if self.readsWaiting==0:
+                  # Give the reader a moment to pick up the next one, unless
+                  # it's held back by a barrier or there's nothing queued
+                  if self.readQueue.empty():
+                     break
+                  self.readTurn.wait(min(timeLeft, 0.01))
+                  if self.readsWaiting==0:
+                     break
+               else:
+                  self.readTurn.wait(timeLeft)
+      finally:
+         self.cppLock.acquire()
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def __scanWalletInChunks(self, cppWlt):
+      """
+      Same as self.bdm.scanBlockchainForTx(cppWlt), but BDM_SCAN_CHUNK_BLOCKS
+      blocks at a time, so reads don't wait for a whole-chain scan.  The C++
+      side carries on where the last piece stopped:  it scans the DB from
+      allScannedUpToBlk_ and the wallet from its lastScanned_.
+      """
+      nextBlk = self.bdm.getTopBlockHeight() + 1
+      endBlk = nextBlk - self.bdm.numBlocksToRescan(cppWlt, nextBlk)
+      fetchFirst = True
+      while endBlk + BDM_SCAN_CHUNK_BLOCKS < nextBlk:
+         endBlk += BDM_SCAN_CHUNK_BLOCKS
+         self.bdm.scanBlockchainForTx(cppWlt, 0, endBlk, fetchFirst)
+         fetchFirst = False
+         self.__yieldToReaders()
+
+      self.bdm.scanBlockchainForTx(cppWlt, 0, UINT32_MAX, fetchFirst)
+
    #############################################################################
    @TimeThisFunction
    @ActLikeASingletonBDM
@@ -1004,7 +1251,7 @@ class BlockDataManagerThread(threading.Thread):
 
       # The above op populates the BDM with all relevent tx, but those tx
       # still need to be scanned to collect the wallet ledger and UTXO sets
-      self.bdm.scanBlockchainForTx(self.masterCppWallet)
+      self.__scanWalletInChunks(self.masterCppWallet)
       self.bdm.saveScrAddrHistories()
 
       
@@ -1045,6 +1292,12 @@ class BlockDataManagerThread(threading.Thread):
       self.aboutToRescan = False
       
       if scanType=='AsNeeded':
+         # What an as-needed rescan mostly does is catch the master wallet
+         # up on imported addresses.  Doing that in pieces first leaves
+         # doSyncIfNeeded, which runs as one C++ call, only the last few
+         # days of blocks.  Forced rescans and rebuilds reset the databases
+         # first, so those can't be split up from here.
+         self.__scanWalletInChunks(self.masterCppWallet)
          self.bdm.doSyncIfNeeded()
       elif scanType=='ForceRescan':
          LOGINFO('Forcing full rescan of blockchain')
@@ -1057,7 +1310,7 @@ class BlockDataManagerThread(threading.Thread):
 
       # missingBlocks = self.bdm.missingBlockHashes()
       
-      self.bdm.scanBlockchainForTx(self.masterCppWallet)
+      self.__scanWalletInChunks(self.masterCppWallet)
       self.bdm.saveScrAddrHistories()
 
 
@@ -1124,8 +1377,21 @@ class BlockDataManagerThread(threading.Thread):
          return
 
       self.blkMode = BLOCKCHAINMODE.LiteScanning
+      prevTopHash = self.bdm.getTopBlockHash()
       nblk = self.bdm.readBlkFileUpdate() 
 
+      if nblk > 0:
+         # If the old top block fell off the main branch, walk back along
+         # its branch to find where it rejoins the new one
+         header = self.bdm.getHeaderByHash(prevTopHash)
+         if header and not header.isMainBranch():
+            while header and not header.isMainBranch():
+               header = self.bdm.getHeaderByHash(header.getPrevHash())
+            branchHeight = header.getBlockHeight() if header else -1
+            self.reorgBranchHeights.append(branchHeight)
+            self.reorgCount += 1
+            LOGWARN('Blockchain reorg, branch point at height %d', branchHeight)
+
       # On new blocks, re-save the histories
       # ACR: This was removed because the histories get saved already on the
       #      call to TheBDM.updateWalletsAfterScan()
@@ -1171,6 +1437,7 @@ class BlockDataManagerThread(threading.Thread):
          pyWlt.calledFromBDM = True
          pyWlt.syncWithBlockchain()
          pyWlt.calledFromBDM = prevCFB
+         self.__yieldToReaders()
 
 
       for cppWlt in self.cppWltList:
@@ -1198,7 +1465,7 @@ class BlockDataManagerThread(threading.Thread):
          # However we may want to re-examine this after we implement new
          # database modes of operation
          #self.bdm.scanRegisteredTxForWallet(cppWlt)
-         self.bdm.scanBlockchainForTx(cppWlt)
+         self.__scanWalletInChunks(cppWlt)
 
       # At this point all wallets should be 100% up-to-date, save the histories
       # to be reloaded next time
@@ -1228,6 +1495,8 @@ class BlockDataManagerThread(threading.Thread):
    def __reset(self):
       LOGERROR('Resetting BDM and all wallets')
       self.bdm.Reset()
+      self.reorgBranchHeights.append(-1)
+      self.reorgCount += 1
       
       if self.blkMode in (BLOCKCHAINMODE.Full, BLOCKCHAINMODE.Rescanning):
          # Uninitialized means we want to be online, but haven't loaded yet
@@ -1348,6 +1617,133 @@ class BlockDataManagerThread(threading.Thread):
       return (retVal, True)
 
 
+   #############################################################################
+   @ActLikeASingletonBDM
+   def serveRead(self, cmd, args):
+      """
+      Executed by the reader thread, with self.cppLock held
+      """
+      if not self.bdm.isInitialized():
+         LOGWARN('Blockchain data requested before the BDM was initialized')
+         return None
+
+      if cmd == BDMINPUTTYPE.HeaderRequested:
+         return self.bdm.getHeaderByHash(args[0]) or None
+
+      elif cmd == BDMINPUTTYPE.TxRequested:
+         return self.bdm.getTxByHash(args[0]) or None
+
+      elif cmd == BDMINPUTTYPE.BlockRequested:
+         rawBlock = self.__getFullBlock(args[0])
+         if not rawBlock:
+            LOGERROR('Requested header does not exist:\n%s', \
+                                             binary_to_hex(args[0]))
+         return rawBlock or None
+
+      elif cmd == BDMINPUTTYPE.HeaderAtHeightRequested:
+         rawHeader = self.bdm.getHeaderByHeight(args[0])
+         if not rawHeader:
+            LOGERROR('Requested header does not exist:\nHeight=%s', args[0])
+         return rawHeader or None
+
+      elif cmd == BDMINPUTTYPE.BlockAtHeightRequested:
+         rawBlock = self.__getFullBlock(args[0])
+         if not rawBlock:
+            LOGERROR('Requested header does not exist:\nHeight=%s', args[0])
+         return rawBlock or None
+
+      elif cmd == BDMINPUTTYPE.AddrBookRequested:
+         return self.createAddressBook(args[0])
+
+      elif cmd == BDMINPUTTYPE.InvFilterRequested:
+         # Inv types are MSG_INV_BLOCK (2) and MSG_INV_TX (1), see Networking
+         unknown = []
+         for inv in args[0]:
+            if inv[0]==2:
+               if not self.bdm.hasHeaderWithHash(inv[1]):
+                  unknown.append(inv)
+            elif inv[0]==1:
+               if not self.bdm.hasTxWithHash(inv[1]):
+                  unknown.append(inv)
+         return unknown
+
+      elif cmd == BDMINPUTTYPE.TxDataBatchRequested:
+         txHashList, withSenders = args
+         txData = {}
+         for txHash in txHashList:
+            if txHash in txData or not self.bdm.hasTxWithHash(txHash):
+               continue
+            cppTx = self.bdm.getTxByHash(txHash)
+            if not cppTx.isInitialized():
+               continue
+            cppHead = self.bdm.getHeaderPtrForTx(cppTx)
+            valIn, valOut = 0, 0
+            senders = [] if withSenders else None
+            for i in range(cppTx.getNumTxIn()):
+               txin = cppTx.getTxInCopy(i)
+               val = self.bdm.getSentValue(txin)
+               valIn += val
+               if withSenders:
+                  senders.append([self.bdm.getSenderScrAddr(txin), val])
+            for i in range(cppTx.getNumTxOut()):
+               valOut += cppTx.getTxOutCopy(i).getValue()
+            txData[txHash] = [cppTx, cppHead, valIn - valOut, senders]
+         return txData
+
+      elif cmd == BDMINPUTTYPE.Passthrough:
+         return getattr(self.bdm, args[0])(*args[1:])
+
+      elif cmd == BDMINPUTTYPE.PassthroughBatch:
+         return [getattr(self.bdm, call[0])(*call[1:]) for call in args[0]]
+
+      LOGERROR('Not a read-only BDM input: %s', self.getBDMInputName(cmd))
+      return None
+
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def readerLoop(self):
+      """
+      The reader thread pulls read-only requests off self.readQueue and
+      answers them under self.cppLock.  A request carries the ID
+      of the last non-scan input its thread submitted, and is held back
+      until the BDM thread has processed that input.  While it waits for
+      cppLock it counts in self.readsWaiting, so a BDM thread in the middle
+      of a long scan knows to let it in (see __yieldToReaders).
+      """
+      while True:
+         readTuple = self.readQueue.get()
+         if readTuple is None:
+            break
+
+         cmd, reqID, barrierID = readTuple[:3]
+         output = None
+         try:
+            with self.inputDone:
+               while self.lastDoneID < barrierID and not self.doShutdown:
+                  self.inputDone.wait()
+
+            with self.readTurn:
+               self.readsWaiting += 1
+               self.readTurn.notifyAll()
+            try:
+               with self.cppLock:
+                  output = self.serveRead(cmd, readTuple[3:])
+            finally:
+               with self.readTurn:
+                  self.readsWaiting -= 1
+                  self.readTurn.notifyAll()
+         except:
+            LOGERROR('Error processing BDM read')
+            LOGERROR('Received readTuple: %s %s', self.getBDMInputName(cmd), \
+                                                  str(readTuple))
+            LOGEXCEPT('ERROR:')
+            output = 'BDM_REQUEST_ERROR'
+
+         self.postReply(reqID, output)
+
+
+   #############################################################################
    @ActLikeASingletonBDM
    def run(self):
       """
@@ -1355,21 +1751,11 @@ class BlockDataManagerThread(threading.Thread):
       on the self.inputQueue, and then processing those entries.  If there
       are no requests to the BDM from the main thread, this thread will just
       sit idle (in a CPU-friendly fashion) until something does.
+
+      Read-only requests never show up here; see readerLoop.
       """
 
       while not self.doShutdown:
-         # If there were any errors, we will have that many extra output
-         # entries on the outputQueue.  We clear them off so that this 
-         # thread can be re-sync'd with the main thread
-         try:
-            while self.errorOut>0:
-               self.outputQueue.get_nowait()
-               self.errorOut -= 1
-         except Queue.Empty:
-            LOGERROR('ErrorOut var over-represented number of errors!')
-            self.errorOut = 0
-               
-
          # Now start the main 
          try:
             try:
@@ -1397,135 +1783,96 @@ class BlockDataManagerThread(threading.Thread):
 
 
             # The first list element is always the BDMINPUTTYPE (command)
-            # The second argument is whether the caller will be waiting 
-            # for the output:  which means even if it's None, we need to
-            # put something on the output queue.
+            # The second is the request ID, and the third is whether the 
+            # caller will be waiting for the output:  which means even if 
+            # it's None, we need to put something in its reply slot.
             cmd          = inputTuple[0]
-            rndID        = inputTuple[1]
+            reqID        = inputTuple[1]
             expectOutput = inputTuple[2]
             output       = None
 
             # Some variables that can be queried externally to figure out 
             # what the BDM is currently doing
             self.currentActivity = self.getBDMInputName(inputTuple[0])
-            self.currentID = rndID
-
-            if cmd == BDMINPUTTYPE.RegisterAddr:
-               scrAddr,timeInfo = inputTuple[3:]
-               self.__registerScrAddrNow(scrAddr, timeInfo)
-
-            elif cmd == BDMINPUTTYPE.ZeroConfTxToInsert:
-               rawTx  = inputTuple[3]
-               timeIn = inputTuple[4]
-               if isinstance(rawTx, PyTx):
-                  rawTx = rawTx.serialize()
-               self.bdm.addNewZeroConfTx(rawTx, timeIn, True)
-               
-            elif cmd == BDMINPUTTYPE.HeaderRequested:
-               headHash = inputTuple[3]
-               rawHeader = self.bdm.getHeaderByHash(headHash)
-               if rawHeader:
-                  output = rawHeader
-               else:
-                  output = None
+            self.currentID = reqID
 
-            elif cmd == BDMINPUTTYPE.TxRequested:
-               txHash = inputTuple[3] 
-               rawTx = self.bdm.getTxByHash(txHash)
-               if rawTx:
-                  output = rawTx
-               else:
-                  output = None
+            self.cppLock.acquire()
+            try:
+               if cmd == BDMINPUTTYPE.RegisterAddr:
+                  scrAddr,timeInfo = inputTuple[3:]
+                  self.__registerScrAddrNow(scrAddr, timeInfo)
+
+               elif cmd == BDMINPUTTYPE.ZeroConfTxToInsert:
+                  rawTx  = inputTuple[3]
+                  timeIn = inputTuple[4]
+                  if isinstance(rawTx, PyTx):
+                     rawTx = rawTx.serialize()
+                  self.bdm.addNewZeroConfTx(rawTx, timeIn, True)
+                                                
+               elif cmd == BDMINPUTTYPE.UpdateWallets:
+                  self.__updateWalletsAfterScan()
+
+               elif cmd == BDMINPUTTYPE.RescanRequested:
+                  scanType = inputTuple[3]
+                  if not scanType in ('AsNeeded', 'ForceRescan', 'ForceRebuild'):
+                     LOGERROR('Invalid scan type for rescanning: ' + scanType)
+                     scanType = 'AsNeeded'
+                  self.__startRescanBlockchain(scanType)
+
+               elif cmd == BDMINPUTTYPE.WalletRecoveryScan:
+                  LOGINFO('Wallet Recovery Scan Requested')
+                  pywlt = inputTuple[3]
+                  self.__startRecoveryRescan(pywlt)
                   
-            elif cmd == BDMINPUTTYPE.BlockRequested:
-               headHash = inputTuple[3] 
-               rawBlock = self.__getFullBlock(headHash)
-               if rawBlock:
-                  output = rawBlock
-               else:
-                  output = None
-                  LOGERROR('Requested header does not exist:\n%s', \
-                                             binary_to_hex(headHash))
-
-            elif cmd == BDMINPUTTYPE.HeaderAtHeightRequested:
-               height = inputTuple[3] 
-               rawHeader = self.bdm.getHeaderByHeight(height)
-               if rawHeader:
-                  output = rawHeader
-               else:
-                  output = None
-                  LOGERROR('Requested header does not exist:\nHeight=%s', height)
-         
-            elif cmd == BDMINPUTTYPE.BlockAtHeightRequested:
-               height = inputTuple[3] 
-               rawBlock = self.__getFullBlock(height)
-               if rawBlock:
-                  output = rawBlock
-               else:
-                  output = None
-                  LOGERROR('Requested header does not exist:\nHeight=%s', height)
-
-            elif cmd == BDMINPUTTYPE.AddrBookRequested:
-               cppWlt = inputTuple[3] 
-               output = self.createAddressBook(cppWlt)
-                                             
-            elif cmd == BDMINPUTTYPE.UpdateWallets:
-               self.__updateWalletsAfterScan()
-
-            elif cmd == BDMINPUTTYPE.RescanRequested:
-               scanType = inputTuple[3]
-               if not scanType in ('AsNeeded', 'ForceRescan', 'ForceRebuild'):
-                  LOGERROR('Invalid scan type for rescanning: ' + scanType)
-                  scanType = 'AsNeeded'
-               self.__startRescanBlockchain(scanType)
-
-            elif cmd == BDMINPUTTYPE.WalletRecoveryScan:
-               LOGINFO('Wallet Recovery Scan Requested')
-               pywlt = inputTuple[3]
-               self.__startRecoveryRescan(pywlt)
-               
-            elif cmd == BDMINPUTTYPE.ReadBlkUpdate:
-               output = self.__readBlockfileUpdates()
-
-            elif cmd == BDMINPUTTYPE.Passthrough:
-               # If the caller is waiting, then it is notified by output
-               funcName = inputTuple[3]
-               funcArgs = inputTuple[4:]
-               output = getattr(self.bdm, funcName)(*funcArgs)
-
-            elif cmd == BDMINPUTTYPE.Shutdown:
-               LOGINFO('Shutdown Requested')
-               self.__shutdown()
-
-            elif cmd == BDMINPUTTYPE.ForceRebuild:
-               LOGINFO('Rebuild databases requested')
-               self.__fullRebuild()
-
-            elif cmd == BDMINPUTTYPE.Reset:
-               LOGINFO('Reset Requested')
-               self.__reset()
-               
-            elif cmd == BDMINPUTTYPE.GoOnlineRequested:
-               LOGINFO('Go online requested')
-               # This only sets the blkMode to what will later be
-               # recognized as online-requested, or offline
-               self.prefMode = BLOCKCHAINMODE.Full
-               if self.bdm.isInitialized():
-                  # The BDM was started and stopped at one point, without
-                  # being reset.  It can safely pick up from where it 
-                  # left off
-                  self.__readBlockfileUpdates()
-               else:
-                  self.blkMode = BLOCKCHAINMODE.Uninitialized
-                  self.__startLoadBlockchain()
+               elif cmd == BDMINPUTTYPE.ReadBlkUpdate:
+                  output = self.__readBlockfileUpdates()
+
+               elif cmd == BDMINPUTTYPE.Passthrough:
+                  # If the caller is waiting, then it is notified by output
+                  funcName = inputTuple[3]
+                  funcArgs = inputTuple[4:]
+                  output = getattr(self.bdm, funcName)(*funcArgs)
+
+               elif cmd == BDMINPUTTYPE.Shutdown:
+                  LOGINFO('Shutdown Requested')
+                  self.__shutdown()
+
+               elif cmd == BDMINPUTTYPE.ForceRebuild:
+                  LOGINFO('Rebuild databases requested')
+                  self.__fullRebuild()
+
+               elif cmd == BDMINPUTTYPE.Reset:
+                  LOGINFO('Reset Requested')
+                  self.__reset()
+                  
+               elif cmd == BDMINPUTTYPE.GoOnlineRequested:
+                  LOGINFO('Go online requested')
+                  # This only sets the blkMode to what will later be
+                  # recognized as online-requested, or offline
+                  self.prefMode = BLOCKCHAINMODE.Full
+                  if self.bdm.isInitialized():
+                     # The BDM was started and stopped at one point, without
+                     # being reset.  It can safely pick up from where it 
+                     # left off
+                     self.__readBlockfileUpdates()
+                  else:
+                     self.blkMode = BLOCKCHAINMODE.Uninitialized
+                     self.__startLoadBlockchain()
+
+               elif cmd == BDMINPUTTYPE.GoOfflineRequested:
+                  LOGINFO('Go offline requested')
+                  self.prefMode = BLOCKCHAINMODE.Offline
 
-            elif cmd == BDMINPUTTYPE.GoOfflineRequested:
-               LOGINFO('Go offline requested')
-               self.prefMode = BLOCKCHAINMODE.Offline
+               elif cmd in BDM_READ_INPUTS:
+                  LOGERROR('Read-only input on the BDM input queue: %s', 
+                                                   self.currentActivity)
+            finally:
+               self.cppLock.release()
+               self.markInputDone(reqID)
 
             self.inputQueue.task_done()
             if expectOutput:
-               self.outputQueue.put(output)
+               self.postReply(reqID, output)
 
          except Queue.Empty:
             continue
@@ -1534,14 +1881,26 @@ class BlockDataManagerThread(threading.Thread):
             LOGERROR('Error processing BDM input')
             #traceback.print_stack()
             LOGERROR('Received inputTuple: ' + inputName + ' ' + str(inputTuple))
-            LOGERROR('Error processing ID (%d)', rndID)
+            LOGERROR('Error processing ID (%d)', reqID)
             LOGEXCEPT('ERROR:')
             if expectOutput:
-               self.outputQueue.put('BDM_REQUEST_ERROR')
+               self.postReply(reqID, 'BDM_REQUEST_ERROR')
             self.inputQueue.task_done()
             continue
            
+      # Release the reader thread (and anything it's holding back)
+      self.markInputDone(self.currentID)
+      self.readQueue.put(None)
+
       LOGINFO('BDM is shutdown.')
+
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def markInputDone(self, reqID):
+      with self.inputDone:
+         self.lastDoneID = max(self.lastDoneID, reqID)
+         self.inputDone.notify_all()
       
          
 ################################################################################
@@ -12,12 +12,56 @@
 # Orig Date:  20 November, 2011
 #
 ################################################################################
-from armoryengine.ArmoryUtils import LITTLEENDIAN, int_to_binary, packVarInt
+from armoryengine.ArmoryUtils import LITTLEENDIAN, BIGENDIAN, packVarInt
 UINT8, UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, BINARY_CHUNK = range(12)
-from struct import pack, unpack
+from struct import Struct, error as StructError
 
 class PackerError(Exception): pass
 
+
+# Format characters for every fixed-width type.  The compiled Struct objects
+# are built once per (type, endianness), and shared with BinaryUnpacker
+FIXED_WIDTH_FMT = { UINT8:  'B', UINT16: 'H', UINT32: 'I', UINT64: 'Q',
+                    INT8:   'b', INT16:  'h', INT32:  'i', INT64:  'q',
+                    FLOAT:  'f' }
+
+STRUCT_CACHE = {}
+for _end in (LITTLEENDIAN, BIGENDIAN):
+   for _vtype,_fmt in FIXED_WIDTH_FMT.iteritems():
+      STRUCT_CACHE[(_vtype, _end)] = Struct(_end + _fmt)
+
+def getFixedWidthStruct(varType, endianness):
+   """ Returns the cached Struct for a fixed-width type, or None """
+   codec = STRUCT_CACHE.get((varType, endianness))
+   if codec is None and varType in FIXED_WIDTH_FMT:
+      codec = Struct(endianness + FIXED_WIDTH_FMT[varType])
+      STRUCT_CACHE[(varType, endianness)] = codec
+   return codec
+
+# Layouts passed to putMany()/getMany() are compiled on first use
+LAYOUT_CACHE = {}
+
+def getLayoutStruct(varTypes, endianness):
+   """
+   Compile a list of fixed-width types and (BINARY_CHUNK, sz) pairs into a 
+   single Struct.  Returns None if the list contains anything else.
+   """
+   key = (tuple(varTypes), endianness)
+   codec = LAYOUT_CACHE.get(key)
+   if codec is None:
+      fmt = [endianness]
+      for vtype in varTypes:
+         if isinstance(vtype, (list,tuple)) and vtype[0]==BINARY_CHUNK:
+            fmt.append('%ds' % vtype[1])
+         elif vtype in FIXED_WIDTH_FMT:
+            fmt.append(FIXED_WIDTH_FMT[vtype])
+         else:
+            return None
+      codec = Struct(''.join(fmt))
+      LAYOUT_CACHE[key] = codec
+   return codec
+
+
 class BinaryPacker(object):
 
    """
@@ -26,22 +70,55 @@ class BinaryPacker(object):
       >> bup.put(UINT32, 12)
       >> bup.put(VAR_INT, 78)
       >> bup.put(BINARY_CHUNK, '\x9f'*10)
+      >> bup.putMany([UINT32, UINT8], [1, 2])
       >> ...etc...
       >> result = bup.getBinaryString()
+
+   Data is written into a single bytearray that grows geometrically.  If 
+   you know roughly how big the result will be, pass sizeHint and it will
+   usually never have to grow at all.
    """
-   def __init__(self):
-      self.binaryConcat = []
+   def __init__(self, sizeHint=0):
+      self.binaryBuf = bytearray(max(sizeHint, 64))
+      self.size = 0
 
    def getSize(self):
-      return sum([len(a) for a in self.binaryConcat])
+      return self.size
 
    def getBinaryString(self):
-      return ''.join(self.binaryConcat)
+      if self.size == len(self.binaryBuf):
+         return str(self.binaryBuf)
+      return memoryview(self.binaryBuf)[:self.size].tobytes()
 
    def __str__(self):
       return self.getBinaryString()
 
+   #############################################################################
+   def reserve(self, nBytes):
+      """ Make sure there is room for nBytes more without reallocating """
+      needed = self.size + nBytes
+      if needed > len(self.binaryBuf):
+         newLen = max(needed, 2*len(self.binaryBuf))
+         self.binaryBuf.extend('\x00' * (newLen - len(self.binaryBuf)))
+
+   #############################################################################
+   def putBytes(self, theData):
+      n = len(theData)
+      self.reserve(n)
+      self.binaryBuf[self.size:self.size+n] = theData
+      self.size += n
+
+   #############################################################################
+   def putStruct(self, codec, *values):
+      self.reserve(codec.size)
+      try:
+         codec.pack_into(self.binaryBuf, self.size, *values)
+      except StructError as e:
+         raise PackerError, 'Cannot pack %s: %s' % (str(values), str(e))
+      self.size += codec.size
 
+
+   #############################################################################
    def put(self, varType, theData, width=None, endianness=LITTLEENDIAN):
       """
       Need to supply the argument type you are put'ing into the stream.
@@ -49,38 +126,36 @@ class BinaryPacker(object):
 
       Use width=X to include padding of BINARY_CHUNKs w/ 0x00 bytes
       """
-      E = endianness
-      if   varType == UINT8:
-         self.binaryConcat += int_to_binary(theData, 1, endianness)
-      elif varType == UINT16:
-         self.binaryConcat += int_to_binary(theData, 2, endianness)
-      elif varType == UINT32:
-         self.binaryConcat += int_to_binary(theData, 4, endianness)
-      elif varType == UINT64:
-         self.binaryConcat += int_to_binary(theData, 8, endianness)
-      elif varType == INT8:
-         self.binaryConcat += pack(E+'b', theData)
-      elif varType == INT16:
-         self.binaryConcat += pack(E+'h', theData)
-      elif varType == INT32:
-         self.binaryConcat += pack(E+'i', theData)
-      elif varType == INT64:
-         self.binaryConcat += pack(E+'q', theData)
+      codec = getFixedWidthStruct(varType, endianness)
+      if codec is not None:
+         self.putStruct(codec, theData)
       elif varType == VAR_INT:
-         self.binaryConcat += packVarInt(theData)[0]
+         self.putBytes(packVarInt(theData)[0])
       elif varType == VAR_STR:
-         self.binaryConcat += packVarInt(len(theData))[0]
-         self.binaryConcat += theData
-      elif varType == FLOAT:
-         self.binaryConcat += pack(E+'f', theData)
+         self.putBytes(packVarInt(len(theData))[0])
+         self.putBytes(theData)
       elif varType == BINARY_CHUNK:
          if width==None:
-            self.binaryConcat += theData
+            self.putBytes(theData)
          else:
             if len(theData)>width:
                raise PackerError, 'Too much data to fit into fixed width field'
-            self.binaryConcat += theData.ljust(width, '\x00')
+            self.putBytes(theData)
+            self.putBytes('\x00' * (width-len(theData)))
       else:
          raise PackerError, "Var type not recognized!  VarType="+str(varType)
 
-
+   #############################################################################
+   def putMany(self, varTypes, values, endianness=LITTLEENDIAN):
+      """
+      Write a run of fixed-width fields with a single pack call.  varTypes
+      takes the same layouts as BinaryUnpacker.getMany():  fixed-width types
+      or (BINARY_CHUNK, sz) pairs.  BINARY_CHUNK values shorter than sz are
+      padded with 0x00 bytes.
+      """
+      codec = getLayoutStruct(varTypes, endianness)
+      if codec is None:
+         raise PackerError, 'putMany only handles fixed-width types'
+      if not len(values)==len(varTypes):
+         raise PackerError, 'Expected %d values, got %d' % (len(varTypes), len(values))
+      self.putStruct(codec, *values)
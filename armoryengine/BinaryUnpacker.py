@@ -21,12 +21,20 @@
 #  Classes for reading and writing large binary objects
 ################################################################################
 ################################################################################
-from struct import pack, unpack
-from BinaryPacker import UINT8, UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, BINARY_CHUNK
-from armoryengine.ArmoryUtils import LITTLEENDIAN, unpackVarInt, LOGERROR
+from struct import error as StructError
+from BinaryPacker import UINT8, UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, BINARY_CHUNK, \
+                         STRUCT_CACHE, getFixedWidthStruct, getLayoutStruct
+from armoryengine.ArmoryUtils import LITTLEENDIAN, LOGERROR
 
 class UnpackerError(Exception): pass
 
+
+VARINT_U8  = STRUCT_CACHE[(UINT8,  LITTLEENDIAN)]
+VARINT_U16 = STRUCT_CACHE[(UINT16, LITTLEENDIAN)]
+VARINT_U32 = STRUCT_CACHE[(UINT32, LITTLEENDIAN)]
+VARINT_U64 = STRUCT_CACHE[(UINT64, LITTLEENDIAN)]
+
+
 # Seed this object with binary data, then read in its pieces sequentially
 class BinaryUnpacker(object):
    """
@@ -35,96 +43,134 @@ class BinaryUnpacker(object):
       >> int32   = bup.get(UINT32)
       >> int64   = bup.get(VAR_INT)
       >> bytes10 = bup.get(BINARY_CHUNK, 10)
+      >> ver,cnt = bup.getMany([UINT32, UINT8])
       >> ...etc...
+
+   Fixed-width fields are decoded in place with Struct.unpack_from, so no
+   intermediate slice is created for them.  The data may be a str or any
+   object supporting the buffer interface (memoryview, bytearray, mmap);
+   BINARY_CHUNK and VAR_STR reads always come back as str.
    """
    def __init__(self, binaryStr):
       self.binaryStr = binaryStr
+      self.isStr = isinstance(binaryStr, str)
       self.pos = 0
 
    def getSize(self): return len(self.binaryStr)
    def getRemainingSize(self): return len(self.binaryStr) - self.pos
    def getBinaryString(self): return self.binaryStr
-   def getRemainingString(self): return self.binaryStr[self.pos:]
-   def append(self, binaryStr): self.binaryStr += binaryStr
+   def getRemainingString(self): return self.getChunk(self.pos, len(self.binaryStr)-self.pos)
    def advance(self, bytesToAdvance): self.pos += bytesToAdvance
    def rewind(self, bytesToRewind): self.pos -= bytesToRewind
    def resetPosition(self, toPos=0): self.pos = toPos
    def getPosition(self): return self.pos
 
+   #############################################################################
+   def append(self, binaryStr):
+      self.binaryStr = self.getBinaryStr() + binaryStr
+      self.isStr = True
+
+   #############################################################################
+   def getBinaryStr(self):
+      """ The underlying data as a str, whatever it was created with """
+      if self.isStr:
+         return self.binaryStr
+      return self.getChunk(0, len(self.binaryStr))
+
+   #############################################################################
+   def getRemainingBuffer(self):
+      """
+      Zero-copy access to the unread tail:  a read-only memoryview over the 
+      remaining bytes.  Use getRemainingString() if you need an actual str.
+      """
+      try:
+         return memoryview(self.binaryStr)[self.pos:]
+      except TypeError:
+         # mmap only has the old-style buffer interface in python 2
+         return buffer(self.binaryStr, self.pos)
+
+   #############################################################################
+   def getChunk(self, start, sz):
+      """ Return sz bytes at absolute offset start, as a str """
+      if self.isStr:
+         return self.binaryStr[start:start+sz]
+      chunk = self.binaryStr[start:start+sz]
+      if isinstance(chunk, memoryview):
+         return chunk.tobytes()
+      # bytearray slices are bytearrays, mmap slices are already str
+      return str(chunk)
+
+   #############################################################################
+   def getVarIntAt(self, pos):
+      """ Returns [value, nBytes] for the var_int at absolute offset pos """
+      if self.isStr:
+         code = ord(self.binaryStr[pos])
+      else:
+         code = VARINT_U8.unpack_from(self.binaryStr, pos)[0]
+      try:
+         if   code  < 0xfd: return [code, 1]
+         elif code == 0xfd: return [VARINT_U16.unpack_from(self.binaryStr, pos+1)[0], 3]
+         elif code == 0xfe: return [VARINT_U32.unpack_from(self.binaryStr, pos+1)[0], 5]
+         else:              return [VARINT_U64.unpack_from(self.binaryStr, pos+1)[0], 9]
+      except StructError:
+         raise UnpackerError, 'Not enough data for var_int'
+
+   #############################################################################
    def get(self, varType, sz=0, endianness=LITTLEENDIAN):
       """
       First argument is the data-type:  UINT32, VAR_INT, etc.
       If BINARY_CHUNK, need to supply a number of bytes to read, as well
       """
-      def sizeCheck(sz):
-         if self.getRemainingSize()<sz:
-            raise UnpackerError
-
-      E = endianness
       pos = self.pos
-      if varType == UINT32:
-         sizeCheck(4)
-         value = unpack(E+'I', self.binaryStr[pos:pos+4])[0]
-         self.advance(4)
-         return value
-      elif varType == UINT64:
-         sizeCheck(8)
-         value = unpack(E+'Q', self.binaryStr[pos:pos+8])[0]
-         self.advance(8)
-         return value
-      elif varType == UINT8:
-         sizeCheck(1)
-         value = unpack(E+'B', self.binaryStr[pos:pos+1])[0]
-         self.advance(1)
-         return value
-      elif varType == UINT16:
-         sizeCheck(2)
-         value = unpack(E+'H', self.binaryStr[pos:pos+2])[0]
-         self.advance(2)
-         return value
-      elif varType == INT32:
-         sizeCheck(4)
-         value = unpack(E+'i', self.binaryStr[pos:pos+4])[0]
-         self.advance(4)
-         return value
-      elif varType == INT64:
-         sizeCheck(8)
-         value = unpack(E+'q', self.binaryStr[pos:pos+8])[0]
-         self.advance(8)
-         return value
-      elif varType == INT8:
-         sizeCheck(1)
-         value = unpack(E+'b', self.binaryStr[pos:pos+1])[0]
-         self.advance(1)
-         return value
-      elif varType == INT16:
-         sizeCheck(2)
-         value = unpack(E+'h', self.binaryStr[pos:pos+2])[0]
-         self.advance(2)
-         return value
+      codec = getFixedWidthStruct(varType, endianness)
+      if codec is not None:
+         if len(self.binaryStr) - pos < codec.size:
+            raise UnpackerError
+         self.pos = pos + codec.size
+         return codec.unpack_from(self.binaryStr, pos)[0]
+      elif varType == BINARY_CHUNK:
+         if len(self.binaryStr) - pos < sz:
+            raise UnpackerError
+         self.pos = pos + sz
+         return self.getChunk(pos, sz)
       elif varType == VAR_INT:
-         sizeCheck(1)
-         [value, nBytes] = unpackVarInt(self.binaryStr[pos:pos+9])
-         self.advance(nBytes)
+         if len(self.binaryStr) - pos < 1:
+            raise UnpackerError
+         value, nBytes = self.getVarIntAt(pos)
+         self.pos = pos + nBytes
          return value
       elif varType == VAR_STR:
-         sizeCheck(1)
-         [value, nBytes] = unpackVarInt(self.binaryStr[pos:pos+9])
-         binOut = self.binaryStr[pos+nBytes:pos+nBytes+value]
-         self.advance(nBytes+value)
-         return binOut
-      elif varType == FLOAT:
-         sizeCheck(4)
-         value = unpack(E+'f', self.binaryStr[pos:pos+4])[0]
-         self.advance(4)
-         return value
-      elif varType == BINARY_CHUNK:
-         sizeCheck(sz)
-         binOut = self.binaryStr[pos:pos+sz]
-         self.advance(sz)
-         return binOut
+         if len(self.binaryStr) - pos < 1:
+            raise UnpackerError
+         value, nBytes = self.getVarIntAt(pos)
+         if len(self.binaryStr) - pos - nBytes < value:
+            raise UnpackerError
+         self.pos = pos + nBytes + value
+         return self.getChunk(pos+nBytes, value)
 
       LOGERROR('Var Type not recognized!  VarType = %d', varType)
       raise UnpackerError, "Var type not recognized!  VarType="+str(varType)
 
-################################################################################
+   #############################################################################
+   def getMany(self, varTypes, endianness=LITTLEENDIAN):
+      """
+      Read a run of fixed-width fields in one unpack call, and return them 
+      as a tuple.  For instance a block header's leading fields:
+
+         >> version, prevHash = bup.getMany([UINT32, (BINARY_CHUNK, 32)])
+
+      varTypes is a list of fixed-width types, or (BINARY_CHUNK, sz) pairs.
+      The compiled layout is cached, so a layout that is read over and over
+      costs one dict lookup and one unpack_from per use.
+      """
+      codec = getLayoutStruct(varTypes, endianness)
+      if codec is None:
+         LOGERROR('getMany only handles fixed-width types: %s', str(varTypes))
+         raise UnpackerError, 'Not a fixed-width layout: ' + str(varTypes)
+
+      pos = self.pos
+      if len(self.binaryStr) - pos < codec.size:
+         raise UnpackerError
+      self.pos = pos + codec.size
+      return codec.unpack_from(self.binaryStr, pos)
+
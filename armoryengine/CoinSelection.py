@@ -385,6 +385,14 @@ def PySelectCoins_MultiInput_DoubleValue( \
 
 
 
+################################################################################
+def countTrailingZeros(btcVal):
+   for i in range(1,20):
+      if btcVal % 10**i != 0:
+         return i-1
+   return 0  # not sure how we'd get here, but let's be safe
+
+
 ################################################################################
 def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
    """
@@ -404,26 +412,51 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
           indirectly available with the current set of factors here
    """
 
-   # Need to calculate how much the change will be returned to sender on this tx
-   totalIn = sum([utxo.getValue() for utxo in utxoSelectList])
-   totalChange = totalIn - (targetOutVal+minFee)
-
    # Abort if this is an empty list (negative score) or not enough coins
-   if len(utxoSelectList)==0 or totalIn<targetOutVal+minFee:
+   if len(utxoSelectList)==0:
       return -1
 
-
    ##################
    # -- Does this selection include any zero-confirmation tx?
    # -- How many addresses are linked together by this tx?
+   totalIn = 0
+   sumPriority = 0
    addrSet = set()
    noZeroConf = 1
    for utxo in utxoSelectList:
-      
+      totalIn += utxo.getValue()
       addrSet.add(script_to_scrAddr(utxo.getScript()))
       if utxo.getNumConfirm() == 0:
          noZeroConf = 0
-   numAddr = len(addrSet)
+      else:
+         sumPriority += utxo.getValue() * utxo.getNumConfirm()
+
+   return computeSelectCoinsScores(totalIn, len(utxoSelectList), len(addrSet),
+                                   noZeroConf, sumPriority, targetOutVal, minFee)
+
+
+################################################################################
+def computeSelectCoinsScores(totalIn, numInputs, numAddr, noZeroConf,
+                             sumPriority, targetOutVal, minFee, numBytes=None):
+   """
+   The guts of getSelectCoinsScores(), operating only on aggregate values
+   of the selection instead of the UTXO list itself.  All the factors only
+   depend on the totals, the input count, the number of distinct addresses,
+   whether any input is zero-conf, and the sum of value*numConf -- so a
+   search that maintains those incrementally can score a candidate without
+   touching its inputs again.
+
+   numBytes may be supplied to use real input sizes; by default we use the
+   same 180-bytes-per-input estimate as before so scores stay comparable.
+   """
+
+   # Need to calculate how much the change will be returned to sender on this tx
+   totalChange = totalIn - (targetOutVal+minFee)
+
+   # Abort if this is an empty list (negative score) or not enough coins
+   if numInputs==0 or totalIn<targetOutVal+minFee:
+      return -1
+
    numAddrFactor = 4.0/(numAddr+1)**2  # values in the range (0, 1]
 
 
@@ -438,11 +471,6 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
    # If the diff is negative, the wrong answer starts to look like the
    # correct one (about which output is recipient and which is change)
    # We should give "extra credit" for those cases
-   def countTrailingZeros(btcVal):
-      for i in range(1,20):
-         if btcVal % 10**i != 0:
-            return i-1
-      return 0  # not sure how we'd get here, but let's be safe
    tgtTrailingZeros =  countTrailingZeros(targetOutVal)
    chgTrailingZeros =  countTrailingZeros(totalChange)
    zeroDiff = tgtTrailingZeros - chgTrailingZeros
@@ -485,9 +513,10 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
    ##################
    # Tx size:  we don't have signatures yet, but we assume that each txin is
    #           about 180 Bytes, TxOuts are 35, and 10 other bytes in the Tx
-   numBytes  =  10
-   numBytes += 180 * len(utxoSelectList)
-   numBytes +=  35 * (1 if totalChange==0 else 2)
+   if numBytes is None:
+      numBytes  =  10
+      numBytes += 180 * numInputs
+      numBytes +=  35 * (1 if totalChange==0 else 2)
    txSizeFactor = 0
    numKb = int(numBytes / 1000)
    # Will compute size factor after we see this tx priority and AllowFree
@@ -500,15 +529,7 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
    #            then we might be allowed a free tx.  But, if its priority
    #            isn't much above this thresh, it might take a couple blocks
    #            to be included
-   dPriority = 0
-   anyZeroConfirm = False
-   for utxo in utxoSelectList:
-      if utxo.getNumConfirm() == 0:
-         anyZeroConfirm = True
-      else:
-         dPriority += utxo.getValue() * utxo.getNumConfirm()
-
-   dPriority = dPriority / numBytes
+   dPriority = sumPriority / numBytes
    priorityThresh = ONE_BTC * 144 / 250
    if dPriority < priorityThresh:
       priorityFactor = 0
@@ -590,6 +611,15 @@ def PyEvalCoinSelect(utxoSelectList, targetOutVal, minFee, weights=WEIGHTS):
    "balanced", etc).
    """
    scores = getSelectCoinsScores(utxoSelectList, targetOutVal, minFee)
+   return weightSelectCoinsScores(scores, minFee, weights)
+
+
+################################################################################
+def weightSelectCoinsScores(scores, minFee, weights=WEIGHTS):
+   """
+   Apply the weightings to a tuple of sub-scores from getSelectCoinsScores()
+   or computeSelectCoinsScores().  Returns -1 for an invalid selection.
+   """
    if scores==-1:
       return -1
 
@@ -608,11 +638,36 @@ def PyEvalCoinSelect(utxoSelectList, targetOutVal, minFee, weights=WEIGHTS):
    return theScore
 
 
+################################################################################
+# Below this many UTXOs the exhaustive heuristic search is cheap enough (and
+# well-tested enough) that we keep using it by default
+COINSELECT_BNB_MIN_UTXOS = 100
+
+################################################################################
+@TimeThisFunction
+def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10,
+                                                   margin=CENT, useBnB=None):
+   """
+   Entry point for coin selection.  Small wallets go through the original
+   "run every heuristic and keep the best" algorithm.  Large wallets use the
+   branch-and-bound search, which scores candidates incrementally and stops
+   after a fixed time budget.  Pass useBnB=True/False to force either one.
+   """
+   if useBnB is None:
+      useBnB = len(unspentTxOutInfo) >= COINSELECT_BNB_MIN_UTXOS
+
+   if useBnB:
+      return PySelectCoinsBnB(unspentTxOutInfo, targetOutVal, minFee, margin)
+   else:
+      return PySelectCoinsLegacy(unspentTxOutInfo, targetOutVal, minFee,
+                                                         numRand, margin)
+
+
 ################################################################################
 # https://bitcointalk.org/index.php?topic=92496.msg1126310#msg1126310 contains a
 # description (possibly out-of-date?) of how this function works.
-@TimeThisFunction
-def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10, margin=CENT):
+def PySelectCoinsLegacy(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10,
+                                                                margin=CENT):
    """
    Intense algorithm for coin selection:  computes about 30 different ways to
    select coins based on the desired target output and the min tx fee.  Then
@@ -659,6 +714,15 @@ def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10, margin=C
    if len(finalSelection)==0:
       return []
 
+   return PySelectCoins_SweepSameAddr(finalSelection, unspentTxOutInfo, SCORES)
+
+
+################################################################################
+def PySelectCoins_SweepSameAddr(finalSelection, unspentTxOutInfo, scores):
+   """
+   Post-processing step shared by both selection engines.  Appends to (and
+   returns) finalSelection.
+   """
    # If we selected a list that has only one or two inputs, and we have
    # other, tiny, unspent outputs from the same addresses, we should
    # throw one or two of them in to help clear them out.  However, we
@@ -678,8 +742,8 @@ def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10, margin=C
    # anonymity: this extra output may cause a tx with good output anonymity
    # to no longer possess this property
    IDEAL_NUM_INPUTS = 5
-   if len(finalSelection) < IDEAL_NUM_INPUTS and \
-          SCORES[IDX_OUTANONYM] == 0:
+   if scores != -1 and len(finalSelection) < IDEAL_NUM_INPUTS and \
+          scores[IDX_OUTANONYM] == 0:
 
       utxoToScrAddr = lambda a: a.getRecipientScrAddr()
       getPriority   = lambda a: a.getValue() * a.getNumConfirm()
@@ -687,7 +751,6 @@ def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10, margin=C
 
       alreadyUsedAddr = set( [utxoToScrAddr(utxo) for utxo in finalSelection] )
       utxoSmallToLarge = sorted(unspentTxOutInfo, key=getPriority)
-      utxoSmToLgIDs = [getUtxoID(utxo) for utxo in utxoSmallToLarge]
       finalSelectIDs = [getUtxoID(utxo) for utxo in finalSelection]
       
       for other in utxoSmallToLarge:
@@ -713,6 +776,307 @@ def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10, margin=C
             break
    return finalSelection
 
+################################################################################
+class UtxoFeatures(object):
+   """
+   Everything the selection search needs to know about one UTXO, computed
+   once up front.  getSelectCoinsScores() re-derives the scrAddr from the
+   script on every call, which is what makes scoring hundreds of candidate
+   lists over a large wallet so slow.
+   """
+   def __init__(self, utxo, lboxList=None):
+      script = utxo.getScript()
+      self.utxo     = utxo
+      self.value    = utxo.getValue()
+      self.numConf  = utxo.getNumConfirm()
+      self.priority = self.value * self.numConf
+      self.scrAddr  = script_to_scrAddr(script)
+      self.txInSize = approxTxInSizeForTxOut(script, lboxList)
+
+
+################################################################################
+# Largest value computeSelectCoinsScores() can assign to outAnonFactor
+# (change with ~19 more trailing zeros than the target)
+MAX_OUTANON_FACTOR = 20
+
+################################################################################
+class SelectCoinsAccumulator(object):
+   """
+   Running aggregates of a partial selection.  These are exactly the inputs
+   to computeSelectCoinsScores(), so adding/removing one UTXO and rescoring
+   is O(1) instead of a pass over the whole selection.
+   """
+   def __init__(self):
+      self.totalIn     = 0
+      self.numInputs   = 0
+      self.numZeroConf = 0
+      self.sumPriority = 0
+      self.sizeIn      = 0
+      self.addrCounts  = {}
+
+   #############################################################################
+   def add(self, feat):
+      self.totalIn   += feat.value
+      self.numInputs += 1
+      self.sizeIn    += feat.txInSize
+      if feat.numConf == 0:
+         self.numZeroConf += 1
+      else:
+         self.sumPriority += feat.priority
+      self.addrCounts[feat.scrAddr] = self.addrCounts.get(feat.scrAddr, 0) + 1
+
+   #############################################################################
+   def remove(self, feat):
+      self.totalIn   -= feat.value
+      self.numInputs -= 1
+      self.sizeIn    -= feat.txInSize
+      if feat.numConf == 0:
+         self.numZeroConf -= 1
+      else:
+         self.sumPriority -= feat.priority
+      cnt = self.addrCounts[feat.scrAddr] - 1
+      if cnt == 0:
+         del self.addrCounts[feat.scrAddr]
+      else:
+         self.addrCounts[feat.scrAddr] = cnt
+
+   #############################################################################
+   def getScores(self, targetOutVal, minFee, exactSizes=False):
+      numBytes = None
+      if exactSizes:
+         totalChange = self.totalIn - (targetOutVal+minFee)
+         numBytes = 10 + self.sizeIn + 35 * (1 if totalChange==0 else 2)
+
+      return computeSelectCoinsScores(self.totalIn,
+                                      self.numInputs,
+                                      len(self.addrCounts),
+                                      1 if self.numZeroConf==0 else 0,
+                                      self.sumPriority,
+                                      targetOutVal,
+                                      minFee,
+                                      numBytes)
+
+   #############################################################################
+   def getScoreUpperBound(self, minFee, weights=WEIGHTS,
+                                    maxOutAnon=MAX_OUTANON_FACTOR):
+      """
+      Best weighted score any superset of this selection could reach.  Adding
+      inputs can never remove a zero-conf input or un-link an address, so
+      those two factors are capped by the current state; the others are
+      assumed to come out at their maximum (maxOutAnon can be tightened by
+      the caller if it knows how large the change could possibly get).
+      Only valid for non-negative weights.
+      """
+      numAddr = max(1, len(self.addrCounts))
+      bound  = weights[IDX_NOZEROCONF] * (1 if self.numZeroConf==0 else 0)
+      bound += weights[IDX_NUMADDR]    * 4.0/(numAddr+1)**2
+      bound += weights[IDX_PRIORITY]   * 1.0
+      bound += weights[IDX_TXSIZE]     * 1.0
+      bound += weights[IDX_OUTANONYM]  * maxOutAnon
+      if minFee < 0.0005:
+         bound += weights[IDX_ALLOWFREE]
+      return bound
+
+################################################################################
+# Per-address greedy seeds scored by PySelectCoinsBnB (for each of the two
+# orderings):  only the addresses that cover the target with fewest coins
+BNB_MAX_ADDR_SEEDS = 16
+
+################################################################################
+def PySelectCoinsBnB(unspentTxOutInfo, targetOutVal, minFee=0, margin=CENT,
+                     timeBudget=0.5, maxTries=200000, maxStall=20000,
+                     weights=WEIGHTS, lboxList=None, exactSizes=False):
+   """
+   Branch-and-bound coin selection, scored with the same sub-scores and
+   WEIGHTS as PySelectCoinsLegacy so the two are directly comparable.
+
+   UTXO features are computed once, and a depth-first include/exclude search
+   keeps running aggregates (SelectCoinsAccumulator) so each candidate is
+   scored in constant time.  A branch is cut when the remaining coins can't
+   reach the target, when it already reaches the target (more inputs only
+   add size and linked addresses), or when its score upper bound can't beat
+   the best found so far.  The search is seeded with a few cheap greedy
+   solutions and stops after maxTries nodes, maxStall nodes without an
+   improvement, or timeBudget seconds from the start of the call (seeding
+   included), returning the best selection seen.
+   """
+   deadline = RightNow() + timeBudget
+   feats = [UtxoFeatures(utxo, lboxList) for utxo in unspentTxOutInfo]
+   if sum([f.value for f in feats]) < targetOutVal:
+      return []
+
+   target = targetOutVal + minFee
+   canBound = min(weights) >= 0
+
+   # Confirmed coins first, largest first -- zero-conf only as a last resort
+   feats.sort(key=lambda f: (f.numConf==0, -f.value))
+   nFeat = len(feats)
+
+   # suffixSum[i] is how much value is still available from feats[i:]
+   suffixSum = [0]*(nFeat+1)
+   for i in range(nFeat-1, -1, -1):
+      suffixSum[i] = suffixSum[i+1] + feats[i].value
+
+   # After excluding feats[i], skip over identical coins:  including any of
+   # them instead would produce an identically-scored selection
+   nextDistinct = [nFeat]*(nFeat+1)
+   for i in range(nFeat-2, -1, -1):
+      a,b = feats[i], feats[i+1]
+      if (a.value, a.numConf, a.scrAddr) == (b.value, b.numConf, b.scrAddr):
+         nextDistinct[i] = nextDistinct[i+1]
+      else:
+         nextDistinct[i] = i+1
+
+   def evalIndices(idxList):
+      acc = SelectCoinsAccumulator()
+      for i in idxList:
+         acc.add(feats[i])
+      return weightSelectCoinsScores(acc.getScores(targetOutVal, minFee,
+                                                   exactSizes), minFee, weights)
+
+   ##################
+   # Seeds:  the smallest single coin covering target (and target+margin),
+   # plus greedy fills -- overall and within each address -- taking coins
+   # largest-value-first and highest-priority-first
+   def greedyFill(idxList):
+      fill,total = [],0
+      for i in idxList:
+         fill.append(i)
+         total += feats[i].value
+         if total >= target:
+            break
+      return fill
+
+   # Smallest single coin covering target (and target+margin).  feats is
+   # sorted largest-first within confirmed and then within zero-conf coins,
+   # so that's the last covering coin of the first group that has one
+   seeds = []
+   for tgt in [target, target+margin]:
+      best = None
+      for i in xrange(nFeat):
+         if best is not None and (feats[i].value < tgt or
+                        (feats[i].numConf==0) != (feats[best].numConf==0)):
+            break
+         if feats[i].value >= tgt:
+            best = i
+      if best is not None:
+         seeds.append([best])
+
+   byValue = range(nFeat)
+   byPriority = sorted(byValue, key=lambda i: -feats[i].priority)
+   greedy = greedyFill(byValue)
+   seeds.append(greedy)
+   seeds.append(greedyFill(byPriority))
+
+   # Scoring a seed costs as much as the seed is long, so with thousands
+   # of addresses that can each cover the target, only score the ones that
+   # need the fewest coins (and, among those, give the least change).
+   # Group once; only the addresses that can cover the target get filled
+   byAddr,addrTotal = {},{}
+   for i in byValue:
+      a = feats[i].scrAddr
+      byAddr.setdefault(a, []).append(i)
+      addrTotal[a] = addrTotal.get(a, 0) + feats[i].value
+   coverLists = [byAddr[a] for a in addrTotal if addrTotal[a] >= target]
+   priorityRank = [0]*nFeat
+   for rank,i in enumerate(byPriority):
+      priorityRank[i] = rank
+   firstByValue = lambda idxList: idxList[0]
+   firstByPriority = lambda idxList: min(idxList, key=priorityRank.__getitem__)
+   for firstOf in [firstByValue, firstByPriority]:
+      # If enough addresses cover the target with their first coin alone,
+      # those are the ones that need the fewest coins
+      ones = [firstOf(idxList) for idxList in coverLists]
+      ones = [i for i in ones if feats[i].value >= target]
+      if len(ones) >= BNB_MAX_ADDR_SEEDS:
+         ones.sort(key=lambda i: feats[i].value)
+         seeds.extend([[i] for i in ones[:BNB_MAX_ADDR_SEEDS]])
+         continue
+
+      addrSeeds = []
+      for idxList in coverLists:
+         if firstOf is firstByPriority:
+            idxList = sorted(idxList, key=priorityRank.__getitem__)
+         fill = greedyFill(idxList)
+         addrSeeds.append((len(fill), sum([feats[i].value for i in fill]),
+                           fill))
+      addrSeeds.sort(key=lambda s: s[:2])
+      seeds.extend([fill for n,val,fill in addrSeeds[:BNB_MAX_ADDR_SEEDS]])
+
+   bestScore,bestSelect = -1,[]
+   for seed in seeds:
+      score = evalIndices(seed)
+      if score > bestScore:
+         bestScore,bestSelect = score,seed
+      if RightNow() > deadline:
+         break
+
+   # The change can't have more trailing zeros than it has digits
+   maxChange = sum([f.value for f in feats]) - target
+   maxOutAnon = MAX_OUTANON_FACTOR
+   if maxChange > 0:
+      maxOutAnon = max(1, int(math.log10(maxChange)) + 1 - \
+                                       countTrailingZeros(targetOutVal))
+
+   ##################
+   # Depth-first search, iterative so large wallets don't hit the recursion
+   # limit.  selected is the include-stack; i is the next coin to decide on.
+   lastImproved = 0
+   acc = SelectCoinsAccumulator()
+   selected = []
+   i = 0
+   tries = 0
+   while tries < maxTries:
+      tries += 1
+      if tries % 1000 == 0 and RightNow() > deadline:
+         break
+      if tries - lastImproved > maxStall:
+         break
+
+      backtrack = False
+      if acc.totalIn + suffixSum[i] < target:
+         backtrack = True
+      elif acc.totalIn >= target:
+         score = weightSelectCoinsScores(acc.getScores(targetOutVal, minFee,
+                                                 exactSizes), minFee, weights)
+         if score > bestScore:
+            bestScore,bestSelect = score,selected[:]
+            lastImproved = tries
+         backtrack = True
+      elif canBound and \
+           acc.getScoreUpperBound(minFee, weights, maxOutAnon) <= bestScore:
+         backtrack = True
+
+      if not backtrack:
+         acc.add(feats[i])
+         selected.append(i)
+         i += 1
+         continue
+
+      if len(selected)==0:
+         break
+      j = selected.pop()
+      acc.remove(feats[j])
+      i = nextDistinct[j]
+
+   LOGDEBUG('BnB coin selection: %d utxos, %d nodes, score %s',
+                                             nFeat, tries, str(bestScore))
+
+   if bestScore == -1:
+      # Nothing covers target+fee:  hand back the largest-first fill so the
+      # caller sees the shortfall, same as the legacy path would
+      return [feats[i].utxo for i in greedy]
+
+   finalSelection = [feats[i].utxo for i in bestSelect]
+   scores = getSelectCoinsScores(finalSelection, targetOutVal, minFee)
+
+   # The sweep only ever adds coins from addresses already selected, so
+   # don't make it sort the whole wallet
+   usedAddrs = set([utxo.getRecipientScrAddr() for utxo in finalSelection])
+   sweepList = [utxo for utxo in unspentTxOutInfo \
+                              if utxo.getRecipientScrAddr() in usedAddrs]
+   return PySelectCoins_SweepSameAddr(finalSelection, sweepList, scores)
+
 ################################################################################
 def calcMinSuggestedFeesHackMS(selectCoinsResult, targetOutVal, preSelectedFee, 
                                                          numRecipients):
@@ -21,6 +21,7 @@
 
 import os.path
 import random
+from struct import Struct
 
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
@@ -29,7 +30,7 @@ from armoryengine.ArmoryUtils import LOGINFO, RightNow, getVersionString, \
    BTCARMORY_VERSION, NetworkIDError, LOGERROR, BLOCKCHAINS, CLI_OPTIONS, LOGDEBUG, \
    binary_to_hex, BIGENDIAN, LOGRAWDATA, ARMORY_HOME_DIR, ConnectionError, \
    MAGIC_BYTES, hash256, verifyChecksum, NETWORKENDIAN, int_to_bitset, \
-   bitset_to_int, unixTimeToFormatStr
+   bitset_to_int, unixTimeToFormatStr, LOGEXCEPT, LRUCache
 from armoryengine.BDM import TheBDM
 from armoryengine.BinaryPacker import BinaryPacker, BINARY_CHUNK, UINT32, UINT64, \
    UINT16, VAR_INT, INT32, INT64, VAR_STR, INT8
@@ -48,7 +49,8 @@ class ArmoryClient(Protocol):
 
    ############################################################
    def __init__(self):
-      self.recvData = ''
+      self.recvData = MessageFrameDecoder(knownCmds=PayloadMap)
+      self.recentInv = LRUCache(RECENT_INV_CACHE_SIZE)
       self.gotVerack = False
       self.sentVerack = False
       self.sentHeadersReq = True
@@ -87,84 +89,79 @@ class ArmoryClient(Protocol):
       """
       Called by the reactor when data is received over the connection. 
       This method will do nothing if we don't receive a full message.
+
+      The frame decoder only looks at each byte a constant number of 
+      times:  it waits for a complete frame, verifies the checksum once, 
+      and each payload is unserialized exactly once.
       """
 
       
       #print '\n\nData Received:',
       #pprintHex(binary_to_hex(data), withAddr=False)
 
-      # Put the current buffer into an unpacker, process until empty
-      self.recvData += data
-      buf = BinaryUnpacker(self.recvData)
+      self.recvData.feed(data)
 
-      messages = []
       while True:
          try:
-            # recvData is only modified if the unserialize succeeds
-            # Had a serious issue with references, so I had to convert 
-            # messages to strings to guarantee that copies were being 
-            # made!  (yes, hacky...)
-            thisMsg = PyMessage().unserialize(buf)
-            messages.append( thisMsg.serialize() )
-            self.recvData = buf.getRemainingString()
+            frame = self.recvData.nextFrame()
          except NetworkIDError:
             LOGERROR('Message for a different network!' )
-            if BLOCKCHAINS.has_key(self.recvData[:4]):
-               LOGERROR( '(for network: %s)', BLOCKCHAINS[self.recvData[:4]])
-            # Before raising the error, we should've finished reading the msg
-            # So pop it off the front of the buffer
-            self.recvData = buf.getRemainingString()
+            LOGERROR('(for network: %s)', BLOCKCHAINS.get(self.recvData.lastMagic, 
+                                         binary_to_hex(self.recvData.lastMagic)))
+            continue
+         except ConnectionError:
+            LOGEXCEPT('Unrecoverable stream from peer, disconnecting')
+            self.transport.loseConnection()
             return
-         except UnpackerError:
-            # Expect this error when buffer isn't full enough for a whole msg
-            break
 
-      # We might've gotten here without anything to process -- if so, bail
-      if len(messages)==0:
-         return
+         if frame is None:
+            break
 
+         magic, cmd, payload = frame
+         msg = PyMessage().unserializeFrame(magic, cmd, payload)
+         self.dispatchMessage(msg)
 
-      # Finally, we have some message to process, let's do it
-      for msgStr in messages:
-         msg = PyMessage().unserialize(msgStr)
-         cmd = msg.cmd
 
-         # Log the message if netlog option
-         if CLI_OPTIONS.netlog:
-            LOGDEBUG( 'DataReceived: %s', msg.payload.command)
-            if msg.payload.command == 'tx':
-               LOGDEBUG('\t' + binary_to_hex(msg.payload.tx.thisHash))
-            elif msg.payload.command == 'block':
-               LOGDEBUG('\t' + msg.payload.header.getHashHex())
-            elif msg.payload.command == 'inv':
-               for inv in msg.payload.invList:
-                  LOGDEBUG(('\tBLOCK: ' if inv[0]==2 else '\tTX   : ') + \
-                                                      binary_to_hex(inv[1]))
-
-
-         # We process version and verackk only if we haven't yet
-         if cmd=='version' and not self.sentVerack:
-            self.peerInfo = {}
-            self.peerInfo['version'] = msg.payload.version
-            self.peerInfo['subver']  = msg.payload.subver
-            self.peerInfo['time']    = msg.payload.time
-            self.peerInfo['height']  = msg.payload.height0
-            LOGINFO('Received version message from peer:')
-            LOGINFO('   Version:     %s', str(self.peerInfo['version']))
-            LOGINFO('   SubVersion:  %s', str(self.peerInfo['subver']))
-            LOGINFO('   TimeStamp:   %s', str(self.peerInfo['time']))
-            LOGINFO('   StartHeight: %s', str(self.peerInfo['height']))
-            self.sentVerack = True
-            self.sendMessage( PayloadVerack() )
-         elif cmd=='verack':
-            self.gotVerack = True
-            self.factory.handshakeFinished(self)
-            #self.startHeaderDL()
-
-         ####################################################################
-         # Don't process any other messages unless the handshake is finished
-         if self.gotVerack and self.sentVerack:
-            self.processMessage(msg)
+   ############################################################
+   def dispatchMessage(self, msg):
+      cmd = msg.cmd
+
+      # Log the message if netlog option
+      if CLI_OPTIONS.netlog:
+         LOGDEBUG( 'DataReceived: %s', msg.payload.command)
+         if msg.payload.command == 'tx':
+            LOGDEBUG('\t' + binary_to_hex(msg.payload.getHash()))
+         elif msg.payload.command == 'block':
+            LOGDEBUG('\t' + binary_to_hex(msg.payload.getHash()))
+         elif msg.payload.command == 'inv':
+            for inv in msg.payload.invList:
+               LOGDEBUG(('\tBLOCK: ' if inv[0]==2 else '\tTX   : ') + \
+                                                   binary_to_hex(inv[1]))
+
+
+      # We process version and verackk only if we haven't yet
+      if cmd=='version' and not self.sentVerack:
+         self.peerInfo = {}
+         self.peerInfo['version'] = msg.payload.version
+         self.peerInfo['subver']  = msg.payload.subver
+         self.peerInfo['time']    = msg.payload.time
+         self.peerInfo['height']  = msg.payload.height0
+         LOGINFO('Received version message from peer:')
+         LOGINFO('   Version:     %s', str(self.peerInfo['version']))
+         LOGINFO('   SubVersion:  %s', str(self.peerInfo['subver']))
+         LOGINFO('   TimeStamp:   %s', str(self.peerInfo['time']))
+         LOGINFO('   StartHeight: %s', str(self.peerInfo['height']))
+         self.sentVerack = True
+         self.sendMessage( PayloadVerack() )
+      elif cmd=='verack':
+         self.gotVerack = True
+         self.factory.handshakeFinished(self)
+         #self.startHeaderDL()
+
+      ####################################################################
+      # Don't process any other messages unless the handshake is finished
+      if self.gotVerack and self.sentVerack:
+         self.processMessage(msg)
 
 
    ############################################################
@@ -182,25 +179,25 @@ class ArmoryClient(Protocol):
       #        application.  For now, it's pretty static.
       #msg.payload.pprint(nIndent=2)
       if msg.cmd=='inv':
-         invobj = msg.payload
-         getdataMsg = PyMessage('getdata')
-         for inv in invobj.invList:
-            if inv[0]==MSG_INV_BLOCK:
-               if self.factory.bdm and (self.factory.bdm.getBDMState()=='Scanning' or \
-                  self.factory.bdm.hasHeaderWithHash(inv[1])):
-                  continue
-               getdataMsg.payload.invList.append(inv)
-            if inv[0]==MSG_INV_TX:
-               if self.factory.bdm and (self.factory.bdm.getBDMState()=='Scanning' or \
-                  self.factory.bdm.hasTxWithHash(inv[1])):
-                  continue
-               getdataMsg.payload.invList.append(inv)
-
-         # Now send the full request
-         if self.factory.bdm and not self.factory.bdm.getBDMState()=='Scanning':
-            self.sendMessage(getdataMsg)
+         # Anything we requested or received recently is dropped right here;
+         # the rest goes to the BDM in a single batched lookup
+         bdm = self.factory.bdm
+         if bdm and not bdm.getBDMState()=='Scanning':
+            newInv = [inv for inv in msg.payload.invList \
+                         if inv[0] in (MSG_INV_BLOCK, MSG_INV_TX) and \
+                            not inv[1] in self.recentInv]
+            newInv = bdm.filterUnknownInventory(newInv)
+
+            # Now send the full request
+            if len(newInv) > 0:
+               for inv in newInv:
+                  self.recentInv.put(inv[1])
+               getdataMsg = PyMessage('getdata')
+               getdataMsg.payload.invList = newInv
+               self.sendMessage(getdataMsg)
 
       if msg.cmd=='tx':
+         self.recentInv.put(msg.payload.getHash())
          pytx = msg.payload.tx
          self.factory.func_newTx(pytx)
       elif msg.cmd=='inv':
@@ -208,8 +205,8 @@ class ArmoryClient(Protocol):
          self.factory.func_inv(invList)
       elif msg.cmd=='block':
          pyHeader = msg.payload.header
-         pyTxList = msg.payload.txList
-         LOGINFO('Received new block.  %s', binary_to_hex(pyHeader.getHash(), BIGENDIAN))
+         pyTxList = msg.payload.lazyTxList()
+         LOGINFO('Received new block.  %s', binary_to_hex(msg.payload.getHash(), BIGENDIAN))
          self.factory.func_newBlock(pyHeader, pyTxList)
 
                   
@@ -421,6 +418,14 @@ MSG_INV_ERROR = 0
 MSG_INV_TX    = 1
 MSG_INV_BLOCK = 2
 
+BLOCK_HEADER_SIZE = 80
+
+# How many inv hashes each connection remembers having requested/received
+RECENT_INV_CACHE_SIZE = 50000
+
+# Same limit the Satoshi client uses (MAX_SIZE) for a single message
+MAX_MESSAGE_PAYLOAD = 0x02000000
+
 
 ################################################################################
 class PyMessage(object):
@@ -474,6 +479,17 @@ class PyMessage(object):
       return self
 
 
+   def unserializeFrame(self, magic, cmd, payload):
+      """
+      Build the message from a frame that MessageFrameDecoder has already
+      split and checksummed, without going through unserialize() again
+      """
+      self.magic   = magic
+      self.cmd     = cmd
+      self.payload = PayloadMap[self.cmd]().unserialize(payload)
+      return self
+
+
    def pprint(self, nIndent=0):
       indstr = indent*nIndent
       print ''
@@ -484,6 +500,90 @@ class PyMessage(object):
       self.payload.pprint(nIndent+1)
 
 
+################################################################################
+class MessageFrameDecoder(object):
+   """
+   Incremental framing for the Bitcoin wire protocol.  Received chunks are
+   appended to one bytearray;  nextFrame() parses the 24-byte header in 
+   place, and only once the whole payload has arrived does it copy that 
+   payload out (exactly once) and check its checksum.  Consumed bytes are
+   dropped from the front of the buffer once they make up more than half 
+   of it, so the cost per byte is constant and the buffer never holds more
+   than about twice the largest message.
+
+      >> decoder.feed(data)
+      >> frame = decoder.nextFrame()   # (magic, cmd, payload) or None
+   """
+   HEADER = Struct('<4s12sI4s')
+
+   def __init__(self, maxPayload=MAX_MESSAGE_PAYLOAD, knownCmds=None):
+      self.buf        = bytearray()
+      self.start      = 0
+      self.maxPayload = maxPayload
+      self.knownCmds  = knownCmds
+      self.lastMagic  = ''
+
+   def feed(self, data):
+      self.buf.extend(data)
+
+   def getBufferedSize(self):
+      return len(self.buf) - self.start
+
+   def nextFrame(self):
+      """
+      Returns (magic, cmd, payload) for the next complete message, or None 
+      if we're still waiting for more bytes.  A message for another network
+      is consumed and reported with NetworkIDError;  a message with a bad
+      checksum, or a command not in knownCmds, is consumed and skipped.  A length field over maxPayload 
+      means we can't find the next frame boundary, so ConnectionError is 
+      raised and the caller should drop the connection.
+      """
+      while True:
+         avail = len(self.buf) - self.start
+         if avail < self.HEADER.size:
+            self.compact()
+            return None
+
+         magic,cmd,length,chksum = self.HEADER.unpack_from(self.buf, self.start)
+         if length > self.maxPayload:
+            raise ConnectionError, 'Message payload too large: %d bytes' % length
+
+         frameSize = self.HEADER.size + length
+         if avail < frameSize:
+            self.compact()
+            return None
+
+         cmd = cmd.strip('\x00')
+         if magic == MAGIC_BYTES and self.knownCmds is not None and \
+                                    not cmd in self.knownCmds:
+            # Nothing we'd do with it:  skip without copying or hashing
+            LOGDEBUG('Skipping unknown "%s" message (%d bytes)', cmd, length)
+            self.start += frameSize
+            continue
+
+         pstart  = self.start + self.HEADER.size
+         payload = memoryview(self.buf)[pstart:pstart+length].tobytes()
+         self.start += frameSize
+
+         if magic != MAGIC_BYTES:
+            self.lastMagic = magic
+            raise NetworkIDError, 'Message has wrong network bytes!'
+
+         if not hash256(payload)[:4] == chksum:
+            LOGERROR('Checksum mismatch on "%s" message, skipping it', cmd)
+            continue
+
+         return (magic, cmd, payload)
+
+   def compact(self):
+      # Only shift the buffer when the consumed prefix dominates, so each
+      # byte is moved at most a constant number of times
+      if self.start > 0 and self.start*2 >= len(self.buf):
+         del self.buf[:self.start]
+         self.start = 0
+
+
+
 ################################################################################
 class PyNetAddress(object):
 
@@ -872,17 +972,46 @@ class PayloadGetBlocks(object):
 ################################################################################
 ################################################################################
 class PayloadTx(object):
+   """
+   Unserializing from a string only keeps the raw bytes.  The PyTx (with 
+   all its PyTxIns and PyTxOuts) is built the first time .tx is accessed,
+   and getHash() works straight off the raw bytes without building it.
+   """
    command = 'tx'
 
-   def __init__(self, tx=PyTx()):
-      self.tx = tx
+   def __init__(self, tx=None):
+      self.rawTx    = None
+      self.parsedTx = tx if tx is not None else PyTx()
 
    def unserialize(self, toUnpack):
-      self.tx.unserialize(toUnpack)
+      if isinstance(toUnpack, BinaryUnpacker):
+         self.parsedTx = PyTx().unserialize(toUnpack)
+         self.rawTx    = None
+      else:
+         self.parsedTx = None
+         self.rawTx    = toUnpack
       return self
 
+   def getTx(self):
+      if self.parsedTx is None:
+         self.parsedTx = PyTx().unserialize(self.rawTx)
+      return self.parsedTx
+
+   def setTx(self, tx):
+      self.parsedTx = tx
+      self.rawTx    = None
+
+   tx = property(getTx, setTx)
+
+   def getHash(self):
+      if self.parsedTx is None:
+         return hash256(self.rawTx)
+      return self.parsedTx.getHash()
+
    def serialize(self):
-      return self.tx.serialize()
+      if self.parsedTx is None:
+         return self.rawTx
+      return self.parsedTx.serialize()
 
    def pprint(self, nIndent=0):
       indstr = indent*nIndent
@@ -936,27 +1065,74 @@ class PayloadHeaders(object):
 ################################################################################
 ################################################################################
 class PayloadBlock(object):
+   """
+   Like PayloadTx, unserializing from a string just keeps the raw block.
+   The header is parsed from the first 80 bytes when it's first needed, and
+   the transactions only when txList is first accessed.  Use lazyTxList()
+   to hand the list to a callback without parsing it up front.
+   """
    command = 'block'
 
-   def __init__(self, header=PyBlockHeader(), txlist=[]):
-      self.header = header
-      self.txList = txlist
+   def __init__(self, header=None, txlist=None):
+      self.rawBlock     = None
+      self.parsedHeader = header if header is not None else PyBlockHeader()
+      self.parsedTxList = txlist if txlist is not None else []
    
 
    def unserialize(self, toUnpack):
       if isinstance(toUnpack, BinaryUnpacker):
-         blkData = toUnpack
+         self.rawBlock     = None
+         self.parsedHeader = PyBlockHeader().unserialize(toUnpack)
+         self.parsedTxList = []
+         numTx = toUnpack.get(VAR_INT)
+         for i in range(numTx):
+            self.parsedTxList.append(PyTx().unserialize(toUnpack))
       else:
-         blkData = BinaryUnpacker( toUnpack )
-
-      self.txList = []
-      self.header.unserialize(blkData)
-      numTx = blkData.get(VAR_INT)
-      for i in range(numTx):
-         self.txList.append(PyTx().unserialize(blkData))
+         self.rawBlock     = toUnpack
+         self.parsedHeader = None
+         self.parsedTxList = None
       return self
 
+   def getHeader(self):
+      if self.parsedHeader is None:
+         self.parsedHeader = PyBlockHeader().unserialize(self.rawBlock[:BLOCK_HEADER_SIZE])
+      return self.parsedHeader
+
+   def setHeader(self, header):
+      self.getTxList()
+      self.parsedHeader = header
+      self.rawBlock     = None
+
+   header = property(getHeader, setHeader)
+
+   def getTxList(self):
+      if self.parsedTxList is None:
+         blkData = BinaryUnpacker(self.rawBlock)
+         blkData.advance(BLOCK_HEADER_SIZE)
+         numTx = blkData.get(VAR_INT)
+         self.parsedTxList = [PyTx().unserialize(blkData) for i in range(numTx)]
+      return self.parsedTxList
+
+   def setTxList(self, txList):
+      self.getHeader()
+      self.parsedTxList = txList
+      self.rawBlock     = None
+
+   txList = property(getTxList, setTxList)
+
+   def lazyTxList(self):
+      if self.parsedTxList is None:
+         return LazyTxList(self)
+      return self.parsedTxList
+
+   def getHash(self):
+      if self.parsedHeader is None:
+         return hash256(self.rawBlock[:BLOCK_HEADER_SIZE])
+      return self.parsedHeader.getHash()
+
    def serialize(self):
+      if self.rawBlock is not None:
+         return self.rawBlock
       bp = BinaryPacker()
       bp.put(BINARY_CHUNK, self.header.serialize())
       bp.put(VAR_INT, len(self.txList))
@@ -973,6 +1149,25 @@ class PayloadBlock(object):
          print indstr + indent + 'Tx:', tx.getHashHex()
 
 
+################################################################################
+class LazyTxList(object):
+   """
+   Read-only stand-in for a block's tx list:  the block's transactions are
+   only parsed if the list is actually used
+   """
+   def __init__(self, payloadBlock):
+      self.payloadBlock = payloadBlock
+
+   def __len__(self):
+      return len(self.payloadBlock.txList)
+
+   def __iter__(self):
+      return iter(self.payloadBlock.txList)
+
+   def __getitem__(self, i):
+      return self.payloadBlock.txList[i]
+
+
 ################################################################################
 class PayloadAlert(object):
    command = 'alert'
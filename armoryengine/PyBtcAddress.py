@@ -939,7 +939,7 @@ class PyBtcAddress(object):
       # able to determine where each field is, and will never corrupt the
       # whole wallet so badly we have to go hex-diving to figure out what
       # happened.
-      binOut = BinaryPacker()
+      binOut = BinaryPacker(sizeHint=237)
       binOut.put(BINARY_CHUNK,   self.addrStr20,                    width=20)
       binOut.put(BINARY_CHUNK,   chk(self.addrStr20),               width= 4)
       binOut.put(UINT32,         getVersionInt(PYBTCWALLET_VERSION))
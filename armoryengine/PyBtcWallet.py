@@ -5,8 +5,11 @@
 # See LICENSE or http://www.gnu.org/licenses/agpl.html                         #
 #                                                                              #
 ################################################################################
+import mmap
 import os.path
 import shutil
+from struct import Struct
+from UserDict import DictMixin
 
 from CppBlockUtils import SecureBinaryData, KdfRomix, CryptoAES, CryptoECDSA
 import CppBlockUtils as Cpp
@@ -32,6 +35,9 @@ WLT_DATATYPE_TXCOMMENT   = 2
 WLT_DATATYPE_OPEVAL      = 3
 WLT_DATATYPE_DELETED     = 4
 
+# Group-commit journal written by commitBatchUpdate()
+WLT_JOURNAL_MAGIC = '\xbaWLTJRNL'
+
 DEFAULT_COMPUTE_TIME_TARGET = 0.25
 DEFAULT_MAXMEM_LIMIT        = 32*1024*1024
 
@@ -40,8 +46,118 @@ PYROOTPKCCVERMASK = 0x7F
 PYROOTPKCCSIGNMASK = 0x80
 
 
+# Fields we pick straight out of the raw PyBtcAddress serialization when
+# indexing a wallet file, so we don't have to unserialize every address.
+# See PyBtcAddress.serialize() for the layout
+ADDRDATA_CHAININDEX_OFFSET = 72
+ADDRDATA_CHAININDEX        = Struct('<q')
+ADDRDATA_RANGES_OFFSET     = 213
+ADDRDATA_RANGES            = Struct('<QQII')
+SCRADDR_BULK_RANGES        = Struct('<IIII')
+
 def buildWltFileName(uniqueIDB58):
    return 'armory_%s_.wallet' % uniqueIDB58
+
+
+################################################################################
+class LazyAddressMap(DictMixin):
+   """
+   Drop-in replacement for the addr160->PyBtcAddress dict that only
+   unserializes an address the first time somebody looks it up.
+
+   readWalletFile() indexes every key-data entry by its offset in the
+   wallet file; the raw bytes stay on disk until needed.  The file is only
+   open while an entry is being read, never in between:  the wallet rewrites
+   it in place, and on Windows it couldn't be renamed or deleted (removing
+   a wallet, converting it to watching-only) while we held it open.
+   Anything put in with __setitem__ (newly generated/imported addresses) is
+   just stored as-is.
+   """
+   def __init__(self, wltPath, addrSize, decodeFunc):
+      self.wltPath    = wltPath
+      self.addrSize   = addrSize
+      self.decodeFunc = decodeFunc  # (addr160, rawData, byteLoc) -> PyBtcAddress
+      self.decoded    = {}
+      self.offsets    = {}
+
+   #############################################################################
+   def addOffset(self, addr160, byteLoc):
+      self.decoded.pop(addr160, None)
+      self.offsets[addr160] = byteLoc
+
+   #############################################################################
+   def getNumDecoded(self):
+      return len(self.decoded)
+
+   #############################################################################
+   def getDecodedValues(self):
+      return self.decoded.values()
+
+   #############################################################################
+   def readRawData(self, byteLocList):
+      wltFile = open(self.wltPath, 'rb')
+      try:
+         rawList = []
+         for byteLoc in byteLocList:
+            wltFile.seek(byteLoc)
+            rawList.append(wltFile.read(self.addrSize))
+         return rawList
+      finally:
+         wltFile.close()
+
+   #############################################################################
+   def decodeList(self, addr160List):
+      # The file is closed again before decodeFunc runs:  it may have to
+      # rewrite an entry with byte errors
+      addr160List = [a160 for a160 in addr160List if a160 in self.offsets]
+      rawList = self.readRawData([self.offsets[a160] for a160 in addr160List])
+      for addr160,rawData in zip(addr160List, rawList):
+         byteLoc = self.offsets.pop(addr160)
+         self.decoded[addr160] = self.decodeFunc(addr160, rawData, byteLoc)
+
+   #############################################################################
+   def __getitem__(self, addr160):
+      addr = self.decoded.get(addr160)
+      if addr is None:
+         if not addr160 in self.offsets:
+            raise KeyError(addr160)
+         self.decodeList([addr160])
+         addr = self.decoded[addr160]
+      return addr
+
+   #############################################################################
+   def __setitem__(self, addr160, addr):
+      self.offsets.pop(addr160, None)
+      self.decoded[addr160] = addr
+
+   #############################################################################
+   def __delitem__(self, addr160):
+      if addr160 in self.decoded:
+         del self.decoded[addr160]
+      else:
+         del self.offsets[addr160]
+
+   #############################################################################
+   def __contains__(self, addr160):
+      return addr160 in self.decoded or addr160 in self.offsets
+
+   def has_key(self, addr160):
+      return addr160 in self
+
+   def __len__(self):
+      return len(self.decoded) + len(self.offsets)
+
+   def keys(self):
+      return self.decoded.keys() + self.offsets.keys()
+
+   def __iter__(self):
+      return iter(self.keys())
+
+   def iteritems(self):
+      # Everything gets decoded anyway, so read it all with one open()
+      self.decodeList(self.offsets.keys())
+      for addr160 in self.keys():
+         yield addr160, self[addr160]
    
 class PyBtcWallet(object):
    """
@@ -235,6 +351,13 @@ class PyBtcWallet(object):
       self.interruptTest1  = False
       self.interruptTest2  = False
       self.interruptTest3  = False
+      self.interruptTestJournal = False
+
+      # Pending group-commit data, see beginBatchUpdate()
+      self.batchUpdateDepth = 0
+      self.batchBaseSize    = 0
+      self.batchAppend      = None
+      self.batchModify      = []
       
       #flags the wallet if it has off chain imports (from a consistency repair)
       self.hasNegativeImports = False
@@ -1062,6 +1185,7 @@ class PyBtcWallet(object):
          [[WLT_UPDATE_ADD, WLT_DATATYPE_KEYDATA, new160, newAddr]])
       self.addrMap[new160] = newAddr
       self.addrMap[new160].walletByteLoc = newDataLoc[0] + 21
+      TheScrAddrIndex.addWalletScrAddr(self, Hash160ToScrAddr(new160))
 
       if newAddr.chainIndex > self.lastComputedChainIndex:
          self.lastComputedChainAddr160 = new160
@@ -1104,11 +1228,20 @@ class PyBtcWallet(object):
 
       gap = self.lastComputedChainIndex - self.highestUsedChainIndex
       numToCreate = max(numPool - gap, 0)
-      for i in range(numToCreate):
-         Progress(i+1, numToCreate)
-         self.computeNextAddress(isActuallyNew=isActuallyNew, 
-                                 doRegister=doRegister)            
-         #dlgPrg.UpdateHBar(i+1)
+      if numToCreate == 0:
+         return self.lastComputedChainIndex
+
+      # One journal write for the whole pool instead of a full safe-update
+      # cycle per address
+      self.beginBatchUpdate()
+      try:
+         for i in range(numToCreate):
+            Progress(i+1, numToCreate)
+            self.computeNextAddress(isActuallyNew=isActuallyNew, 
+                                    doRegister=doRegister)            
+            #dlgPrg.UpdateHBar(i+1)
+      finally:
+         self.commitBatchUpdate()
             
       return self.lastComputedChainIndex
 
@@ -1230,24 +1363,34 @@ class PyBtcWallet(object):
 
    #############################################################################
    def writeFreshWalletFile(self, path, newName='', newDescr=''):
-      newFile = open(path, 'wb')
-      bp = BinaryPacker()
+      # Everything is packed into one buffer and written at once.  Each
+      # address entry is a 1-byte type, 20-byte addr160 and 237-byte keydata
+      sizeHint = 2048 + 258*len(self.addrMap) + \
+                 sum([35+len(c) for c in self.commentsMap.itervalues()])
+      bp = BinaryPacker(sizeHint=sizeHint)
       self.packHeader(bp)
-      newFile.write(bp.getBinaryString())
 
       for addr160,addrObj in self.addrMap.iteritems():
          if not addr160=='ROOT':
-            newFile.write('\x00' + addr160 + addrObj.serialize())
+            bp.put(UINT8, WLT_DATATYPE_KEYDATA)
+            bp.put(BINARY_CHUNK, addr160)
+            bp.put(BINARY_CHUNK, addrObj.serialize())
 
       for hashVal,comment in self.commentsMap.iteritems():
-         twoByteLength = int_to_binary(len(comment), widthBytes=2)
          if len(hashVal)==20:
-            typestr = int_to_binary(WLT_DATATYPE_ADDRCOMMENT)
-            newFile.write(typestr + hashVal + twoByteLength + comment)
+            bp.put(UINT8, WLT_DATATYPE_ADDRCOMMENT)
          elif len(hashVal)==32:
-            typestr = int_to_binary(WLT_DATATYPE_TXCOMMENT)
-            newFile.write(typestr + hashVal + twoByteLength + comment)
+            bp.put(UINT8, WLT_DATATYPE_TXCOMMENT)
+         else:
+            continue
+         if isinstance(comment, unicode):
+            comment = toBytes(comment)
+         bp.put(BINARY_CHUNK, hashVal)
+         bp.put(UINT16, len(comment))
+         bp.put(BINARY_CHUNK, comment)
 
+      newFile = open(path, 'wb')
+      newFile.write(bp.getBinaryString())
       newFile.close()
 
    
@@ -2134,12 +2277,37 @@ class PyBtcWallet(object):
 
       return (dtype, hashVal, binData)
 
+   #############################################################################
+   def decodeAddressEntry(self, addr160, rawData, walletByteLoc):
+      """
+      Called by LazyAddressMap the first time an address from the wallet file
+      is accessed.  Does what readWalletFile used to do for every address
+      at load time, including fixing byte errors in the file.
+      """
+      newAddr = PyBtcAddress()
+      newAddr.unserialize(rawData)
+      newAddr.walletByteLoc = walletByteLoc
+      # Fix byte errors in the address data
+      fixedAddrData = newAddr.serialize()
+
+      if not rawData==fixedAddrData:
+         self.walletFileSafeUpdate([ \
+            [WLT_UPDATE_MODIFY, newAddr.walletByteLoc, fixedAddrData]])
+      if newAddr.useEncryption:
+         newAddr.isLocked = True
+      if newAddr.chainIndex < -2:
+         newAddr.chainIndex = -2
+      return newAddr
+
    #############################################################################
    @TimeThisFunction
    def readWalletFile(self, wltpath, verifyIntegrity=True, doScanNow=False):
       if not os.path.exists(wltpath):
          raise FileExistsError("No wallet file:"+wltpath)
 
+      # Don't lose (or read around) anything still queued in a batch
+      if self.batchUpdateDepth > 0:
+         self.flushBatchUpdate()
       self.__init__()
       self.walletPath = wltpath
 
@@ -2151,57 +2319,76 @@ class PyBtcWallet(object):
             raise KeyDataError(errmsg)
 
 
+      # Single pass over the memory-mapped file:  only the header and the
+      # comments are decoded here.  Key data is indexed by offset and decoded
+      # by LazyAddressMap the first time each address is used.
       wltfile = open(wltpath, 'rb')
-      wltdata = BinaryUnpacker(wltfile.read())
-      wltfile.close()
-
-      self.cppWallet = Cpp.BtcWallet()
-      self.unpackHeader(wltdata)
-
-      self.lastComputedChainIndex = -UINT32_MAX
-      self.lastComputedChainAddr160  = None
-      while wltdata.getRemainingSize()>0:
-         byteLocation = wltdata.getPosition()
-         dtype, hashVal, rawData = self.unpackNextEntry(wltdata)
-         if dtype==WLT_DATATYPE_KEYDATA:
-            newAddr = PyBtcAddress()
-            newAddr.unserialize(rawData)
-            newAddr.walletByteLoc = byteLocation + 21
-            # Fix byte errors in the address data
-            fixedAddrData = newAddr.serialize()
-
-            if not rawData==fixedAddrData:
-               self.walletFileSafeUpdate([ \
-                  [WLT_UPDATE_MODIFY, newAddr.walletByteLoc, fixedAddrData]])
-            if newAddr.useEncryption:
-               newAddr.isLocked = True
-            self.addrMap[hashVal] = newAddr
-            if newAddr.chainIndex > self.lastComputedChainIndex:
-               self.lastComputedChainIndex   = newAddr.chainIndex
-               self.lastComputedChainAddr160 = newAddr.getAddr160()
+      wltmap = mmap.mmap(wltfile.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+         wltdata = BinaryUnpacker(wltmap)
+
+         self.cppWallet = Cpp.BtcWallet()
+         self.addrMap = LazyAddressMap(wltpath, self.pybtcaddrSize,
+                                                   self.decodeAddressEntry)
+         self.unpackHeader(wltdata)
+
+         self.lastComputedChainIndex = -UINT32_MAX
+         self.lastComputedChainAddr160  = None
+         entrySize = 21 + self.pybtcaddrSize
+         bulkScrAddrs = []
+         wltScrAddrs = []
+         while wltdata.getRemainingSize()>0:
+            byteLocation = wltdata.getPosition()
+            if not ord(wltmap[byteLocation])==WLT_DATATYPE_KEYDATA:
+               dtype, hashVal, rawData = self.unpackNextEntry(wltdata)
+               if dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
+                  self.commentsMap[hashVal] = rawData # actually ASCII data, here
+                  self.commentLocs[hashVal] = byteLocation
+               if dtype==WLT_DATATYPE_OPEVAL:
+                  raise NotImplementedError('OP_EVAL not support in wallet yet')
+               continue
+
+            if wltdata.getRemainingSize() < entrySize:
+               raise UnpackerError, 'Truncated key data at end of wallet'
+            hashVal = wltdata.getChunk(byteLocation+1, 20)
+            addrLoc = byteLocation + 21
+            wltdata.advance(entrySize)
+
+            chainIndex = ADDRDATA_CHAININDEX.unpack_from(wltmap, 
+                                    addrLoc + ADDRDATA_CHAININDEX_OFFSET)[0]
+            self.addrMap.addOffset(hashVal, addrLoc)
+            if chainIndex > self.lastComputedChainIndex:
+               self.lastComputedChainIndex   = chainIndex
+               self.lastComputedChainAddr160 = hashVal
                
-            if newAddr.chainIndex < -2:
-               newAddr.chainIndex = -2
+            if chainIndex < -2:
+               chainIndex = -2
                self.hasNegativeImports = True
                                  
-            self.linearAddr160List.append(newAddr.getAddr160())
-            self.chainIndexMap[newAddr.chainIndex] = newAddr.getAddr160()
+            self.linearAddr160List.append(hashVal)
+            self.chainIndexMap[chainIndex] = hashVal
    
-            # Update the parallel C++ object that scans the blockchain for us
-            timeRng = newAddr.getTimeRange()
-            blkRng  = newAddr.getBlockRange()
-            self.cppWallet.addScrAddress_5_(Hash160ToScrAddr(hashVal), \
-                                                   timeRng[0], blkRng[0], \
-                                                   timeRng[1], blkRng[1])
-               
-         if dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
-            self.commentsMap[hashVal] = rawData # actually ASCII data, here
-            self.commentLocs[hashVal] = byteLocation
-         if dtype==WLT_DATATYPE_OPEVAL:
-            raise NotImplementedError('OP_EVAL not support in wallet yet')
-         if dtype==WLT_DATATYPE_DELETED:
-            pass
+            # Collected for the parallel C++ object that scans the blockchain
+            t0,t1,b0,b1 = ADDRDATA_RANGES.unpack_from(wltmap, 
+                                    addrLoc + ADDRDATA_RANGES_OFFSET)
+            scrAddr = Hash160ToScrAddr(hashVal)
+            wltScrAddrs.append(scrAddr)
+            bulkScrAddrs.append(chr(len(scrAddr)) + scrAddr)
+            bulkScrAddrs.append(SCRADDR_BULK_RANGES.pack(min(t0, UINT32_MAX),
+                                                         b0,
+                                                         min(t1, UINT32_MAX),
+                                                         b1))
+      finally:
+         wltmap.close()
+         wltfile.close()
+
+      # One call into C++ for all the addresses, not one per address
+      self.cppWallet.addScrAddressBulk(''.join(bulkScrAddrs))
 
+      # Only the wallet the app is using touches the index;  throwaway reads
+      # of the same file must not overwrite its entries
+      if TheScrAddrIndex.isWalletRegistered(self):
+         TheScrAddrIndex.addWallet(self)
 
       if (not doScanNow or \
           not TheBDM.getBDMState()=='BlockchainReady' or \
@@ -2282,6 +2469,17 @@ class PyBtcWallet(object):
       if len(updateList)==0:
          return []
 
+      if self.batchUpdateDepth > 0:
+         # Group-commit mode:  queue it up, commitBatchUpdate() writes it
+         baseSize = self.batchBaseSize + self.batchAppend.getSize()
+         packed = self.packWalletUpdateList(updateList, baseSize)
+         if packed is None:
+            return []
+         updateLocations, binaryToAppend, dataToChange = packed
+         self.batchAppend.put(BINARY_CHUNK, binaryToAppend)
+         self.batchModify.extend(dataToChange)
+         return updateLocations
+
       # Make sure that the primary and backup files are synced before update
       self.doWalletFileConsistencyCheck()
 
@@ -2292,47 +2490,10 @@ class PyBtcWallet(object):
 
       # Will be passing back info about all data successfully added
       oldWalletSize = os.path.getsize(self.walletPath)
-      updateLocations = []
-      dataToChange    = []
-      toAppend = BinaryPacker()
-
-      try:
-         for entry in updateList:
-            modType    = entry[0]
-            updateInfo = entry[1:]
-
-            if(modType==WLT_UPDATE_ADD):
-               dtype = updateInfo[0]
-               updateLocations.append(toAppend.getSize()+oldWalletSize)
-               if dtype==WLT_DATATYPE_KEYDATA:
-                  if len(updateInfo[1])!=20 or not isinstance(updateInfo[2], PyBtcAddress):
-                     raise Exception('Data type does not match update type')
-                  toAppend.put(UINT8, WLT_DATATYPE_KEYDATA)
-                  toAppend.put(BINARY_CHUNK, updateInfo[1])
-                  toAppend.put(BINARY_CHUNK, updateInfo[2].serialize())
-
-               elif dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
-                  if not isinstance(updateInfo[2], str):
-                     raise Exception('Data type does not match update type')
-                  toAppend.put(UINT8, dtype)
-                  toAppend.put(BINARY_CHUNK, updateInfo[1])
-                  toAppend.put(UINT16, len(updateInfo[2]))
-                  toAppend.put(BINARY_CHUNK, updateInfo[2])
-
-               elif dtype==WLT_DATATYPE_OPEVAL:
-                  raise Exception('OP_EVAL not support in wallet yet')
-
-            elif(modType==WLT_UPDATE_MODIFY):
-               updateLocations.append(updateInfo[0])
-               dataToChange.append( updateInfo )
-            else:
-               LOGERROR('Unknown wallet-update type!')
-               raise Exception('Unknown wallet-update type!')
-      except Exception:
-         LOGEXCEPT('Bad input to walletFileSafeUpdate')
+      packed = self.packWalletUpdateList(updateList, oldWalletSize)
+      if packed is None:
          return []
-
-      binaryToAppend = toAppend.getBinaryString()
+      updateLocations, binaryToAppend, dataToChange = packed
 
       # We need to safely modify both the main wallet file and backup
       # Start with main wallet
@@ -2402,6 +2563,255 @@ class PyBtcWallet(object):
 
 
 
+   #############################################################################
+   def packWalletUpdateList(self, updateList, oldWalletSize):
+      """
+      Validate and serialize a walletFileSafeUpdate() list, assuming the new
+      data will be appended at oldWalletSize.  Returns a triplet of
+      (updateLocations, binaryToAppend, dataToChange), or None if the list
+      was malformed.
+      """
+      updateLocations = []
+      dataToChange    = []
+      toAppend = BinaryPacker()
+
+      try:
+         for entry in updateList:
+            modType    = entry[0]
+            updateInfo = entry[1:]
+
+            if(modType==WLT_UPDATE_ADD):
+               dtype = updateInfo[0]
+               updateLocations.append(toAppend.getSize()+oldWalletSize)
+               if dtype==WLT_DATATYPE_KEYDATA:
+                  if len(updateInfo[1])!=20 or not isinstance(updateInfo[2], PyBtcAddress):
+                     raise Exception('Data type does not match update type')
+                  toAppend.put(UINT8, WLT_DATATYPE_KEYDATA)
+                  toAppend.put(BINARY_CHUNK, updateInfo[1])
+                  toAppend.put(BINARY_CHUNK, updateInfo[2].serialize())
+
+               elif dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
+                  if not isinstance(updateInfo[2], str):
+                     raise Exception('Data type does not match update type')
+                  toAppend.put(UINT8, dtype)
+                  toAppend.put(BINARY_CHUNK, updateInfo[1])
+                  toAppend.put(UINT16, len(updateInfo[2]))
+                  toAppend.put(BINARY_CHUNK, updateInfo[2])
+
+               elif dtype==WLT_DATATYPE_OPEVAL:
+                  raise Exception('OP_EVAL not support in wallet yet')
+
+            elif(modType==WLT_UPDATE_MODIFY):
+               updateLocations.append(updateInfo[0])
+               dataToChange.append( updateInfo )
+            else:
+               LOGERROR('Unknown wallet-update type!')
+               raise Exception('Unknown wallet-update type!')
+      except Exception:
+         LOGEXCEPT('Bad input to walletFileSafeUpdate')
+         return None
+
+      return updateLocations, toAppend.getBinaryString(), dataToChange
+
+
+
+
+   #############################################################################
+   def beginBatchUpdate(self):
+      """
+      Start group-commit mode.  Until the matching commitBatchUpdate(), every
+      walletFileSafeUpdate() call is only validated and queued (its return
+      value is still the correct final file offsets), and the whole batch is
+      then written to both wallet files at once:
+
+         (1) one checksummed journal record with all appended data and all
+             in-place modifications is written and fsync'd
+         (2) the record is applied to the main file, then the backup, with
+             one fsync each
+         (3) the journal is removed
+
+      If we die anywhere in (2), doWalletFileConsistencyCheck() finds the
+      valid journal and re-applies it to both files -- applying it is
+      idempotent because it truncates back to the pre-batch size first.  If
+      we die in (1), the checksum doesn't match, neither file was touched,
+      and the journal is simply discarded.  So we always have two identical,
+      uncorrupted wallet files, same as with the flag-file protocol.
+
+      Calls may be nested; only the outermost commit writes to disk.  The
+      usual rule still applies: don't hand out anything created inside the
+      batch (addresses, etc) until it has been committed.
+      """
+      if self.batchUpdateDepth == 0:
+         if not os.path.exists(self.walletPath):
+            raise FileExistsError('No wallet file exists to be updated!')
+
+         # Make sure that the primary and backup files are synced before update
+         self.doWalletFileConsistencyCheck()
+         self.batchBaseSize = os.path.getsize(self.walletPath)
+         self.batchAppend   = BinaryPacker()
+         self.batchModify   = []
+
+      self.batchUpdateDepth += 1
+
+
+   #############################################################################
+   def commitBatchUpdate(self):
+      """
+      End group-commit mode started by beginBatchUpdate().  Returns False if
+      the batch could not be written.
+      """
+      if self.batchUpdateDepth == 0:
+         LOGWARN('commitBatchUpdate() called without a batch in progress')
+         return True
+
+      self.batchUpdateDepth -= 1
+      if self.batchUpdateDepth > 0:
+         return True
+
+      return self.flushBatchUpdate()
+
+
+   #############################################################################
+   def flushBatchUpdate(self):
+      """
+      Write everything queued in the current batch through the journal, and
+      start over with an empty batch (depth is left alone).
+      """
+      appendData = self.batchAppend.getBinaryString()
+      dataToChange = self.batchModify
+      baseSize = self.batchBaseSize
+
+      self.batchAppend = BinaryPacker()
+      self.batchModify = []
+      self.batchBaseSize = baseSize + len(appendData)
+
+      if len(appendData)==0 and len(dataToChange)==0:
+         return True
+
+      journalPath = self.getWalletPath('journal')
+      try:
+         jfile = open(journalPath, 'wb')
+         jfile.write(self.packWalletJournal(baseSize, appendData, dataToChange))
+         jfile.flush()
+         os.fsync(jfile.fileno())
+         jfile.close()
+      except IOError:
+         LOGEXCEPT('Could not write wallet journal.  Permissions?')
+         if os.path.exists(journalPath):
+            os.remove(journalPath)
+         return False
+
+      try:
+         self.applyWalletJournal(self.walletPath, baseSize, appendData,
+                                                              dataToChange)
+
+         # This is for unit-testing the atomic-wallet-file-update robustness
+         if self.interruptTestJournal: raise InterruptTestError
+
+         self.applyWalletJournal(self.getWalletPath('backup'), baseSize,
+                                              appendData, dataToChange)
+      except IOError:
+         # The journal is intact:  the next consistency check re-applies it
+         LOGEXCEPT('Could not apply wallet journal.  Permissions?')
+         return False
+
+      os.remove(journalPath)
+      return True
+
+
+   #############################################################################
+   def packWalletJournal(self, baseSize, appendData, dataToChange):
+      """
+      [MAGIC(8) | PAYLOADSIZE(8) | PAYLOAD | HASH256(PAYLOAD)(32)] where the
+      payload is the pre-batch file size, the data to append, and the list
+      of (offset, data) overwrites.
+      """
+      payload = BinaryPacker()
+      payload.put(UINT64, baseSize)
+      payload.put(VAR_INT, len(appendData))
+      payload.put(BINARY_CHUNK, appendData)
+      payload.put(VAR_INT, len(dataToChange))
+      for loc,replStr in dataToChange:
+         payload.put(UINT64, loc)
+         payload.put(VAR_INT, len(replStr))
+         payload.put(BINARY_CHUNK, replStr)
+      payload = payload.getBinaryString()
+
+      bp = BinaryPacker()
+      bp.put(BINARY_CHUNK, WLT_JOURNAL_MAGIC)
+      bp.put(UINT64, len(payload))
+      bp.put(BINARY_CHUNK, payload)
+      bp.put(BINARY_CHUNK, hash256(payload))
+      return bp.getBinaryString()
+
+
+   #############################################################################
+   def unpackWalletJournal(self, journalData):
+      """
+      Returns (baseSize, appendData, dataToChange), or None if the journal is
+      incomplete or fails its checksum -- i.e. we died while writing it, and
+      neither wallet file has been touched yet.
+      """
+      try:
+         bu = BinaryUnpacker(journalData)
+         if not bu.get(BINARY_CHUNK, 8)==WLT_JOURNAL_MAGIC:
+            return None
+         payloadSize = bu.get(UINT64)
+         payload = bu.get(BINARY_CHUNK, payloadSize)
+         if not bu.get(BINARY_CHUNK, 32)==hash256(payload):
+            return None
+
+         bu = BinaryUnpacker(payload)
+         baseSize = bu.get(UINT64)
+         appendData = bu.get(BINARY_CHUNK, bu.get(VAR_INT))
+         dataToChange = []
+         for i in range(bu.get(VAR_INT)):
+            loc = bu.get(UINT64)
+            dataToChange.append([loc, bu.get(BINARY_CHUNK, bu.get(VAR_INT))])
+         return baseSize, appendData, dataToChange
+      except UnpackerError:
+         return None
+
+
+   #############################################################################
+   def applyWalletJournal(self, wltPath, baseSize, appendData, dataToChange):
+      """
+      Bring one wallet file to the post-batch state.  Safe to repeat:  we
+      truncate to the pre-batch size before appending.
+      """
+      wltfile = open(wltPath, 'r+b')
+      wltfile.truncate(baseSize)
+      wltfile.seek(baseSize)
+      wltfile.write(appendData)
+      for loc,replStr in dataToChange:
+         wltfile.seek(loc)
+         wltfile.write(replStr)
+      wltfile.flush()
+      os.fsync(wltfile.fileno())
+      wltfile.close()
+
+
+   #############################################################################
+   def recoverWalletJournal(self):
+      """
+      Called by the consistency check if a batch commit was interrupted.
+      """
+      journalPath = self.getWalletPath('journal')
+      with open(journalPath, 'rb') as jfile:
+         journal = self.unpackWalletJournal(jfile.read())
+
+      if journal is None:
+         LOGWARN('***WARNING: discarding incomplete wallet journal')
+      else:
+         LOGWARN('***WARNING: last batch update was interrupted -- replaying')
+         baseSize, appendData, dataToChange = journal
+         self.applyWalletJournal(self.walletPath, baseSize, appendData,
+                                                              dataToChange)
+         self.applyWalletJournal(self.getWalletPath('backup'), baseSize,
+                                                  appendData, dataToChange)
+      os.remove(journalPath)
+
+
    #############################################################################
    def doWalletFileConsistencyCheck(self, onlySyncBackup=True):
       """
@@ -2444,6 +2854,9 @@ class PyBtcWallet(object):
          shutil.copy(self.walletPath, walletFileBackup)
          os.remove(backupUpdateFlag)
 
+      if os.path.exists(self.getWalletPath('journal')):
+         self.recoverWalletJournal()
+
       if os.path.exists(backupUpdateFlag) and os.path.exists(mainUpdateFlag):
          # Here we actually have a good main file, but backup never succeeded
          LOGWARN('***WARNING: error in backup file... how did that happen?')
@@ -2625,6 +3038,7 @@ class PyBtcWallet(object):
       self.addrMap[newAddr160] = newAddr.copy()
       self.addrMap[newAddr160].walletByteLoc = newDataLoc[0] + 21
       self.linearAddr160List.append(newAddr160)
+      TheScrAddrIndex.addWalletScrAddr(self, Hash160ToScrAddr(newAddr160))
       if self.useEncryption and self.kdfKey:
          self.addrMap[newAddr160].lock(self.kdfKey)
          if not self.isLocked:
@@ -2802,33 +3216,37 @@ class PyBtcWallet(object):
       LOGDEBUG('Number of inputs that you can sign for: %d', numMyAddr)
 
 
-      # Unlock the wallet if necessary, sign inputs 
-      maxChainIndex = -1
-      for addrObj,idx,sigIdx in wltAddr:
-         maxChainIndex = max(maxChainIndex, addrObj.chainIndex)
-         if addrObj.isLocked:
-            if self.kdfKey:
-               if addrObj.createPrivKeyNextUnlock:
-                  self.unlock(self.kdfKey)
-               else:
-                  addrObj.unlock(self.kdfKey)
-            else:
-               self.lock()
+      # Decrypt only the keys we're signing with, then sign inputs 
+      self.unlockAddresses([addrObj.getAddr160() for addrObj,i,j in wltAddr])
+      try:
+         maxChainIndex = -1
+         keyList = []
+         for addrObj,idx,sigIdx in wltAddr:
+            maxChainIndex = max(maxChainIndex, addrObj.chainIndex)
+            if addrObj.isLocked:
                raise WalletLockError('Cannot sign tx without unlocking wallet')
 
-         if not addrObj.hasPubKey():
-            # Make sure the public key is available for this address
-            addrObj.binPublicKey65 = \
-               CryptoECDSA().ComputePublicKey(addrObj.binPrivKey32_Plain)
+            if not addrObj.hasPubKey():
+               # Make sure the public key is available for this address
+               addrObj.binPublicKey65 = \
+                  CryptoECDSA().ComputePublicKey(addrObj.binPrivKey32_Plain)
+
+            keyList.append((idx, addrObj.binPrivKey32_Plain))
 
 
          ##### MAGIC #####
-         ustx.createAndInsertSignatureForInput(idx, addrObj.binPrivKey32_Plain)
+         # (spread over --sig-workers threads if there are enough inputs)
+         errorList = ustx.createAndInsertSignaturesForInputs(keyList)
          ##### MAGIC #####
-                                               
+      finally:
+         # The keys are decrypted right now, whatever happened above
+         if self.useEncryption:
+            self.lock()
 
-      if self.useEncryption:
-         self.lock()
+      if len(errorList) > 0:
+         for idx,errStr in errorList:
+            LOGERROR('Could not sign input %d: %s', idx, errStr)
+         raise SignatureError('Could not sign %d input(s)' % len(errorList))
       
       prevHighestIndex = self.highestUsedChainIndex  
       if prevHighestIndex<maxChainIndex:
@@ -2841,13 +3259,18 @@ class PyBtcWallet(object):
    #############################################################################
    def unlock(self, secureKdfOutput=None, \
                     securePassphrase=None, \
-                    tempKeyLifetime=0, Progress=emptyFunc):
+                    tempKeyLifetime=0, Progress=emptyFunc, lazy=False):
       """
       We must assume that the kdfResultKey is a SecureBinaryData object
       containing the result of the KDF-passphrase.  The wallet unlocked-
       lifetime will be set to X seconds from time.time() [now] and next
       time the checkWalletLockTimeout function is called it will be re-
       locked.
+
+      With lazy=True only the KDF output is kept:  no private key is
+      decrypted here.  Whoever needs a key must call unlockAddresses() for
+      it first (signUnsignedTx and armoryd do), so code that reads
+      binPrivKey32_Plain straight out of addrMap must use the default.
       """
       
       LOGDEBUG('Attempting to unlock wallet: %s', self.uniqueIDB58)
@@ -2873,6 +3296,11 @@ class PyBtcWallet(object):
       else:
          self.lockWalletAtTime = RightNow() + tempKeyLifetime
 
+      if lazy:
+         self.isLocked = False
+         LOGDEBUG('Unlock succeeded (lazy): %s', self.uniqueIDB58)
+         return
+
       #Fix to n2 unlock issue: newly chained addresses on a locked wallet 
       #cannot have their private key computed until the next unlock.
       #When that unlock takes place, certain address entries lack context
@@ -2885,6 +3313,7 @@ class PyBtcWallet(object):
       addrCount = len(self.addrMap)
          
       addrObjPrev = None
+      saveUpdates = []
       import operator
       for addrObj in (sorted(self.addrMap.values(), 
                              key=operator.attrgetter('chainIndex'))):
@@ -2907,14 +3336,76 @@ class PyBtcWallet(object):
          if addrObj.chainIndex > -1: addrObjPrev = addrObj
 
          if needToSaveAddrAfterUnlock:
-            updateLoc = addrObj.walletByteLoc 
-            self.walletFileSafeUpdate( [[WLT_UPDATE_MODIFY, 
-                                         addrObj.walletByteLoc,
-                                         addrObj.serialize()]])
+            saveUpdates.append([WLT_UPDATE_MODIFY, 
+                                addrObj.walletByteLoc,
+                                addrObj.serialize()])
+
+      # All newly computed keys go to the file in one update
+      if len(saveUpdates) > 0:
+         self.walletFileSafeUpdate(saveUpdates)
 
       self.isLocked = False
       LOGDEBUG('Unlock succeeded: %s', self.uniqueIDB58)
 
+   #############################################################################
+   def unlockAddresses(self, addr160List):
+      """
+      Decrypt only the listed addresses with the key kept by unlock().  This
+      is what makes a lazy unlock cheap:  signing three inputs costs three
+      decrypts, not one per address in the wallet.  Addresses extended while
+      the wallet was locked (createPrivKeyNextUnlock) get their private keys
+      computed here, and are all written back in a single file update.
+      """
+      if not self.useEncryption or self.kdfKey is None:
+         return
+
+      addrList = [self.addrMap[a160] for a160 in set(addr160List) \
+                                                   if self.hasAddr(a160)]
+      addrList = [a for a in addrList if a.isLocked]
+
+      # Lower chain indices first, so a higher one can be derived from them
+      saveUpdates = []
+      import operator
+      for addrObj in sorted(addrList, key=operator.attrgetter('chainIndex')):
+         needToSaveAddrAfterUnlock = addrObj.createPrivKeyNextUnlock
+         if needToSaveAddrAfterUnlock:
+            self.shortenPrivKeyNextUnlockChain(addrObj)
+
+         addrObj.unlock(self.kdfKey)
+
+         if needToSaveAddrAfterUnlock:
+            saveUpdates.append([WLT_UPDATE_MODIFY, 
+                                addrObj.walletByteLoc,
+                                addrObj.serialize()])
+
+      if len(saveUpdates) > 0:
+         self.walletFileSafeUpdate(saveUpdates)
+
+   #############################################################################
+   def shortenPrivKeyNextUnlockChain(self, addrObj):
+      """
+      An address created while the wallet was locked is derived from the
+      last address that had an encrypted key at the time, possibly many
+      links back.  If a closer chain address has an encrypted key by now,
+      start from that one instead (same fix unlock() applies in bulk).
+      """
+      for depth in range(1, addrObj.createPrivKeyNextUnlock_ChainDepth):
+         prev160 = self.chainIndexMap.get(addrObj.chainIndex - depth)
+         if prev160 is None or not self.hasAddr(prev160):
+            return
+
+         addrObjPrev = self.addrMap[prev160]
+         if addrObjPrev.createPrivKeyNextUnlock:
+            continue
+
+         if addrObjPrev.binPrivKey32_Encr.getSize() == 32:
+            addrObj.createPrivKeyNextUnlock_IVandKey[0] = \
+                                       addrObjPrev.binInitVect16.copy()
+            addrObj.createPrivKeyNextUnlock_IVandKey[1] = \
+                                       addrObjPrev.binPrivKey32_Encr.copy()
+            addrObj.createPrivKeyNextUnlock_ChainDepth  = depth
+         return
+
    ############################################################################
    def lock(self, Progress=emptyFunc):
       """
@@ -2950,14 +3441,22 @@ class PyBtcWallet(object):
       #       kdfKey because we saved the encrypted versions before unlocking
       if self.useEncryption:
          LOGDEBUG('Attempting to lock wallet: %s', self.uniqueIDB58)
+         # Addresses that were never unserialized were never decrypted
+         # either, so a lazily-loaded wallet only has to visit the ones in
+         # memory:  after a lazy unlock that's just the keys that were used
+         if isinstance(self.addrMap, LazyAddressMap):
+            addrList = self.addrMap.getDecodedValues()
+         else:
+            addrList = self.addrMap.values()
+
          i=1
-         nAddr = len(self.addrMap)
+         nAddr = len(addrList)
          try:
-            for addr160,addrObj in self.addrMap.iteritems():
+            for addrObj in addrList:
                Progress(i, nAddr)
                i = i +1
                
-               self.addrMap[addr160].lock(self.kdfKey)
+               addrObj.lock(self.kdfKey)
    
             if self.kdfKey:
                self.kdfKey.destroy()
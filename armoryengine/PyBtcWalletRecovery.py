@@ -18,7 +18,9 @@ from time import sleep, ctime
 from armoryengine.ArmoryUtils import AllowAsync, emptyFunc, LOGEXCEPT, \
                                      LOGINFO, LOGERROR, SECP256K1_ORDER, \
                                      binary_to_int, BIGENDIAN, int_to_binary, \
-                                     binary_to_hex, enum, HMAC256
+                                     binary_to_hex, enum, HMAC256, hash256, \
+                                     RightNow
+import bisect
 
 
 #                      0          1        2       3       4        5 
@@ -1665,6 +1667,197 @@ def WalletConsistencyCheck(wallet, prgAt=None):
    return PyBtcWalletRecovery().ProcessWallet(None, wallet, None, 
                                     RECOVERMODE.Check, prgAt, True)
 
+###############################################################################
+class IncrementalWalletCheck(object):
+   """
+   Cheap periodic re-check of a wallet that already passed a full
+   ProcessWallet(..., RECOVERMODE.Check).  Remembers how far the file has
+   been verified (byte offset, highest chain index, and a checksum for every
+   WLT_CHECK_BLOCK_SIZE block of it), and on each run only validates the
+   entries appended since, plus those in blocks whose checksum changed.
+
+   Only checks what doesn't need the passphrase:  entry checksums, pubkeys
+   on the curve, chaincode, public key chaining, and private/public key
+   pairs for unencrypted wallets.  It doesn't repair anything -- when
+   run() returns errors, run the full check to get the report and fixes.
+
+   The crypto work is done in slices of sliceSec, with sleeps in between so
+   it uses at most cpuFraction of a core (and leaves the GIL to the others).
+   """
+   WLT_CHECK_BLOCK_SIZE = 64*1024
+
+   def __init__(self, wltPath, cpuFraction=0.25, sliceSec=0.05):
+      self.wltPath      = wltPath
+      self.cpuFraction  = cpuFraction
+      self.sliceSec     = sliceSec
+      self.reset()
+
+   ############################################################################
+   def reset(self):
+      self.checkedOffset     = 0
+      self.highestChainIndex = -1
+      self.blockChecksums    = []
+      self.entryOffsets      = []   # sorted start offsets of verified entries
+      self.chainOffsets      = {}   # chainIndex -> offset of verified entry
+
+   ############################################################################
+   def computeBlockChecksums(self, wltData):
+      bsz = self.WLT_CHECK_BLOCK_SIZE
+      return [hash256(wltData[i:i+bsz])[:8] for i in range(0, len(wltData), bsz)]
+
+   ############################################################################
+   def getDirtyEntryOffsets(self, newChecksums):
+      """ Offsets of verified entries in blocks that changed since """
+      bsz = self.WLT_CHECK_BLOCK_SIZE
+      dirtyOffsets = set()
+      for iblk,oldSum in enumerate(self.blockChecksums):
+         if iblk < len(newChecksums) and newChecksums[iblk] == oldSum:
+            continue
+         # The entry that started before this block may run into it
+         first = max(bisect.bisect_left(self.entryOffsets, iblk*bsz) - 1, 0)
+         last  = bisect.bisect_left(self.entryOffsets, (iblk+1)*bsz)
+         dirtyOffsets.update(self.entryOffsets[first:last])
+      return sorted(dirtyOffsets)
+
+   ############################################################################
+   def run(self):
+      """
+      Returns a list of error strings, empty if everything checked out.  The
+      high-water mark only moves forward when there were no errors.
+      """
+      with open(self.wltPath, 'rb') as wltFile:
+         wltData = wltFile.read()
+
+      if len(wltData) < self.checkedOffset:
+         # Shrunk?  Something rewrote the file, start over
+         self.reset()
+
+      wlt = PyBtcWallet()
+      wltUnpacker = BinaryUnpacker(wltData)
+      try:
+         wlt.unpackHeader(wltUnpacker)
+      except:
+         LOGEXCEPT('')
+         return ['Could not unpack wallet header']
+      rootAddr = wlt.addrMap['ROOT']
+      headerEnd = wltUnpacker.getPosition()
+
+      newChecksums = self.computeBlockChecksums(wltData)
+      toCheck = self.getDirtyEntryOffsets(newChecksums)
+      startOffset = max(self.checkedOffset, headerEnd)
+
+      errors = []
+      newEntries = []
+      sliceStart = RightNow()
+
+      # Re-check modified entries, then everything appended since last time
+      wltUnpacker.resetPosition(startOffset)
+      while True:
+         if len(toCheck) > 0:
+            offset = toCheck.pop(0)
+            wltUnpacker.resetPosition(offset)
+         elif wltUnpacker.getRemainingSize() > 0:
+            offset = wltUnpacker.getPosition()
+            newEntries.append(offset)
+         else:
+            break
+
+         errStr = self.checkEntry(wlt, rootAddr, wltData, wltUnpacker, offset)
+         if errStr:
+            # No point going on, the full check will find the rest
+            errors.append('%s (offset %d)' % (errStr, offset))
+            break
+
+         # Stay within our CPU budget
+         if RightNow() - sliceStart > self.sliceSec:
+            sleep(self.sliceSec * (1-self.cpuFraction) / self.cpuFraction)
+            sliceStart = RightNow()
+
+         if len(toCheck) == 0 and offset < startOffset:
+            wltUnpacker.resetPosition(startOffset)
+
+      if len(errors) == 0:
+         self.entryOffsets.extend(newEntries)
+         self.checkedOffset  = len(wltData)
+         self.blockChecksums = newChecksums
+      return errors
+
+   ############################################################################
+   def checkEntry(self, wlt, rootAddr, wltData, wltUnpacker, offset):
+      try:
+         dtype, hashVal, rawData = wlt.unpackNextEntry(wltUnpacker)
+      except NotImplementedError:
+         # Only the dtype byte was read, so we can't find the next entry.
+         # The full check knows how to deal with these
+         return 'Found OP_EVAL data entry'
+      except:
+         LOGEXCEPT('')
+         return 'Could not unpack entry'
+
+      if dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT, \
+                   WLT_DATATYPE_DELETED):
+         return None
+      elif not dtype==WLT_DATATYPE_KEYDATA:
+         return 'Unknown entry type %d' % dtype
+
+      newAddr = PyBtcAddress()
+      try:
+         newAddr.unserialize(rawData)
+      except:
+         LOGEXCEPT('')
+         return 'Checksum error in address entry'
+
+      if not newAddr.serialize() == rawData:
+         return 'Byte error in address entry'
+
+      if newAddr.hasPubKey():
+         if not CryptoECDSA().VerifyPublicKeyValid(newAddr.binPublicKey65):
+            return 'Invalid public key'
+         if not newAddr.getAddr160() == hashVal:
+            return 'Address entry does not match its hash160'
+
+      if newAddr.hasPrivKey() and not newAddr.useEncryption:
+         computedPub = CryptoECDSA().ComputePublicKey(newAddr.binPrivKey32_Plain)
+         if not computedPub.toBinStr() == newAddr.binPublicKey65.toBinStr():
+            return 'Private key does not match public key'
+
+      if newAddr.chainIndex < 0:
+         # Imported key, nothing to chain it to
+         return None
+
+      if not newAddr.chaincode.toBinStr() == rootAddr.chaincode.toBinStr():
+         return 'Chaincode mismatch at chainIndex %d' % newAddr.chainIndex
+
+      if newAddr.hasPubKey():
+         if newAddr.chainIndex == 0:
+            prevAddr, gap = rootAddr, 1
+         else:
+            prevIndex = newAddr.chainIndex - 1
+            while prevIndex >= 0 and not prevIndex in self.chainOffsets:
+               prevIndex -= 1
+            if prevIndex < 0:
+               prevAddr, gap = rootAddr, newAddr.chainIndex + 1
+            else:
+               prevLoc = self.chainOffsets[prevIndex]
+               prevUnpacker = BinaryUnpacker(wltData)
+               prevUnpacker.resetPosition(prevLoc)
+               prevAddr = PyBtcAddress().unserialize( \
+                                    wlt.unpackNextEntry(prevUnpacker)[2])
+               gap = newAddr.chainIndex - prevIndex
+
+         extended = prevAddr.binPublicKey65
+         for i in range(gap):
+            extended = CryptoECDSA().ComputeChainedPublicKey(extended, 
+                                                      prevAddr.chaincode)
+         if not extended.toBinStr() == newAddr.binPublicKey65.toBinStr():
+            return 'Forked public key chain at chainIndex %d' % \
+                                                        newAddr.chainIndex
+
+      self.chainOffsets[newAddr.chainIndex] = offset
+      self.highestChainIndex = max(self.highestChainIndex, newAddr.chainIndex)
+      return None
+
+
 #############################################################################
 # We don't have access to the qtdefines:tr function, but we still want
 # the capability to print multi-line strings within the code.  This simply
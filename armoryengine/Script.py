@@ -147,6 +147,7 @@ class PyScriptProcessor(object):
       self.txNew   = None
       self.script1 = None
       self.script2 = None
+      self.sigHashCache = None
       if txOldData and txNew and not txInIndex==None:
          self.setTxObjects(txOldData, txNew, txInIndex)
 
@@ -162,6 +163,7 @@ class PyScriptProcessor(object):
       TxOut instead of just the script itself.
       """
       self.txNew = PyTx().unserialize(txNew.serialize())
+      self.sigHashCache = TxSigHashCache(self.txNew)
       self.script1 = str(txNew.inputs[txInIndex].binScript) # copy
       self.txInIndex  = txInIndex
       self.txOutIndex = txNew.inputs[txInIndex].outpoint.txOutIndex
@@ -267,23 +269,22 @@ class PyScriptProcessor(object):
          LOGERROR('Non-unity hashtypes not implemented yet! (hashtype = %d)', hashtype)
          assert(False)
 
-      # 5. Make a copy of the transaction -- we will be hashing a modified version
-      txCopy = PyTx().unserialize( txInTx.serialize() )
+      # 5. We hash a modified version of the transaction.  The blanked-out
+      #    copy is serialized once per tx by the TxSigHashCache, not once
+      #    per signature
+      sigHashCache = self.sigHashCache
+      if sigHashCache is None or not sigHashCache.pytx is txInTx:
+         sigHashCache = TxSigHashCache(txInTx)
 
       # 6. Remove all OP_CODESEPARATORs
       subscript.replace( int_to_binary(OP_CODESEPARATOR), '')
 
       # 7. All the TxIn scripts in the copy are blanked (set to empty string)
-      for txin in txCopy.inputs:
-         txin.binScript = ''
-
       # 8. Script for the current input in the copy is set to subscript
-      txCopy.inputs[txInIndex].binScript = subscript
+      toHash = sigHashCache.getPreHashMsg(txInIndex, subscript, hashtype)[0]
 
       # 9. Prepare the signature and public key
       senderAddr = PyBtcAddress().createFromPublicKey(binPubKey)
-      binHashCode = int_to_binary(hashtype, widthBytes=4)
-      toHash = txCopy.serialize() + binHashCode
 
       # Hashes are computed as part of CppBlockUtils::CryptoECDSA methods
       ##hashToVerify = hash256(toHash)
@@ -5,8 +5,10 @@
 # See LICENSE or http://www.gnu.org/licenses/agpl.html                         #
 #                                                                              #
 ################################################################################
+import bisect
 import logging
 import os
+import threading
 
 import CppBlockUtils as Cpp
 from armoryengine.ArmoryUtils import *
@@ -700,7 +702,8 @@ class PyTx(BlockComponent):
       self.lockTime   = txData.get(UINT32)
       endPos = txData.getPosition()
       self.nBytes = endPos - startPos
-      self.thisHash = hash256(self.serialize())
+      # Hash the bytes we just read, rather than re-serializing the tx
+      self.thisHash = hash256(txData.getChunk(startPos, self.nBytes))
       return self
 
    # Before broadcasting a transaction make sure that the script is canonical
@@ -884,6 +887,121 @@ class TxSigningStatus(object):
          stat.pprint(indent+3, lutFunc)
 
 
+################################################################################
+class TxSigHashCache(object):
+   """
+   Builds SIGHASH_ALL pre-hash messages for every input of one tx without
+   copying and re-serializing the whole tx for each of them.
+
+   The message for input i is the tx with every input script blanked,
+   except input i which gets the script being spent, plus the hashcode.
+   Only that one input differs between inputs, so the tx is serialized
+   once with all scripts blank, and each message is the blank tx with the
+   bytes of input i swapped out.  Outpoints are indexed as well, so finding
+   the input that spends a given outpoint is a dict lookup.
+
+   Input scripts are not part of the message, so it stays valid while
+   signatures are added to the tx.  Anything else that changes the tx
+   (inputs, outputs, sequence numbers, locktime) needs a new object.
+   """
+   def __init__(self, pytx):
+      self.pytx = pytx
+
+      binOut = BinaryPacker()
+      binOut.put(UINT32, pytx.version)
+      binOut.put(VAR_INT, len(pytx.inputs))
+      self.prefix = binOut.getBinaryString()
+
+      self.outpointMap = {}
+      self.blankTxIns  = []
+      self.blankStarts = []
+      start = 0
+      for i,txin in enumerate(pytx.inputs):
+         opStr = txin.outpoint.serialize()
+         self.outpointMap.setdefault(opStr, i)
+         blankIn = opStr + '\x00' + int_to_binary(txin.intSeq, widthBytes=4,
+                                                    endOut=LITTLEENDIAN)
+         self.blankTxIns.append(blankIn)
+         self.blankStarts.append(start)
+         start += len(blankIn)
+      self.blankStarts.append(start)
+      self.blankInputs = ''.join(self.blankTxIns)
+
+      binOut = BinaryPacker()
+      binOut.put(VAR_INT, len(pytx.outputs))
+      for txout in pytx.outputs:
+         binOut.put(BINARY_CHUNK, txout.serialize())
+      binOut.put(UINT32, pytx.lockTime)
+      self.suffix = binOut.getBinaryString()
+
+   #############################################################################
+   def getTxInIndex(self, outpoint):
+      """ Index of the input spending this PyOutPoint, -1 if none """
+      return self.outpointMap.get(outpoint.serialize(), -1)
+
+   #############################################################################
+   def getPreHashMsg(self, txInIndex, prevTxOutScript, hashcode=1):
+      """ Same result as generatePreHashTxMsgToSign(self.pytx, ...) """
+      if not hashcode==1:
+         LOGERROR('Only hashcode=1 is supported at this time!')
+         LOGERROR('Requested hashcode=%d' % hashcode)
+         return None
+
+      blankIn = self.blankTxIns[txInIndex]
+      start = self.blankStarts[txInIndex]
+      end   = self.blankStarts[txInIndex+1]
+
+      hashCode1  = int_to_binary(hashcode, widthBytes=1)
+      hashCode4  = int_to_binary(hashcode, widthBytes=4, endOut=LITTLEENDIAN)
+      preHashMsg = ''.join([self.prefix, 
+                            self.blankInputs[:start],
+                            blankIn[:36],
+                            packVarInt(len(prevTxOutScript))[0],
+                            prevTxOutScript,
+                            blankIn[37:],
+                            self.blankInputs[end:],
+                            self.suffix,
+                            hashCode4])
+      return preHashMsg, hashCode1
+
+
+
+################################################################################
+# Signing and verifying hundreds of inputs is worth spreading over a few
+# threads, but starting them costs more than a handful of ECDSA ops
+SIG_WORKER_MIN_TASKS = 16
+
+################################################################################
+def getNumSigWorkers(numWorkers=None):
+   if numWorkers is None:
+      numWorkers = CLI_OPTIONS.sigWorkers
+   return max(numWorkers, 0)
+
+################################################################################
+def runECDSABatch(batch, numWorkers):
+   """
+   Runs the jobs of a C++ ECDSABatch over numWorkers threads.  That happens
+   entirely in C++ with the GIL released:  private keys stay in
+   SecureBinaryData, and nothing is forked.  Returns [(success, result), ...]
+   in job order, result being the 64-byte r|s for sign jobs, True/False for
+   verify jobs, or the error string.  The batch is wiped before returning.
+   """
+   try:
+      batch.run(numWorkers)
+      results = []
+      for i in range(batch.getNumJobs()):
+         if batch.jobFailed(i):
+            results.append((False, batch.getError(i)))
+         elif batch.isSignJob(i):
+            results.append((True, batch.getSignature(i).toBinStr()))
+         else:
+            results.append((True, batch.isVerified(i)))
+      return results
+   finally:
+      batch.clear()
+
+
+
 ################################################################################
 def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1):
    """
@@ -892,25 +1010,11 @@ def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1):
    into a few simple lines of code!
    (blank all scripts except this one, insert prev script, append hashcode)
 
-   Right now only supports SIGHASH_ALL
+   Right now only supports SIGHASH_ALL.  Use a TxSigHashCache directly when
+   computing messages for more than one input of the same tx.
    """
-   if not hashcode==1:
-      LOGERROR('Only hashcode=1 is supported at this time!')
-      LOGERROR('Requested hashcode=%d' % hashcode)
-      return None
-
-   # Create a copy of the tx with all scripts blanked out
-   txCopy = pytx.copy()
-   for i in range(len(txCopy.inputs)):
-      txCopy.inputs[i].binScript = ''
-
-   # Set the script of the TxIn being signed, to the previous TxOut script
-   txCopy.inputs[txInIndex].binScript = prevTxOutScript
-
-   hashCode1  = int_to_binary(hashcode, widthBytes=1)
-   hashCode4  = int_to_binary(hashcode, widthBytes=4, endOut=LITTLEENDIAN)
-   preHashMsg = txCopy.serialize() + hashCode4
-   return preHashMsg, hashCode1
+   return TxSigHashCache(pytx).getPreHashMsg(txInIndex, prevTxOutScript, 
+                                                                  hashcode)
 
 
 
@@ -1202,7 +1306,8 @@ class UnsignedTxInput(AsciiSerializable):
 
 
    #############################################################################
-   def createTxSignature(self, pytx, sbdPrivKey, hashcode=1):
+   def createTxSignature(self, pytx, sbdPrivKey, hashcode=1, 
+                                                    sigHashCache=None):
       """
       This might be a little confusing ... remember this is an input for a
       transaction which may not have been fully defined at the time this
@@ -1211,24 +1316,13 @@ class UnsignedTxInput(AsciiSerializable):
       using the CryptoECDSA module and the supplied privKey.
 
       This returns a DER-encoded signature string with the 1-byte hashcode
-      appended to the end
+      appended to the end.  Pass in a TxSigHashCache for pytx if signing more
+      than one input of it.
       """
 
       # Make sure the supplied privateKey is relevant to this USTXI
-      computedPub = CryptoECDSA().ComputePublicKey(sbdPrivKey).toBinStr()
-      if not computedPub in self.pubKeys:
-         raise SignatureError('No PubKey that matches this privKey')
-
-      txiIdx = -1
-      for i,txin in enumerate(pytx.inputs):
-         if self.outpoint.serialize()==txin.outpoint.serialize():
-            txiIdx = i
-            break
-      else:
-         raise SignatureError('No TxIn in tx that matches this USTXI')
-
-      msg,hc = generatePreHashTxMsgToSign(pytx, txiIdx, 
-                                    self.getTxoScriptToSign(), hashcode)
+      msg,hc,pub = self.getPreHashMsgForKey(pytx, sbdPrivKey, hashcode, 
+                                                               sigHashCache)
       sbdSig = CryptoECDSA().SignData(SecureBinaryData(msg), sbdPrivKey)
       binSig = sbdSig.toBinStr()
       return createDERSigFromRS(binSig[:32], binSig[32:]) + hc
@@ -1256,20 +1350,46 @@ class UnsignedTxInput(AsciiSerializable):
 
 
    #############################################################################
-   def createAndInsertSignature(self, pytx, sbdPrivKey, hashcode=1):
+   def getPreHashMsgForKey(self, pytx, sbdPrivKey, hashcode=1, 
+                                                    sigHashCache=None):
+      """
+      Everything createTxSignature does except the signing itself.  Returns
+      the message to sign and the pubkey of sbdPrivKey.
+      """
+      computedPub = CryptoECDSA().ComputePublicKey(sbdPrivKey).toBinStr()
+      if not computedPub in self.pubKeys:
+         raise SignatureError('No PubKey that matches this privKey')
 
-      derSig = self.createTxSignature(pytx, sbdPrivKey, hashcode)
+      if sigHashCache is None:
+         sigHashCache = TxSigHashCache(pytx)
+
+      txiIdx = sigHashCache.getTxInIndex(self.outpoint)
+      if txiIdx < 0:
+         raise SignatureError('No TxIn in tx that matches this USTXI')
+
+      msg,hc = sigHashCache.getPreHashMsg(txiIdx, self.getTxoScriptToSign(), 
+                                                                  hashcode)
+      return msg, hc, computedPub
+
+   #############################################################################
+   def createAndInsertSignature(self, pytx, sbdPrivKey, hashcode=1,
+                                                    sigHashCache=None):
+
+      derSig = self.createTxSignature(pytx, sbdPrivKey, hashcode, 
+                                                          sigHashCache)
       computedPub = CryptoECDSA().ComputePublicKey(sbdPrivKey).toBinStr()
 
       msIdx = self.insertSignature(derSig, computedPub)
       return derSig, msIdx
 
    #############################################################################
-   def verifyTxSignature(self, pytx, sigStr, pubKey=None):
-      return (self.getValidIndexForSignature(pytx, sigStr, pubKey) >= 0)
+   def verifyTxSignature(self, pytx, sigStr, pubKey=None, sigHashCache=None):
+      return (self.getValidIndexForSignature(pytx, sigStr, pubKey, 
+                                                    sigHashCache) >= 0)
 
    #############################################################################
-   def getValidIndexForSignature(self, pytx, sigStr, pubKey=None):
+   def getValidIndexForSignature(self, pytx, sigStr, pubKey=None, 
+                                                    sigHashCache=None):
       """
       IMPORTANT:  This returns the index in the self.pubKeys list, for which
                   the signature is valid!  -1 is returned if the signature is
@@ -1277,44 +1397,41 @@ class UnsignedTxInput(AsciiSerializable):
 
                      isValid = (verifyTxSignature(...) >= 0)
       """
-      txiIdx = -1
-      for i,txin in enumerate(pytx.inputs):
-         if self.outpoint.serialize()==txin.outpoint.serialize():
-            txiIdx = i
-            break
-      else:
-         raise SignatureError('No TxIn that matches this USTXI')
+      if sigHashCache is None:
+         sigHashCache = TxSigHashCache(pytx)
 
+      txiIdx = sigHashCache.getTxInIndex(self.outpoint)
+      if txiIdx < 0:
+         raise SignatureError('No TxIn that matches this USTXI')
 
-      # If we were not given a public key to use for verification,
-      # recurse into this method once with each of self.pubKeys.
-      # We've assumed up until now that pubkeys and p2sh script will
-      # always be available with the supportingTx, all as part of the
-      # USTXI class
+      # If we were not given a public key to use for verification, try
+      # each of self.pubKeys.  We've assumed up until now that pubkeys and 
+      # p2sh script will always be available with the supportingTx, all as 
+      # part of the USTXI class
       if pubKey is None:
-         for i,pubk in enumerate(self.pubKeys):
-            if self.verifyTxSignature(pytx, sigStr, pubk):
-               return i
-         return -1
-
-
-      # If public key is supplied (including on recursion)
-      try:
-         msIndex = self.pubKeys.index(pubKey)
-      except ValueError:
-         raise KeyDataError('Supplied pubkey does not match any USTXI keys')
+         pubKeyList = list(enumerate(self.pubKeys))
+      else:
+         try:
+            pubKeyList = [(self.pubKeys.index(pubKey), pubKey)]
+         except ValueError:
+            raise KeyDataError('Supplied pubkey does not match any USTXI keys')
 
 
       rBin, sBin = getRSFromDERSig(sigStr)
       hashcode  = binary_to_int(sigStr[-1])
 
-      # Don't forget "sigStr" has the 1-byte hashcode at the end
-      msg = generatePreHashTxMsgToSign(pytx, txiIdx,
-            self.getTxoScriptToSign(), hashcode)[0]
+      # Don't forget "sigStr" has the 1-byte hashcode at the end.  The msg
+      # is the same for every pubkey, so only build it once
+      msg = sigHashCache.getPreHashMsg(txiIdx, self.getTxoScriptToSign(), 
+                                                                hashcode)[0]
       sbdMsg = SecureBinaryData(msg)
       sbdSig = SecureBinaryData(rBin + sBin)
-      sbdPub = SecureBinaryData(pubKey)
-      return msIndex if CryptoECDSA().VerifyData(sbdMsg, sbdSig, sbdPub) else -1
+      for msIndex,pubk in pubKeyList:
+         sbdPub = SecureBinaryData(pubk)
+         if CryptoECDSA().VerifyData(sbdMsg, sbdSig, sbdPub):
+            return msIndex
+
+      return -1
 
    #############################################################################
    # make sure to sign the p2shScript if it is there, other wise sign the txoScript
@@ -1324,7 +1441,36 @@ class UnsignedTxInput(AsciiSerializable):
       return self.p2shScript if self.p2shScript else self.txoScript
       
    #############################################################################
-   def verifyAllSignatures(self, pytx):
+   def getSigVerifyTasks(self, pytx, sigHashCache=None):
+      """
+      The (preHashMsg, binSigRS, pubKey) triplets verifyAllSignatures would
+      check, so they can be checked somewhere else.  Returns None if there
+      aren't enough signatures to bother.
+      """
+      signStat = self.evaluateSigningStatus()
+      if not signStat.allSigned:
+         return None
+
+      if sigHashCache is None:
+         sigHashCache = TxSigHashCache(pytx)
+
+      txiIdx = sigHashCache.getTxInIndex(self.outpoint)
+      if txiIdx < 0:
+         raise SignatureError('No TxIn that matches this USTXI')
+
+      taskList = []
+      for i in range(signStat.N):
+         if signStat.statusN[i] in [TXIN_SIGSTAT.ALREADY_SIGNED, \
+                                    TXIN_SIGSTAT.WLT_ALREADY_SIGNED]:
+            sig = self.signatures[i]
+            rBin, sBin = getRSFromDERSig(sig)
+            msg = sigHashCache.getPreHashMsg(txiIdx, self.getTxoScriptToSign(),
+                                             binary_to_int(sig[-1]))[0]
+            taskList.append((msg, rBin+sBin, self.pubKeys[i]))
+      return taskList
+
+   #############################################################################
+   def verifyAllSignatures(self, pytx, sigHashCache=None):
       M = self.sigsNeeded
       N = self.keysListed
       signStat = self.evaluateSigningStatus()
@@ -1334,13 +1480,16 @@ class UnsignedTxInput(AsciiSerializable):
          return False
 
       # Now check that all the raw signatures are actually value
+      if sigHashCache is None:
+         sigHashCache = TxSigHashCache(pytx)
+
       numValid = 0  # we'll double check sufficient sigs
       for i in range(signStat.N):
          if signStat.statusN[i] in [TXIN_SIGSTAT.ALREADY_SIGNED, \
                                     TXIN_SIGSTAT.WLT_ALREADY_SIGNED]:
             pub = self.pubKeys[i]
             sig = self.signatures[i]
-            if self.verifyTxSignature(pytx, sig, pub):
+            if self.verifyTxSignature(pytx, sig, pub, sigHashCache):
                numValid +=1
             else:
                LOGERROR('Signature in USTXI is not valid')
@@ -1977,6 +2126,7 @@ class UnsignedTransaction(AsciiSerializable):
       self.lockTime        = 0
       self.ustxInputs  = []
       self.decorTxOuts = []
+      self.sigHashCache = None
 
       txMap   = {} if txMap   is None else txMap
       p2shMap = {} if p2shMap is None else p2shMap
@@ -2390,12 +2540,77 @@ class UnsignedTransaction(AsciiSerializable):
 
 
    #############################################################################
-   def verifySigsAllInputs(self):
-      for ustxi in self.ustxInputs:
-         if not ustxi.verifyAllSignatures(self.pytxObj):
-            return False
+   def getSigHashCache(self):
+      """
+      Shared by every signature created or checked on this USTX, so the
+      pytx is serialized once rather than once per input (and per key).
+      """
+      if self.sigHashCache is None or \
+         not self.sigHashCache.pytx is self.pytxObj:
+         self.sigHashCache = TxSigHashCache(self.pytxObj)
+      return self.sigHashCache
 
-      return True
+   #############################################################################
+   def verifySigsAllInputs(self, numWorkers=None):
+      return all([valid for valid,err in self.verifySigsEachInput(numWorkers)])
+
+   #############################################################################
+   def verifySigsEachInput(self, numWorkers=None):
+      """
+      Returns one (isValid, errorStr) pair per input, in input order.  With
+      numWorkers>1 (default: --sig-workers) and enough signatures to make it
+      worthwhile, the ECDSA checks are spread over that many threads.
+      """
+      sigHashCache = self.getSigHashCache()
+      numWorkers = getNumSigWorkers(numWorkers)
+
+      if numWorkers > 1:
+         resultList = [None]*len(self.ustxInputs)
+         inputTasks = []
+         for iin,ustxi in enumerate(self.ustxInputs):
+            try:
+               taskList = ustxi.getSigVerifyTasks(self.pytxObj, sigHashCache)
+            except Exception as e:
+               resultList[iin] = (False, str(e))
+               continue
+            if taskList is None:
+               resultList[iin] = (False, 'Missing or invalid signature')
+            else:
+               inputTasks.append((iin, taskList))
+
+         allTasks = [task for iin,taskList in inputTasks for task in taskList]
+         if len(allTasks) >= SIG_WORKER_MIN_TASKS:
+            batch = Cpp.ECDSABatch()
+            for msg,binSigRS,pubKey in allTasks:
+               batch.addVerifyJob(SecureBinaryData(msg), 
+                                  SecureBinaryData(binSigRS), 
+                                  SecureBinaryData(pubKey))
+            workerResults = runECDSABatch(batch, numWorkers)
+            for iin,taskList in inputTasks:
+               ustxi = self.ustxInputs[iin]
+               inputResults = workerResults[:len(taskList)]
+               workerResults = workerResults[len(taskList):]
+               errList = [res for ok,res in inputResults if not ok]
+               numValid = len([res for ok,res in inputResults if ok and res])
+               if len(errList) > 0:
+                  resultList[iin] = (False, errList[0])
+               elif numValid < ustxi.sigsNeeded:
+                  LOGERROR('Signature in USTXI is not valid')
+                  resultList[iin] = (False, 'Missing or invalid signature')
+               else:
+                  resultList[iin] = (True, '')
+            return resultList
+
+      resultList = []
+      for ustxi in self.ustxInputs:
+         try:
+            if ustxi.verifyAllSignatures(self.pytxObj, sigHashCache):
+               resultList.append((True, ''))
+            else:
+               resultList.append((False, 'Missing or invalid signature'))
+         except Exception as e:
+            resultList.append((False, str(e)))
+      return resultList
 
    #############################################################################
    def verifyInputsMatchPyTxObj(self):
@@ -2468,7 +2683,8 @@ class UnsignedTransaction(AsciiSerializable):
          raise SignatureError('TxIn index is out of range for this USTX')
 
       ustxi = self.ustxInputs[txInIndex]
-      return ustxi.verifyTxSignature(self.pytxObj, sigStr, pubKey)
+      return ustxi.verifyTxSignature(self.pytxObj, sigStr, pubKey,
+                                                   self.getSigHashCache())
 
 
    #############################################################################
@@ -2477,13 +2693,69 @@ class UnsignedTransaction(AsciiSerializable):
          raise SignatureError('TxIn index is out of range for this USTX')
 
       ustxi = self.ustxInputs[txInIndex]
-      ustxi.createAndInsertSignature(self.pytxObj, sbdPrivKey, hashcode)
+      ustxi.createAndInsertSignature(self.pytxObj, sbdPrivKey, hashcode,
+                                                   self.getSigHashCache())
+
 
+   #############################################################################
+   def createAndInsertSignaturesForInputs(self, keyList, hashcode=1, 
+                                                          numWorkers=None):
+      """
+      keyList is a list of (txInIndex, sbdPrivKey).  Returns a list of
+      (txInIndex, errorStr) for every entry that could not be signed; the
+      rest get their signatures inserted, in keyList order.  With
+      numWorkers>1 (default: --sig-workers) and enough inputs, the signing
+      is spread over that many threads by a C++ ECDSABatch, so the keys
+      never leave SecureBinaryData.
+      """
+      numWorkers = getNumSigWorkers(numWorkers)
+      sigHashCache = self.getSigHashCache()
+      errorList = []
+
+      if numWorkers <= 1 or len(keyList) < SIG_WORKER_MIN_TASKS:
+         for txInIndex,sbdPrivKey in keyList:
+            try:
+               if txInIndex >= len(self.ustxInputs):
+                  raise SignatureError('TxIn index is out of range for this USTX')
+               self.ustxInputs[txInIndex].createAndInsertSignature(
+                           self.pytxObj, sbdPrivKey, hashcode, sigHashCache)
+            except Exception as e:
+               errorList.append((txInIndex, str(e)))
+         return errorList
+
+      taskInfo = []
+      batch = Cpp.ECDSABatch()
+      for pos,(txInIndex,sbdPrivKey) in enumerate(keyList):
+         try:
+            if txInIndex >= len(self.ustxInputs):
+               raise SignatureError('TxIn index is out of range for this USTX')
+            msg,hc,pub = self.ustxInputs[txInIndex].getPreHashMsgForKey(
+                           self.pytxObj, sbdPrivKey, hashcode, sigHashCache)
+         except Exception as e:
+            errorList.append((pos, txInIndex, str(e)))
+            continue
+         taskInfo.append((pos, txInIndex, hc, pub))
+         batch.addSignJob(SecureBinaryData(msg), sbdPrivKey)
+
+      workerResults = runECDSABatch(batch, numWorkers)
+      for (pos,txInIndex,hc,pub),(ok,res) in zip(taskInfo, workerResults):
+         try:
+            if not ok:
+               raise SignatureError(res)
+            derSig = createDERSigFromRS(res[:32], res[32:])
+            self.ustxInputs[txInIndex].insertSignature(derSig + hc, pub)
+         except Exception as e:
+            errorList.append((pos, txInIndex, str(e)))
+
+      # Same order the serial path reports them in
+      errorList.sort()
+      return [(txInIndex,err) for pos,txInIndex,err in errorList]
 
    #############################################################################
    def insertSignatureForInput(self, txInIndex, sigStr, pubKey=None):
       ustxi = self.ustxInputs[txInIndex]
-      sigIndex = ustxi.getValidIndexForSignature(self.pytxObj, sigStr, pubKey)
+      sigIndex = ustxi.getValidIndexForSignature(self.pytxObj, sigStr, pubKey,
+                                                   self.getSigHashCache())
       if sigIndex >= 0:
          ustxi.setSignature(sigIndex, sigStr)
          return sigIndex
@@ -2757,20 +3029,352 @@ def PyCreateAndSignTx_old(srcTxOuts, dstAddrsVals):
 
 
 
+################################################################################
+# Confirmations after which we stop worrying that a reorg will undo a block
+TX_FACTS_SAFE_DEPTH = 6
+TX_FACTS_CACHE_SIZE = 20000
+ZC_RECENT_TX_SIZE = 2000
+
+################################################################################
+class TxFacts(object):
+   """
+   Everything about a tx that can't change once it is in a block:  its fee,
+   inputs and outputs, and where it was mined.  inputs and outputs are
+   lists of [scrAddr, value].  blockHeight is UINT32_MAX if it's not in a
+   block yet.
+   """
+   __slots__ = ('txHash', 'fee', 'valueIn', 'valueOut', 'inputs', 'outputs', \
+                'txSize', 'blockHash', 'blockHeight', 'blockTime', 'txIndex')
+
+   def __init__(self, txHash, cppTx, cppHead, fee, senders):
+      self.txHash   = txHash
+      self.fee      = fee
+      self.inputs   = senders
+      self.outputs  = []
+      for i in range(cppTx.getNumTxOut()):
+         txout = cppTx.getTxOutCopy(i)
+         self.outputs.append([txout.getScrAddressStr(), txout.getValue()])
+      self.valueOut = sum([out[1] for out in self.outputs])
+      self.valueIn  = fee + self.valueOut
+      self.txSize   = cppTx.getSize()
+      self.txIndex  = cppTx.getBlockTxIndex()
+
+      if cppHead and cppHead.isInitialized():
+         self.blockHash   = cppHead.getThisHash()
+         self.blockHeight = cppHead.getBlockHeight()
+         self.blockTime   = cppHead.getTimestamp()
+      else:
+         self.blockHash   = ''
+         self.blockHeight = UINT32_MAX
+         self.blockTime   = 0
+
+   def isConfirmed(self):
+      return not self.blockHeight==UINT32_MAX
+
+
+################################################################################
+class TxFactsCache(object):
+   """
+   LRU cache of TxFacts for confirmed transactions, so ledger views don't
+   go back to the BDM for the same tx on every repaint.  Misses are fetched
+   with a single TheBDM.getTxDataBatch() call.
+
+   When the BDM reports a reorg, entries from blocks above the branch point
+   or less than safeDepth blocks deep are dropped.  Anything deeper stays.
+   """
+
+   #############################################################################
+   def __init__(self, maxSize=TX_FACTS_CACHE_SIZE, safeDepth=TX_FACTS_SAFE_DEPTH):
+      self.cache = LRUCache(maxSize)
+      self.safeDepth = safeDepth
+      self.lock = threading.Lock()
+      self.seenReorgCount = None
+
+   #############################################################################
+   def checkForReorg(self):
+      # Two reorgs between calls must not leave the deeper one's facts behind
+      reorgCount, branchHeight = TheBDM.getLastReorg(self.seenReorgCount)
+      if self.seenReorgCount is None:
+         self.seenReorgCount = reorgCount
+      elif not reorgCount==self.seenReorgCount:
+         self.seenReorgCount = reorgCount
+         safeHeight = TheBDM.getTopBlockHeight() - self.safeDepth
+         self.invalidateAbove(min(branchHeight, safeHeight))
+
+   #############################################################################
+   def invalidateAbove(self, height):
+      with self.lock:
+         for txHash in self.cache.keys():
+            if self.cache.data[txHash].blockHeight > height:
+               self.cache.pop(txHash)
+
+   #############################################################################
+   def getTxFactsBatch(self, txHashList):
+      """
+      Returns a dict txHash -> TxFacts.  Tx the BDM doesn't know are left out
+      """
+      self.checkForReorg()
+
+      result, missing = {}, []
+      with self.lock:
+         for txHash in txHashList:
+            facts = self.cache.get(txHash)
+            if facts is None:
+               missing.append(txHash)
+            else:
+               result[txHash] = facts
+
+      if missing:
+         txDataMap = TheBDM.getTxDataBatch(missing, True)
+         with self.lock:
+            for txHash,txData in txDataMap.iteritems():
+               facts = TxFacts(txHash, *txData)
+               if facts.isConfirmed():
+                  self.cache.put(txHash, facts)
+               result[txHash] = facts
+
+      return result
+
+   #############################################################################
+   def getTxFacts(self, txHash):
+      return self.getTxFactsBatch([txHash]).get(txHash)
+
+   #############################################################################
+   def clear(self):
+      with self.lock:
+         self.cache.clear()
+
+
+TheTxFactsCache = TxFactsCache()
+
+
+################################################################################
+class ScrAddrIndex(object):
+   """
+   Maps each scrAddr to the IDs of the wallets and lockboxes that hold it,
+   so code that only has a scrAddr doesn't have to ask every wallet in turn.
+   Wallets are keyed by wallet ID, lockboxes by lockbox ID;  both live in
+   the same namespace, like everywhere else they share a ledger.
+
+   Only wallets the app actually uses are indexed:  the apps call addWallet
+   and removeWallet as wallets enter and leave their wallet maps, and add
+   lockboxes as they load them.  After that, the registered wallet object
+   reports each address it computes or imports.  Any other PyBtcWallet with
+   the same ID (a temporary copy read from file, a duplicate on disk) is
+   ignored, so it can't change what the live wallet's entries look like.
+   """
+
+   #############################################################################
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.scrAddrMap = {}
+      self.ownerMap = {}
+      self.walletMap = {}
+
+   #############################################################################
+   def addScrAddr(self, ownerID, scrAddr):
+      with self.lock:
+         self.scrAddrMap.setdefault(scrAddr, set()).add(ownerID)
+         self.ownerMap.setdefault(ownerID, set()).add(scrAddr)
+
+   #############################################################################
+   def addScrAddrList(self, ownerID, scrAddrList, replace=False):
+      """
+      With replace=True, whatever the owner had before is dropped first, for
+      when a wallet is re-read from file (e.g. after deleting an import)
+      """
+      if replace:
+         self.removeOwner(ownerID)
+
+      with self.lock:
+         ownerSet = self.ownerMap.setdefault(ownerID, set())
+         for scrAddr in scrAddrList:
+            self.scrAddrMap.setdefault(scrAddr, set()).add(ownerID)
+            ownerSet.add(scrAddr)
+
+   #############################################################################
+   def addWallet(self, wlt):
+      """
+      Registers wlt as the live wallet for its ID and (re)indexes all of its
+      addresses.  Also used when the live wallet re-reads its file.
+      """
+      wltID = wlt.uniqueIDB58
+      scrAddrList = [Hash160ToScrAddr(a160) for a160 in wlt.linearAddr160List]
+      self.addScrAddrList(wltID, scrAddrList, replace=True)
+      with self.lock:
+         self.walletMap[wltID] = wlt
+
+   #############################################################################
+   def removeWallet(self, wltID):
+      with self.lock:
+         self.walletMap.pop(wltID, None)
+      self.removeOwner(wltID)
+
+   #############################################################################
+   def isWalletRegistered(self, wlt):
+      with self.lock:
+         return self.walletMap.get(wlt.uniqueIDB58) is wlt
+
+   #############################################################################
+   def addWalletScrAddr(self, wlt, scrAddr):
+      """
+      Called by PyBtcWallet for each address it computes or imports;  only
+      the registered wallet object for that ID gets to update the index
+      """
+      if self.isWalletRegistered(wlt):
+         self.addScrAddr(wlt.uniqueIDB58, scrAddr)
+
+   #############################################################################
+   def addLockbox(self, lbID, lbox):
+      scrAddrReg  = script_to_scrAddr(lbox.binScript)
+      scrAddrP2SH = script_to_scrAddr(script_to_p2sh_script(lbox.binScript))
+      self.addScrAddrList(lbID, [scrAddrReg, scrAddrP2SH], replace=True)
+
+   #############################################################################
+   def removeOwner(self, ownerID):
+      with self.lock:
+         for scrAddr in self.ownerMap.pop(ownerID, []):
+            owners = self.scrAddrMap.get(scrAddr)
+            if owners is None:
+               continue
+            owners.discard(ownerID)
+            if len(owners)==0:
+               del self.scrAddrMap[scrAddr]
+
+   #############################################################################
+   def getOwners(self, scrAddr):
+      with self.lock:
+         return set(self.scrAddrMap.get(scrAddr, []))
+
+   #############################################################################
+   def getOwnerIn(self, scrAddr, ownerMap):
+      """
+      Returns the ID of an owner of scrAddr that is a key in ownerMap, or
+      None.  If several are, the lowest ID wins, so the answer is stable.
+      """
+      with self.lock:
+         owners = self.scrAddrMap.get(scrAddr)
+         if not owners:
+            return None
+         found = [ownerID for ownerID in owners if ownerID in ownerMap]
+      return min(found) if found else None
+
+   #############################################################################
+   def getOwnersForList(self, scrAddrList):
+      owners = set()
+      with self.lock:
+         for scrAddr in scrAddrList:
+            owners.update(self.scrAddrMap.get(scrAddr, []))
+      return owners
+
+   #############################################################################
+   def getAllOwners(self):
+      with self.lock:
+         return set(self.ownerMap.keys())
+
+
+TheScrAddrIndex = ScrAddrIndex()
+
+
+################################################################################
+class ZeroConfDispatcher(object):
+   """
+   Figures out which wallets and lockboxes a batch of new zero-conf tx
+   touch, parsing each tx once.  A tx touches whoever owns one of its
+   outputs, and whoever owned an output it spends.  The spent outputs are
+   looked up with one TxFactsCache batch for the whole set of tx, plus the
+   outputs of the zero-conf tx we parsed recently, since those usually
+   aren't in the DB yet.
+
+   If a spent output can't be found at all, every wallet is reported as
+   affected:  that's what callers did before, and it's never wrong.
+   """
+
+   #############################################################################
+   def __init__(self, scrAddrIndex=None, maxRecent=ZC_RECENT_TX_SIZE):
+      self.scrAddrIndex = scrAddrIndex or TheScrAddrIndex
+      self.recentOutputs = LRUCache(maxRecent)
+
+   #############################################################################
+   def dispatch(self, rawTxList):
+      """
+      Returns (affectedIDs, txOwnerList), where txOwnerList has one
+      [txHash, ownerIDSet] pair per tx that parsed, in the same order.
+      """
+      parsedList = []
+      prevHashes = set()
+      for rawTx in rawTxList:
+         try:
+            tx = PyTx().unserialize(rawTx)
+         except:
+            LOGEXCEPT('Could not parse zero-conf tx')
+            continue
+
+         outScrAddrs = [script_to_scrAddr(txout.getScript()) \
+                                                   for txout in tx.outputs]
+         txHash = tx.getHash()
+         self.recentOutputs.put(txHash, outScrAddrs)
+
+         prevOuts = []
+         for txin in tx.inputs:
+            prevHash = txin.outpoint.txHash
+            if prevHash == '\x00'*32:
+               continue
+            prevOuts.append([prevHash, txin.outpoint.txOutIndex])
+            prevHashes.add(prevHash)
+         parsedList.append([txHash, outScrAddrs, prevOuts])
+
+      prevOutMap = {}
+      lookup = []
+      for prevHash in prevHashes:
+         outScrAddrs = self.recentOutputs.get(prevHash)
+         if outScrAddrs is None:
+            lookup.append(prevHash)
+         else:
+            prevOutMap[prevHash] = outScrAddrs
+
+      if lookup:
+         try:
+            factsMap = TheTxFactsCache.getTxFactsBatch(lookup)
+         except:
+            LOGEXCEPT('Could not look up outputs spent by zero-conf tx')
+            factsMap = {}
+         for prevHash,facts in factsMap.iteritems():
+            prevOutMap[prevHash] = [out[0] for out in facts.outputs]
+
+      allOwners = None
+      affectedIDs = set()
+      txOwnerList = []
+      for txHash,outScrAddrs,prevOuts in parsedList:
+         scrAddrList = list(outScrAddrs)
+         for prevHash,prevIndex in prevOuts:
+            prevScrAddrs = prevOutMap.get(prevHash)
+            if prevScrAddrs is None or prevIndex >= len(prevScrAddrs):
+               if allOwners is None:
+                  allOwners = self.scrAddrIndex.getAllOwners()
+               scrAddrList = None
+               break
+            scrAddrList.append(prevScrAddrs[prevIndex])
+
+         if scrAddrList is None:
+            owners = set(allOwners)
+         else:
+            owners = self.scrAddrIndex.getOwnersForList(scrAddrList)
+         affectedIDs.update(owners)
+         txOwnerList.append([txHash, owners])
+
+      return affectedIDs, txOwnerList
+
+
 #############################################################################
 def getFeeForTx(txHash):
    if TheBDM.getBDMState()=='BlockchainReady':
-      if not TheBDM.hasTxWithHash(txHash):
+      facts = TheTxFactsCache.getTxFacts(txHash)
+      if facts is None:
          LOGERROR('Attempted to get fee for tx we don\'t have...?  %s', \
                                              binary_to_hex(txHash,BIGENDIAN))
          return 0
-      txref = TheBDM.getTxByHash(txHash)
-      valIn, valOut = 0,0
-      for i in range(txref.getNumTxIn()):
-         valIn += TheBDM.getSentValue(txref.getTxInCopy(i))
-      for i in range(txref.getNumTxOut()):
-         valOut += txref.getTxOutCopy(i).getValue()
-      return valIn - valOut
+      return facts.fee
 
 
 #############################################################################
@@ -2783,28 +3387,296 @@ def determineSentToSelfAmt(le, wlt):
    """
    amt = 0
    if TheBDM.isInitialized() and le.isSentToSelf():
-      txref = TheBDM.getTxByHash(le.getTxHash())
-      if not txref.isInitialized():
+      facts = TheTxFactsCache.getTxFacts(le.getTxHash())
+      if facts is None:
          return (0, 0)
-      if txref.getNumTxOut()==1:
-         return (txref.getTxOutCopy(0).getValue(), -1)
+      if len(facts.outputs)==1:
+         return (facts.outputs[0][1], -1)
       maxChainIndex = -5
       txOutChangeVal = 0
       changeIndex = -1
-      valSum = 0
-      for i in range(txref.getNumTxOut()):
-         valSum += txref.getTxOutCopy(i).getValue()
-         addr160 = CheckHash160(txref.getTxOutCopy(i).getScrAddressStr())
+      for i,(scrAddr,val) in enumerate(facts.outputs):
+         addr160 = CheckHash160(scrAddr)
          addr    = wlt.getAddrByHash160(addr160)
          if addr and addr.chainIndex > maxChainIndex:
             maxChainIndex = addr.chainIndex
-            txOutChangeVal = txref.getTxOutCopy(i).getValue()
+            txOutChangeVal = val
             changeIndex = i
 
-      amt = valSum - txOutChangeVal
+      amt = facts.valueOut - txOutChangeVal
    return (amt, changeIndex)
 
 
+################################################################################
+class LedgerEntrySnapshot(object):
+   """
+   Python-side copy of a C++ LedgerEntry.  Entries handed out by the SWIG
+   ledger vectors point into memory the BDM reallocates whenever it
+   updates the wallet, so anything kept across updates has to be copied.
+   Same accessors as LedgerEntry, so it can be passed to the usual helpers.
+   """
+   __slots__ = ('value', 'blockNum', 'txHash', 'index', 'txTime', \
+                'coinbase', 'sentToSelf', 'changeBack', 'valid')
+
+   def __init__(self, le):
+      self.value      = le.getValue()
+      self.blockNum   = le.getBlockNum()
+      self.txHash     = le.getTxHash()
+      self.index      = le.getIndex()
+      self.txTime     = le.getTxTime()
+      self.coinbase   = le.isCoinbase()
+      self.sentToSelf = le.isSentToSelf()
+      self.changeBack = le.isChangeBack()
+      self.valid      = le.isValid()
+
+   def getValue(self):     return self.value
+   def getBlockNum(self):  return self.blockNum
+   def getTxHash(self):    return self.txHash
+   def getIndex(self):     return self.index
+   def getTxTime(self):    return self.txTime
+   def isValid(self):      return self.valid
+   def isCoinbase(self):   return self.coinbase
+   def isSentToSelf(self): return self.sentToSelf
+   def isChangeBack(self): return self.changeBack
+
+   def getSortKey(self):
+      return (self.blockNum, self.index)
+
+
+################################################################################
+class WalletLedgerIndex(object):
+   """
+   The confirmed ledger of one C++ wallet (or lockbox wallet), kept on the
+   Python side in (block, tx index) order.  refresh() only copies entries
+   added since the last call, so it is cheap to run after every
+   updateWalletsAfterScan.  If the C++ ledger shrank or the last entry we
+   saw moved (a reorg), the index is rebuilt from scratch.
+
+   Pages are fetched either by offset, like the old from_tx arguments, or
+   by cursor.  A cursor names the last entry of the previous page, so a
+   client walking the whole ledger doesn't skip or repeat entries when
+   new blocks arrive in between.  Zero-conf entries always come after the
+   confirmed ones and are read fresh from the wallet on every request.
+   """
+
+   #############################################################################
+   def __init__(self, cppWallet):
+      self.cppWallet = cppWallet
+      self.entries = []
+      self.keys = []
+      self.numRebuilds = 0
+      self.refresh()
+
+   #############################################################################
+   def refresh(self):
+      """
+      Returns the number of entries added (or re-added, after a rebuild)
+      """
+      ledger = self.cppWallet.getTxLedger()
+      nNew = len(ledger)
+      nOld = len(self.entries)
+      if nOld > 0:
+         lastSeen = self.entries[-1]
+         if nNew < nOld or \
+            not ledger[nOld-1].getTxHash() == lastSeen.getTxHash() or \
+            not ledger[nOld-1].getBlockNum() == lastSeen.getBlockNum():
+            LOGINFO('Ledger changed below its tip, rebuilding ledger index')
+            self.entries = []
+            self.keys = []
+            self.numRebuilds += 1
+            nOld = 0
+
+      for i in range(nOld, nNew):
+         le = LedgerEntrySnapshot(ledger[i])
+         self.entries.append(le)
+         self.keys.append(le.getSortKey())
+
+      return nNew - nOld
+
+   #############################################################################
+   def getNumEntries(self, withZeroConf=True):
+      nZC = len(self.cppWallet.getZeroConfLedger()) if withZeroConf else 0
+      return len(self.entries) + nZC
+
+   #############################################################################
+   def getCursorForEntry(self, le):
+      return '%d:%d' % le.getSortKey()
+
+   #############################################################################
+   def getPage(self, count, start=0, cursor=None, withZeroConf=True):
+      """
+      Returns (entryList, nextCursor).  If cursor is given, the page starts
+      right after the entry it names and start is ignored.  nextCursor
+      names the last confirmed entry of the page:  zero-conf entries have
+      no stable position yet, so they are returned again on the next page
+      until they make it into a block.
+      """
+      count = max(int(count), 0)
+      if cursor:
+         try:
+            blkNum, txIndex = [int(x) for x in cursor.split(':')]
+         except ValueError:
+            raise ValueError('Invalid ledger cursor: "%s"' % cursor)
+         start = bisect.bisect_right(self.keys, (blkNum, txIndex))
+      else:
+         start = max(int(start), 0)
+
+      page = self.entries[start:start+count]
+      if withZeroConf and len(page) < count:
+         zcLedger = self.cppWallet.getZeroConfLedger()
+         zcStart = max(start - len(self.entries), 0)
+         zcEnd = min(zcStart + count - len(page), len(zcLedger))
+         for i in range(zcStart, zcEnd):
+            page.append(LedgerEntrySnapshot(zcLedger[i]))
+
+      nextCursor = cursor or ''
+      for le in reversed(page):
+         if not le.getBlockNum()==UINT32_MAX:
+            nextCursor = self.getCursorForEntry(le)
+            break
+      return (page, nextCursor)
+
+
+################################################################################
+class MergedLedger(object):
+   """
+   The ledgers of several wallets and lockboxes merged into one list, kept
+   sorted by whatever the caller displays them by.  update() only pulls the
+   per-wallet deltas out of WalletLedgerIndex objects and inserts them with
+   bisect, instead of re-reading and re-sorting every entry each time a
+   block or zero-conf tx comes in.
+
+   keyFunc(wltID, le) must return a key unique to the entry.  Keys that
+   depend on more than the entry itself (wallet names, comments) can change
+   behind our back, so pass stableKeys=False for those and the whole list
+   is re-keyed and re-sorted on every update.
+   """
+
+   #############################################################################
+   def __init__(self):
+      self.reset()
+
+   #############################################################################
+   def reset(self):
+      self.ledgerIndexes = {}
+      self.rebuildCounts = {}
+      self.zcEntries     = {}
+      self.keys          = []
+      self.entries       = []
+      self.sortCol       = None
+      self.reverse       = False
+
+   #############################################################################
+   def __len__(self):
+      return len(self.entries)
+
+   #############################################################################
+   def update(self, cppWltMap, sortCol, keyFunc, reverse=False, stableKeys=True):
+      """
+      cppWltMap maps the ID of each wallet/lockbox to merge to its C++
+      wallet.  Returns the set of IDs whose ledgers changed, including the
+      ones added to or dropped from the list.
+      """
+      changed = set()
+      dropIDs = set()
+      addList = []
+      removeList = []
+
+      for wltID,ledgerIndex in self.ledgerIndexes.items():
+         if not cppWltMap.get(wltID) is ledgerIndex.cppWallet:
+            del self.ledgerIndexes[wltID]
+            dropIDs.add(wltID)
+
+      for wltID,cppWlt in cppWltMap.iteritems():
+         ledgerIndex = self.ledgerIndexes.get(wltID)
+         if ledgerIndex is None:
+            ledgerIndex = WalletLedgerIndex(cppWlt)
+            self.ledgerIndexes[wltID] = ledgerIndex
+            self.rebuildCounts[wltID] = ledgerIndex.numRebuilds
+            self.zcEntries[wltID] = {}
+            addList.extend([wltID, le] for le in ledgerIndex.entries)
+            changed.add(wltID)
+         else:
+            nOld = len(ledgerIndex.entries)
+            nAdded = ledgerIndex.refresh()
+            if not ledgerIndex.numRebuilds==self.rebuildCounts[wltID]:
+               # Reorg:  drop everything we had for it and start over
+               self.rebuildCounts[wltID] = ledgerIndex.numRebuilds
+               self.zcEntries[wltID] = {}
+               dropIDs.add(wltID)
+               addList.extend([wltID, le] for le in ledgerIndex.entries)
+               changed.add(wltID)
+            elif nAdded > 0:
+               addList.extend([wltID, le] for le in ledgerIndex.entries[nOld:])
+               changed.add(wltID)
+
+         # Zero-conf ledgers are small, just diff them against the last call
+         oldZC = self.zcEntries[wltID]
+         newZC = {}
+         for le in cppWlt.getZeroConfLedger():
+            zcKey = (le.getTxHash(), le.isValid())
+            if zcKey in oldZC:
+               newZC[zcKey] = oldZC.pop(zcKey)
+            else:
+               newZC[zcKey] = LedgerEntrySnapshot(le)
+               addList.append([wltID, newZC[zcKey]])
+               changed.add(wltID)
+
+         if len(oldZC) > 0:
+            removeList.extend([wltID, le] for le in oldZC.itervalues())
+            changed.add(wltID)
+         self.zcEntries[wltID] = newZC
+
+      for wltID in dropIDs:
+         if not wltID in cppWltMap:
+            self.rebuildCounts.pop(wltID, None)
+            self.zcEntries.pop(wltID, None)
+      changed.update(dropIDs)
+
+      nDelta = len(addList) + len(removeList)
+      if not stableKeys or not sortCol==self.sortCol or len(dropIDs) > 0 or \
+                                       nDelta > max(len(self.entries)/8, 64):
+         removeSet = set([id(le) for wltID,le in removeList])
+         merged = [e for e in self.entries if not (e[0] in dropIDs or \
+                                                   id(e[1]) in removeSet)]
+         merged.extend(addList)
+         keyed = [(keyFunc(wltID, le), [wltID, le]) for wltID,le in merged]
+         keyed.sort(key=lambda x: x[0])
+         self.keys    = [k for k,e in keyed]
+         self.entries = [e for k,e in keyed]
+      else:
+         for wltID,le in removeList:
+            i = bisect.bisect_left(self.keys, keyFunc(wltID, le))
+            if i < len(self.entries) and self.entries[i][1] is le:
+               del self.keys[i]
+               del self.entries[i]
+            else:
+               LOGWARN('Zero-conf entry missing from merged ledger')
+
+         for wltID,le in addList:
+            key = keyFunc(wltID, le)
+            i = bisect.bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.entries.insert(i, [wltID, le])
+
+      self.sortCol = sortCol
+      self.reverse = reverse
+      return changed
+
+   #############################################################################
+   def getSlice(self, start, stop):
+      """
+      Entries [start, stop) in display order, as [wltID, le] pairs.  The
+      list itself is always kept in ascending key order.
+      """
+      nEntries = len(self.entries)
+      start = min(max(start, 0), nEntries)
+      stop  = min(max(stop, start), nEntries)
+      if not self.reverse:
+         return self.entries[start:stop]
+      return self.entries[nEntries-stop:nEntries-start][::-1]
+
+
 ################################################################################
 #def getUnspentTxOutsForAddrList(addr160List, utxoType='Sweep', startBlk=-1, \
 def getUnspentTxOutsForAddr160List(addr160List, utxoType='Sweep', startBlk=-1, \
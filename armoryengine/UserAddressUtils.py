@@ -8,7 +8,8 @@
 from armoryengine.ArmoryUtils import *
 from armoryengine.MultiSigUtils import readLockboxEntryStr, calcLockboxID, \
                                        isBareLockbox, isP2SHLockbox
-from armoryengine.Transaction import getTxOutScriptType, getMultisigScriptInfo
+from armoryengine.Transaction import getTxOutScriptType, getMultisigScriptInfo, \
+                                     TheScrAddrIndex
 
 #############################################################################
 def getScriptForUserString(userStr, wltMap, lboxList):
@@ -44,10 +45,7 @@ def getScriptForUserString(userStr, wltMap, lboxList):
    """
 
    def getWltIDForScrAddr(scrAddr, walletMap):
-      for iterID,iterWlt in walletMap.iteritems():
-         if iterWlt.hasScrAddr(scrAddr):
-            return iterID
-      return None
+      return TheScrAddrIndex.getOwnerIn(scrAddr, walletMap)
 
    # Now try to figure it out
    try:
@@ -535,6 +535,215 @@ class LedgerDispDelegate(QStyledItemDelegate):
 
 
 
+################################################################################
+class AddrStats(object):
+   """ One row of WalletAddrStatsTable """
+   __slots__ = ('addr160', 'chainIndex', 'balance', 'numTx', 'hasTx', \
+                'firstSeen', 'lastSeen', 'isChange')
+
+   def __init__(self, addr160, chainIndex):
+      self.addr160    = addr160
+      self.chainIndex = chainIndex
+      self.balance    = None
+      self.numTx      = 0
+      self.hasTx      = False
+      self.firstSeen  = -1
+      self.lastSeen   = -1
+      self.isChange   = False
+
+
+################################################################################
+class WalletAddrStatsTable(object):
+   """
+   Balance, tx count, first/last block seen and change flag of every
+   address in one wallet that has been handed out:  chained addresses up to
+   highestUsedChainIndex, and all imported ones (the keypool beyond that is
+   left out, same as the address dialogs always did).  Each address is
+   read from the C++ wallet once; after that refresh() takes the
+   wallet-level ledger delta (new blocks and zero-conf changes), looks up
+   which scrAddrs those tx spend from and pay to in TheTxFactsCache, and
+   re-reads only the addresses they touch.  The address dialogs filter and
+   sort over this table, instead of going to C++ for every address on every
+   reset() and every cell on every repaint.
+
+   Get one through getWalletAddrStats(), so all the views of a wallet share
+   it and it lives as long as the wallet is loaded.
+   """
+
+   #############################################################################
+   def __init__(self, wlt):
+      self.wlt = wlt
+      self.rebuild()
+
+   #############################################################################
+   def rebuild(self):
+      self.cppWallet = self.wlt.cppWallet
+      self.hasBlockchainData = (TheBDM.getBDMState()=='BlockchainReady')
+      self.statsMap = {}
+      self.addr160List = []
+      self.unusedList = []  # [(chainIndex, addr160)] still in the keypool
+      self.nScanned = 0     # how much of wlt.linearAddr160List was looked at
+      self.zcHashes = set()
+      self.ledgerIndex = None
+      if self.hasBlockchainData:
+         self.ledgerIndex = WalletLedgerIndex(self.cppWallet)
+         self.rebuildCount = self.ledgerIndex.numRebuilds
+         self.zcHashes = set([le.getTxHash() for le in \
+                                       self.cppWallet.getZeroConfLedger()])
+      self.addNewAddresses()
+      self.refreshChangeFlags()
+
+   #############################################################################
+   def readAddrStats(self, addr160):
+      stats = self.statsMap[addr160]
+      if not self.hasBlockchainData:
+         return
+
+      scrAddr = Hash160ToScrAddr(addr160)
+      cppAddr = self.cppWallet.getScrAddrObjByKey(scrAddr)
+      ledger = cppAddr.getTxLedger()
+      stats.balance = cppAddr.getFullBalance()
+      stats.numTx = len(ledger) + len(cppAddr.getZeroConfLedger())
+      stats.hasTx = len(ledger) > 0
+      if stats.hasTx:
+         blkNums = [le.getBlockNum() for le in ledger]
+         stats.firstSeen = min(blkNums)
+         stats.lastSeen  = max(blkNums)
+      else:
+         stats.firstSeen = stats.lastSeen = -1
+
+   #############################################################################
+   def addNewAddresses(self):
+      wltList = self.wlt.linearAddr160List
+      candidates = list(self.unusedList)
+      if len(wltList) > self.nScanned:
+         # Imported addresses aren't in chainIndexMap (or all share -2)
+         chainIndexOf = dict([(a160,ci) for ci,a160 in \
+                              self.wlt.chainIndexMap.iteritems() if ci >= 0])
+         candidates += [(chainIndexOf.get(a160, -2), a160) \
+                                       for a160 in wltList[self.nScanned:]]
+         self.nScanned = len(wltList)
+         self.lastScanned160 = wltList[-1]
+
+      highestUsed = self.wlt.highestUsedChainIndex
+      newList = []
+      self.unusedList = []
+      for chainIndex,addr160 in candidates:
+         if chainIndex > highestUsed:
+            self.unusedList.append((chainIndex, addr160))
+            continue
+         chainIndex = self.wlt.addrMap[addr160].chainIndex
+         self.statsMap[addr160] = AddrStats(addr160, chainIndex)
+         self.readAddrStats(addr160)
+         newList.append(addr160)
+      self.addr160List.extend(newList)
+      return newList
+
+   #############################################################################
+   def refreshChangeFlags(self):
+      # Plain dict lookups, cheap enough to redo every time:  comments can
+      # be edited from any number of dialogs
+      commentsMap = self.wlt.commentsMap
+      for addr160,stats in self.statsMap.iteritems():
+         stats.isChange = (commentsMap.get(addr160)==CHANGE_ADDR_DESCR_STRING)
+
+   #############################################################################
+   def refresh(self):
+      """
+      Returns the list of addr160s whose stats were re-read
+      """
+      bdmReady = (TheBDM.getBDMState()=='BlockchainReady')
+      wltList = self.wlt.linearAddr160List
+      nSeen = self.nScanned
+      if not self.cppWallet is self.wlt.cppWallet or \
+         not bdmReady==self.hasBlockchainData or \
+         len(wltList) < nSeen or \
+         (nSeen > 0 and not wltList[nSeen-1]==self.lastScanned160):
+         # Wallet re-read from file (deleted import), or BDM came up/went away
+         self.rebuild()
+         return list(self.addr160List)
+
+      changed = self.addNewAddresses()
+      if bdmReady:
+         nOld = len(self.ledgerIndex.entries)
+         self.ledgerIndex.refresh()
+         if not self.ledgerIndex.numRebuilds==self.rebuildCount:
+            # Reorg:  just read everything again
+            self.rebuild()
+            return list(self.addr160List)
+
+         txHashes = set([le.getTxHash() for le in \
+                                          self.ledgerIndex.entries[nOld:]])
+         zcHashes = set([le.getTxHash() for le in \
+                                       self.cppWallet.getZeroConfLedger()])
+         txHashes.update(zcHashes.symmetric_difference(self.zcHashes))
+         self.zcHashes = zcHashes
+
+         touched = set()
+         if txHashes:
+            factsMap = TheTxFactsCache.getTxFactsBatch(list(txHashes))
+            if len(factsMap) < len(txHashes):
+               LOGWARN('Missing tx data, re-reading all address stats')
+               touched = set(self.addr160List)
+            for facts in factsMap.itervalues():
+               for scrAddr,value in (facts.inputs or []) + facts.outputs:
+                  if scrAddr[1:] in self.statsMap:
+                     touched.add(scrAddr[1:])
+
+         for addr160 in touched:
+            self.readAddrStats(addr160)
+         changed.extend(touched)
+
+      self.refreshChangeFlags()
+      return changed
+
+   #############################################################################
+   def getStats(self, addr160):
+      return self.statsMap.get(addr160)
+
+   #############################################################################
+   def getFilteredList(self, notEmpty=False, noChange=False, usedOnly=False):
+      """
+      Returns addr160s in wallet order.  The balance and usage filters are
+      ignored until we have blockchain data, same as before.
+      """
+      statsList = [self.statsMap[a160] for a160 in self.addr160List]
+      if notEmpty and self.hasBlockchainData:
+         statsList = [s for s in statsList if s.balance>0]
+      if noChange:
+         statsList = [s for s in statsList if not s.isChange]
+      if usedOnly and self.hasBlockchainData:
+         statsList = [s for s in statsList if s.numTx>0]
+      return [s.addr160 for s in statsList]
+
+
+# One stats table per loaded wallet, shared by every view of it
+WALLET_ADDR_STATS = {}
+
+################################################################################
+def getWalletAddrStats(wlt):
+   table = WALLET_ADDR_STATS.get(wlt.uniqueIDB58)
+   if table is None or not table.wlt is wlt:
+      table = WalletAddrStatsTable(wlt)
+      WALLET_ADDR_STATS[wlt.uniqueIDB58] = table
+   else:
+      table.refresh()
+   return table
+
+################################################################################
+def refreshWalletAddrStats(walletMap):
+   """
+   Call after updateWalletsAfterScan (and after new zero-conf tx).  Only
+   wallets whose address view has been opened have a table to refresh;
+   tables of wallets no longer in walletMap are dropped.
+   """
+   for wltID in WALLET_ADDR_STATS.keys():
+      if not wltID in walletMap:
+         del WALLET_ADDR_STATS[wltID]
+      else:
+         WALLET_ADDR_STATS[wltID].refresh()
+
+
 ################################################################################
 class WalletAddrDispModel(QAbstractTableModel):
    
@@ -547,6 +756,9 @@ class WalletAddrDispModel(QAbstractTableModel):
       self.usedOnly = False
       self.notEmpty = False
 
+      self.sortCol = ADDRESSCOLS.ChainIdx
+      self.sortOrder = Qt.AscendingOrder
+
       self.filterAddrList()
       
 
@@ -558,21 +770,37 @@ class WalletAddrDispModel(QAbstractTableModel):
 
 
    def filterAddrList(self):
-      addrList = self.wlt.getLinearAddrList()
+      self.addrStats = getWalletAddrStats(self.wlt)
+      self.addr160List = self.addrStats.getFilteredList(self.notEmpty, \
+                                                        self.noChange, \
+                                                        self.usedOnly)
+      self.sortAddrList()
 
-      if self.notEmpty and TheBDM.getBDMState()=='BlockchainReady':
-         hasBalance = lambda a: (self.wlt.getAddrBalance(a.getAddr160(), 'Full')>0)
-         addrList = filter(hasBalance, addrList)
 
-      if self.noChange:
-         notChange = lambda a: (self.wlt.getCommentForAddress(a.getAddr160()) != CHANGE_ADDR_DESCR_STRING)
-         addrList = filter(notChange, addrList)
+   def sortAddrList(self):
+      COL = ADDRESSCOLS
+      getStats = self.addrStats.getStats
+      if self.sortCol==COL.Address:
+         keyFunc = lambda a160: hash160_to_addrStr(a160).lower()
+      elif self.sortCol==COL.Comment:
+         keyFunc = lambda a160: self.wlt.commentsMap.get(a160, '')
+      elif self.sortCol==COL.NumTx:
+         keyFunc = lambda a160: getStats(a160).numTx
+      elif self.sortCol==COL.Balance:
+         keyFunc = lambda a160: getStats(a160).balance
+      else:
+         keyFunc = lambda a160: getStats(a160).chainIndex
 
-      if self.usedOnly and TheBDM.getBDMState()=='BlockchainReady':
-         isUsed = lambda a: (len(self.wlt.getAddrTxLedger(a.getAddr160(), 'Full')) > 0)
-         addrList = filter(isUsed, addrList)
-         
-      self.addr160List = [a.getAddr160() for a in addrList]
+      self.addr160List.sort(key=keyFunc, \
+                            reverse=(self.sortOrder==Qt.DescendingOrder))
+
+
+   def sort(self, col, order=Qt.AscendingOrder):
+      self.emit(SIGNAL('layoutAboutToBeChanged()'))
+      self.sortCol = col
+      self.sortOrder = order
+      self.sortAddrList()
+      self.emit(SIGNAL('layoutChanged()'))
 
 
    @TimeThisFunction
@@ -593,54 +821,49 @@ class WalletAddrDispModel(QAbstractTableModel):
       row,col = index.row(), index.column()
       if row>=len(self.addr160List):
          return QVariant('')
-      addr = self.wlt.addrMap[self.addr160List[row]]
-      addr160 = addr.getAddr160()
-      addrB58 = addr.getAddrStr()
-      chainIdx = addr.chainIndex+1  # user must get 1-indexed
+      addr160 = self.addr160List[row]
+      stats = self.addrStats.getStats(addr160)
+      chainIdx = stats.chainIndex+1  # user must get 1-indexed
+      hasBalance = (stats.balance is not None and \
+                    TheBDM.getBDMState()=='BlockchainReady')
       if role==Qt.DisplayRole:
          if col==COL.Address: 
-            return QVariant( addrB58 )
+            return QVariant( hash160_to_addrStr(addr160) )
          if col==COL.Comment: 
             if addr160 in self.wlt.commentsMap:
                return QVariant( self.wlt.commentsMap[addr160] )
             else:
                return QVariant('')
          if col==COL.NumTx: 
-            cppAddr = self.wlt.cppWallet.getScrAddrObjByKey(Hash160ToScrAddr(addr160))
-            return QVariant( len(cppAddr.getTxLedger()) + \
-                             len(cppAddr.getZeroConfLedger()))
+            return QVariant( stats.numTx )
          if col==COL.ChainIdx:
-            if self.wlt.addrMap[addr160].chainIndex==-2:
+            if stats.chainIndex==-2:
                return QVariant('Imported')
             else:
                return QVariant(chainIdx)
          if col==COL.Balance: 
-            if not TheBDM.getBDMState()=='BlockchainReady':
+            if not hasBalance:
                return QVariant('(...)')
-            cppAddr = self.wlt.cppWallet.getScrAddrObjByKey(Hash160ToScrAddr(addr160))
-            return QVariant( coin2str(cppAddr.getFullBalance(), maxZeros=2) )
+            return QVariant( coin2str(stats.balance, maxZeros=2) )
       elif role==Qt.TextAlignmentRole:
          if col in (COL.Address, COL.Comment, COL.ChainIdx):
             return QVariant(int(Qt.AlignLeft | Qt.AlignVCenter))
          elif col in (COL.NumTx,):
             return QVariant(int(Qt.AlignHCenter | Qt.AlignVCenter))
          elif col in (COL.Balance,):
-            if not TheBDM.getBDMState()=='BlockchainReady':
+            if not hasBalance:
                return QVariant(int(Qt.AlignHCenter | Qt.AlignVCenter))
             else:
                return QVariant(int(Qt.AlignRight | Qt.AlignVCenter))
       elif role==Qt.ForegroundRole:
          if col==COL.Balance:
-            if not TheBDM.getBDMState()=='BlockchainReady':
+            if not hasBalance:
                return QVariant(Colors.Foreground)
-            cppAddr = self.wlt.cppWallet.getScrAddrObjByKey(Hash160ToScrAddr(addr160))
-            val = cppAddr.getFullBalance()
-            if   val>0: return QVariant(Colors.TextGreen)
-            else:       return QVariant(Colors.Foreground)
+            if   stats.balance>0: return QVariant(Colors.TextGreen)
+            else:                 return QVariant(Colors.Foreground)
       elif role==Qt.FontRole:
-         hasTx = len(self.wlt.cppWallet.getScrAddrObjByKey(Hash160ToScrAddr(addr160)).getTxLedger())>0
-         cmt = str(self.index(index.row(),COL.Comment).data().toString())
-         isChange = (cmt==CHANGE_ADDR_DESCR_STRING)
+         hasTx = stats.hasTx
+         isChange = stats.isChange
 
          if col==COL.Balance:
             return GETFONT('Fixed',bold=hasTx)
@@ -652,8 +875,7 @@ class WalletAddrDispModel(QAbstractTableModel):
             return GETFONT('Var',bold=doBold, italic=doItalic)
       elif role==Qt.ToolTipRole:
          if col==COL.ChainIdx:
-            cmt = str(self.index(index.row(),COL.ChainIdx).data().toString())
-            if cmt.strip().lower().startswith('imp'):
+            if stats.chainIndex==-2:
                return QVariant('<u></u>This is an imported address. Imported '
                                'addresses are not protected by regular paper '
                                'backups.  You must use the "Backup Individual '
@@ -661,18 +883,15 @@ class WalletAddrDispModel(QAbstractTableModel):
             else:
                return QVariant('<u></u>The order that this address was '
                                'generated in this wallet')
-         cmt = str(self.index(index.row(),COL.Comment).data().toString())
-         if cmt==CHANGE_ADDR_DESCR_STRING:
+         if stats.isChange:
             return QVariant('This address was created by Armory to '
                             'receive change-back-to-self from an oversized '
                             'transaction.')
       elif role==Qt.BackgroundColorRole:
-         if not TheBDM.getBDMState()=='BlockchainReady':
+         if not hasBalance:
             return QVariant( Colors.TblWltOther )
 
-         cppAddr = self.wlt.cppWallet.getScrAddrObjByKey(Hash160ToScrAddr(addr160))
-         val = cppAddr.getFullBalance()
-         if val>0:
+         if stats.balance>0:
             return QVariant( Colors.SlightGreen )
          else:
             return QVariant( Colors.TblWltOther )
@@ -702,26 +921,13 @@ class WalletAddrDispModel(QAbstractTableModel):
 ################################################################################
 class WalletAddrSortProxy(QSortFilterProxyModel):
    """      
-   Acts as a proxy that re-maps indices to the table view so that data 
-   appears sorted, without actually touching the model
+   Sorting is handed to WalletAddrDispModel, which sorts its address list
+   with one key per row from the stats table.  Having Qt call lessThan()
+   n*log(n) times, each parsing the display strings back, took seconds on
+   wallets with many thousands of addresses.
    """      
-   def lessThan(self, idxLeft, idxRight):
-      COL = ADDRESSCOLS
-      thisCol  = self.sortColumn()
-      strLeft  = str(self.sourceModel().data(idxLeft).toString())
-      strRight = str(self.sourceModel().data(idxRight).toString())
-      if thisCol==COL.Address:
-         return (strLeft.lower() < strRight.lower())
-      elif thisCol==COL.Comment:
-         return (strLeft < strRight)
-      elif thisCol==COL.Balance:
-         return (float(strLeft.strip()) < float(strRight.strip()))
-      elif thisCol==COL.ChainIdx:
-         left = -2 if strLeft =='Imported' else int(strLeft)
-         rght = -2 if strRight=='Imported' else int(strRight)
-         return (left<rght)
-      else:
-         return super(WalletAddrSortProxy, self).lessThan(idxLeft, idxRight)
+   def sort(self, col, order=Qt.AscendingOrder):
+      self.sourceModel().sort(col, order)
          
 
 ################################################################################
@@ -506,6 +506,28 @@ void BtcWallet::addScrAddress_5_(HashString    scrAddr,
                           lastBlockNum,  lastTimestamp); 
 }
 
+/////////////////////////////////////////////////////////////////////////////
+void BtcWallet::addScrAddressBulk(BinaryData const & packedList)
+{
+   BinaryRefReader brr(packedList);
+   while(brr.getSizeRemaining() > 0)
+   {
+      uint8_t sz = brr.get_uint8_t();
+      if(brr.getSizeRemaining() < (uint32_t)sz + 16)
+      {
+         LOGERR << "Truncated scrAddr list passed to addScrAddressBulk";
+         return;
+      }
+
+      BinaryData scrAddr = brr.get_BinaryData(sz);
+      uint32_t firstTime = brr.get_uint32_t();
+      uint32_t firstBlk  = brr.get_uint32_t();
+      uint32_t lastTime  = brr.get_uint32_t();
+      uint32_t lastBlk   = brr.get_uint32_t();
+      addScrAddress_5_(scrAddr, firstTime, firstBlk, lastTime, lastBlk);
+   }
+}
+
 /////////////////////////////////////////////////////////////////////////////
 bool BtcWallet::hasScrAddress(HashString const & scrAddr) const
 {
@@ -372,6 +372,12 @@ public:
                       uint32_t      lastTimestamp,
                       uint32_t      lastBlockNum);
 
+   // Register many addresses in one call (avoids a SWIG round-trip per
+   // address when loading big wallets).  packedList is a concatenation of
+   // [uint8 len | scrAddr | firstTime | firstBlk | lastTime | lastBlk], the
+   // four trailing fields are LE uint32, same meaning as addScrAddress_5_
+   void addScrAddressBulk(BinaryData const & packedList);
+
    // Why did we not just name this "hasScrAddr" like everything else?
    bool hasScrAddress(BinaryData const & scrAddr) const;
 
@@ -10,6 +10,10 @@
 #include "integer.h"
 #include "oids.h"
 
+#if !defined(_MSC_VER) && !defined(__MINGW32__)
+   #include <pthread.h>
+#endif
+
 //#include <openssl/ec.h>
 //#include <openssl/ecdsa.h>
 //#include <openssl/obj_mac.h>
@@ -1030,3 +1034,170 @@ SecureBinaryData CryptoECDSA::UncompressPoint(SecureBinaryData const & pubKey33)
    EC_KEY_free(pubKey);
    return SecureBinaryData(sigSpace.getPtr(), sigSize);
    */
+
+
+
+////////////////////////////////////////////////////////////////////////////////
+////////////////////////////////////////////////////////////////////////////////
+//
+// ECDSABatch methods
+//
+////////////////////////////////////////////////////////////////////////////////
+////////////////////////////////////////////////////////////////////////////////
+struct ECDSABatchThreadArgs
+{
+   ECDSABatch* batch;
+   uint32_t    first;
+   uint32_t    step;
+};
+
+#if defined(_MSC_VER) || defined(__MINGW32__)
+static DWORD WINAPI ecdsaBatchThread(LPVOID arg)
+#else
+static void* ecdsaBatchThread(void* arg)
+#endif
+{
+   ECDSABatchThreadArgs* args = (ECDSABatchThreadArgs*)arg;
+   args->batch->runJobs(args->first, args->step);
+   return 0;
+}
+
+/////////////////////////////////////////////////////////////////////////////
+uint32_t ECDSABatch::addSignJob(SecureBinaryData const & binToSign, 
+                                SecureBinaryData const & binPrivKey)
+{
+   msgs_.push_back(binToSign);
+   keys_.push_back(binPrivKey);
+   pubKeys_.push_back(SecureBinaryData());
+   sigs_.push_back(SecureBinaryData());
+   isSign_.push_back(1);
+   verified_.push_back(0);
+   failed_.push_back(0);
+   errors_.push_back(string(""));
+   return (uint32_t)msgs_.size() - 1;
+}
+
+/////////////////////////////////////////////////////////////////////////////
+uint32_t ECDSABatch::addVerifyJob(SecureBinaryData const & binMessage, 
+                                  SecureBinaryData const & binSignature,
+                                  SecureBinaryData const & pubkey65B)
+{
+   msgs_.push_back(binMessage);
+   keys_.push_back(SecureBinaryData());
+   pubKeys_.push_back(pubkey65B);
+   sigs_.push_back(binSignature);
+   isSign_.push_back(0);
+   verified_.push_back(0);
+   failed_.push_back(0);
+   errors_.push_back(string(""));
+   return (uint32_t)msgs_.size() - 1;
+}
+
+/////////////////////////////////////////////////////////////////////////////
+void ECDSABatch::runJob(uint32_t i)
+{
+   try
+   {
+      if(isSign_[i])
+         sigs_[i] = CryptoECDSA().SignData(msgs_[i], keys_[i]);
+      else
+         verified_[i] = CryptoECDSA().VerifyData(msgs_[i], 
+                                                 sigs_[i], 
+                                                 pubKeys_[i]) ? 1 : 0;
+   }
+   catch(std::exception const & e)
+   {
+      failed_[i] = 1;
+      errors_[i] = string(e.what());
+   }
+   catch(...)
+   {
+      failed_[i] = 1;
+      errors_[i] = string("Unknown error in ECDSA job");
+   }
+}
+
+/////////////////////////////////////////////////////////////////////////////
+void ECDSABatch::runJobs(uint32_t first, uint32_t step)
+{
+   for(uint32_t i=first; i<msgs_.size(); i+=step)
+      runJob(i);
+}
+
+/////////////////////////////////////////////////////////////////////////////
+void ECDSABatch::run(uint32_t numThreads)
+{
+   uint32_t nJobs = (uint32_t)msgs_.size();
+
+   // Crypto++ sets up the curve parameters the first time they are used.
+   // Run one job here, so the threads don't race on that
+   if(nJobs > 0)
+      runJob(0);
+
+   if(nJobs > 1)
+   {
+      uint32_t nThreads = min(max(numThreads, (uint32_t)1), nJobs-1);
+      vector<ECDSABatchThreadArgs> args(nThreads);
+      for(uint32_t t=0; t<nThreads; t++)
+      {
+         args[t].batch = this;
+         args[t].first = 1 + t;
+         args[t].step  = nThreads;
+      }
+
+      // This thread takes the first share of the jobs itself.  If a thread
+      // can't be started, its share is run here as well
+#if defined(_MSC_VER) || defined(__MINGW32__)
+      vector<HANDLE> threads;
+      for(uint32_t t=1; t<nThreads; t++)
+      {
+         HANDLE h = CreateThread(NULL, 0, ecdsaBatchThread, &args[t], 0, NULL);
+         if(h == NULL)
+            runJobs(args[t].first, args[t].step);
+         else
+            threads.push_back(h);
+      }
+      runJobs(args[0].first, args[0].step);
+      for(uint32_t t=0; t<threads.size(); t++)
+      {
+         WaitForSingleObject(threads[t], INFINITE);
+         CloseHandle(threads[t]);
+      }
+#else
+      vector<pthread_t> threads;
+      for(uint32_t t=1; t<nThreads; t++)
+      {
+         pthread_t tid;
+         if(pthread_create(&tid, NULL, ecdsaBatchThread, &args[t]) != 0)
+            runJobs(args[t].first, args[t].step);
+         else
+            threads.push_back(tid);
+      }
+      runJobs(args[0].first, args[0].step);
+      for(uint32_t t=0; t<threads.size(); t++)
+         pthread_join(threads[t], NULL);
+#endif
+   }
+
+   // Done with the private keys
+   for(uint32_t i=0; i<keys_.size(); i++)
+      keys_[i].destroy();
+}
+
+/////////////////////////////////////////////////////////////////////////////
+void ECDSABatch::clear(void)
+{
+   for(uint32_t i=0; i<keys_.size(); i++)
+      keys_[i].destroy();
+   for(uint32_t i=0; i<sigs_.size(); i++)
+      sigs_[i].destroy();
+
+   msgs_.clear();
+   keys_.clear();
+   pubKeys_.clear();
+   sigs_.clear();
+   isSign_.clear();
+   verified_.clear();
+   failed_.clear();
+   errors_.clear();
+}
@@ -442,4 +442,62 @@ public:
 };
 
 
+////////////////////////////////////////////////////////////////////////////////
+// A list of ECDSA signing and verification jobs, run over several threads
+// by run().  Private keys go in and signatures come out as SecureBinaryData,
+// so signing a large transaction in parallel never puts key material in a
+// Python string or another process.  From python, SWIG (built with -threads)
+// releases the GIL for all of run().  The private keys are destroyed as
+// soon as run() is done with them.
+class ECDSABatch
+{
+public:
+   ECDSABatch(void) {}
+   ~ECDSABatch(void) { clear(); }
+
+   /////////////////////////////////////////////////////////////////////////////
+   // Both return the index of the new job.  Pass the UN-HASHED message, the
+   // same as for CryptoECDSA::SignData/VerifyData
+   uint32_t addSignJob(SecureBinaryData const & binToSign, 
+                       SecureBinaryData const & binPrivKey);
+
+   uint32_t addVerifyJob(SecureBinaryData const & binMessage, 
+                         SecureBinaryData const & binSignature,
+                         SecureBinaryData const & pubkey65B);
+
+   /////////////////////////////////////////////////////////////////////////////
+   void run(uint32_t numThreads);
+
+   /////////////////////////////////////////////////////////////////////////////
+   uint32_t getNumJobs(void) const { return (uint32_t)msgs_.size(); }
+   bool     isSignJob(uint32_t i) const { return isSign_[i] != 0; }
+   bool     jobFailed(uint32_t i) const { return failed_[i] != 0; }
+   string   getError(uint32_t i) const { return errors_[i]; }
+   bool     isVerified(uint32_t i) const { return verified_[i] != 0; }
+   SecureBinaryData getSignature(uint32_t i) const { return sigs_[i]; }
+
+   /////////////////////////////////////////////////////////////////////////////
+   // Wipes everything, keys and signatures included
+   void clear(void);
+
+   /////////////////////////////////////////////////////////////////////////////
+   // Runs jobs first, first+step, first+2*step...  Used by the threads
+   void runJobs(uint32_t first, uint32_t step);
+
+private:
+   void runJob(uint32_t i);
+
+   // One entry per job.  Flags are bytes, not vector<bool>, because the
+   // threads write neighbouring entries at the same time
+   vector<SecureBinaryData> msgs_;
+   vector<SecureBinaryData> keys_;
+   vector<SecureBinaryData> pubKeys_;
+   vector<SecureBinaryData> sigs_;
+   vector<uint8_t>          isSign_;
+   vector<uint8_t>          verified_;
+   vector<uint8_t>          failed_;
+   vector<string>           errors_;
+};
+
+
 #endif
@@ -0,0 +1,299 @@
+################################################################################
+#                                                                              #
+# Copyright (C) 2011-2014, Armory Technologies, Inc.                           #
+# Distributed under the GNU Affero General Public License (AGPL v3)            #
+# See LICENSE or http://www.gnu.org/licenses/agpl.html                         #
+#                                                                              #
+################################################################################
+#
+# Coin-selection benchmark and regression harness.
+#
+# Generates reproducible synthetic UTXO sets shaped like a few wallet types we
+# care about, runs the selection engines and fee calculators on them, and
+# reports time, score, fee, input count and change for every run.  Results can
+# be saved as a baseline and later runs compared against it, so that a change
+# that makes selection slower or picks worse coins shows up immediately.
+#
+#    python coinSelectionBench.py --sizes=1000,10000,50000
+#    python coinSelectionBench.py --save-baseline=csbase.json
+#    python coinSelectionBench.py --baseline=csbase.json
+#
+# The exit code is 1 if any run regressed against the baseline.
+#
+################################################################################
+import sys
+import json
+import optparse
+import random
+from collections import OrderedDict
+
+# ArmoryUtils parses sys.argv when imported, so keep our own options out of it
+if __name__ == '__main__':
+   BENCH_ARGV = sys.argv[1:]
+   sys.argv = sys.argv[:1] + ['--nologging']
+   sys.path.append('..')
+
+# CoinSelection and Transaction import each other; Transaction has to go first
+import armoryengine.Transaction
+from armoryengine.ArmoryUtils import ONE_BTC, CENT, RightNow, \
+   hash160_to_p2pkhash_script, pubkeylist_to_multisig_script, \
+   script_to_scrAddr, script_to_p2sh_script
+from armoryengine.CoinSelection import PyUnspentTxOut, PySelectCoinsLegacy, \
+   PySelectCoinsBnB, PyEvalCoinSelect, calcMinSuggestedFees, \
+   calcMinSuggestedFeesNew
+
+
+################################################################################
+def randomBytes(rng, nBytes):
+   return ''.join([chr(rng.randint(0,255)) for i in range(nBytes)])
+
+################################################################################
+def makeUtxo(rng, script, value, numConf):
+   return PyUnspentTxOut(script_to_scrAddr(script), randomBytes(rng, 32),
+                         rng.randint(0,3), long(value), numConf, script)
+
+################################################################################
+def randomConf(rng, zeroConfPct=0.02):
+   if rng.random() < zeroConfPct:
+      return 0
+   return rng.choice([1, 2, 6, 20, 144, 1000, 10000])
+
+
+################################################################################
+def genDustHeavy(rng, numUtxo):
+   """ Mostly sub-cent outputs (faucets, mining payouts) over a few hundred
+       addresses, with an occasional real-sized coin mixed in """
+   scripts = [hash160_to_p2pkhash_script(randomBytes(rng, 20))
+                                                      for i in range(200)]
+   utxos = []
+   for i in range(numUtxo):
+      if rng.random() < 0.9:
+         value = rng.randint(546, 100000)
+      else:
+         value = rng.randint(CENT, ONE_BTC)
+      utxos.append(makeUtxo(rng, rng.choice(scripts), value, randomConf(rng)))
+   return utxos
+
+################################################################################
+def genExchangeHotWallet(rng, numUtxo):
+   """ Customer deposits:  roughly two coins per deposit address, values
+       spread log-uniformly from 1 mBTC to 50 BTC, and a noticeable share of
+       deposits that haven't confirmed yet """
+   scripts = [hash160_to_p2pkhash_script(randomBytes(rng, 20))
+                                          for i in range(max(1, numUtxo/2))]
+   utxos = []
+   for i in range(numUtxo):
+      value = int(10**rng.uniform(5, 9.7))
+      conf = randomConf(rng, zeroConfPct=0.05)
+      utxos.append(makeUtxo(rng, rng.choice(scripts), value, conf))
+   return utxos
+
+################################################################################
+def genManyAddress(rng, numUtxo):
+   """ Every coin sits on its own address (heavy address reuse avoidance) """
+   utxos = []
+   for i in range(numUtxo):
+      script = hash160_to_p2pkhash_script(randomBytes(rng, 20))
+      value = rng.randint(CENT/10, 2*ONE_BTC)
+      utxos.append(makeUtxo(rng, script, value, randomConf(rng)))
+   return utxos
+
+################################################################################
+def genLockboxMultisig(rng, numUtxo):
+   """ Funds held by a handful of 2-of-3 lockboxes, both bare multisig and
+       P2SH-wrapped, so the input-size estimates differ from plain P2PKH """
+   msScripts = []
+   for i in range(10):
+      pubs = ['\x02' + randomBytes(rng, 32) for j in range(3)]
+      msScripts.append(pubkeylist_to_multisig_script(pubs, 2))
+   scripts = msScripts + [script_to_p2sh_script(ms) for ms in msScripts]
+
+   utxos = []
+   for i in range(numUtxo):
+      value = rng.randint(CENT, 10*ONE_BTC)
+      utxos.append(makeUtxo(rng, rng.choice(scripts), value, randomConf(rng)))
+   return utxos
+
+
+UTXO_PROFILES = OrderedDict()
+UTXO_PROFILES['dust']      = genDustHeavy
+UTXO_PROFILES['exchange']  = genExchangeHotWallet
+UTXO_PROFILES['manyaddr']  = genManyAddress
+UTXO_PROFILES['multisig']  = genLockboxMultisig
+
+SELECT_ENGINES = OrderedDict()
+SELECT_ENGINES['legacy'] = lambda utxos, tgt, fee: \
+                                       PySelectCoinsLegacy(utxos, tgt, fee)
+SELECT_ENGINES['bnb']    = lambda utxos, tgt, fee: \
+                                       PySelectCoinsBnB(utxos, tgt, fee)
+
+# Round payment amounts; any larger than half the balance are skipped
+BENCH_TARGETS = [CENT, ONE_BTC/2, 5*ONE_BTC, 40*ONE_BTC]
+
+
+################################################################################
+def generateUtxoSet(profile, numUtxo, seed=0):
+   """ Same (profile, numUtxo, seed) always produces the same UTXO set """
+   rng = random.Random('%s-%d-%d' % (profile, numUtxo, seed))
+   return UTXO_PROFILES[profile](rng, numUtxo)
+
+
+################################################################################
+def timeSelection(selectFunc, utxos, targetOutVal, fee, repeat):
+   """
+   Returns the selection of the first call and the fastest of repeat calls,
+   so one slow run (another process, GC) doesn't show up as a regression
+   """
+   bestTime = None
+   for i in range(max(repeat, 1)):
+      start = RightNow()
+      result = selectFunc(utxos, targetOutVal, fee)
+      elapsed = RightNow() - start
+      if bestTime is None:
+         select = result
+         bestTime = elapsed
+      bestTime = min(bestTime, elapsed)
+   return select, bestTime
+
+################################################################################
+def runSelection(engine, utxos, targetOutVal, recipScript, repeat=1):
+   """
+   One spend, the way armoryd does it:  select with no fee, ask what fee the
+   selection needs, and reselect with that fee if it's non-zero.  Returns a
+   dict with everything we want to track for this run.  Selection times are
+   the best of repeat calls.
+   """
+   selectFunc = SELECT_ENGINES[engine]
+
+   fee = 0
+   select, selectTime = timeSelection(selectFunc, utxos, targetOutVal, fee,
+                                                                     repeat)
+
+   start = RightNow()
+   minFee = calcMinSuggestedFees(select, targetOutVal, fee, 1)[1]
+   calcMinSuggestedFeesNew(select, [[recipScript, targetOutVal]], fee)
+   feeTime = RightNow() - start
+
+   if minFee > fee:
+      fee = minFee
+      select, reselectTime = timeSelection(selectFunc, utxos, targetOutVal,
+                                                               fee, repeat)
+      selectTime += reselectTime
+
+   totalIn = sum([u.getValue() for u in select])
+   return { 'selectSec': selectTime,
+            'feeSec':    feeTime,
+            'score':     PyEvalCoinSelect(select, targetOutVal, fee),
+            'fee':       fee,
+            'numInputs': len(select),
+            'change':    totalIn - targetOutVal - fee,
+            'covered':   totalIn >= targetOutVal + fee }
+
+
+################################################################################
+def runBenchmark(profiles, sizes, engines, seed=0, legacyMax=5000,
+                                                printFunc=None, repeat=3):
+   """
+   Returns an OrderedDict of runKey -> result dict, for every combination of
+   profile, size, target and engine.  The legacy engine is skipped above
+   legacyMax UTXOs, where a single run can take minutes.
+   """
+   results = OrderedDict()
+   rng = random.Random(seed)
+   recipScript = hash160_to_p2pkhash_script(randomBytes(rng, 20))
+   for profile in profiles:
+      for numUtxo in sizes:
+         utxos = generateUtxoSet(profile, numUtxo, seed)
+         balance = sum([u.getValue() for u in utxos])
+         for target in BENCH_TARGETS:
+            if target > balance/2:
+               continue
+            for engine in engines:
+               if engine=='legacy' and numUtxo > legacyMax:
+                  continue
+               runKey = '%s/%d/%d/%s' % (profile, numUtxo, target, engine)
+               results[runKey] = runSelection(engine, utxos, target,
+                                                   recipScript, repeat)
+               if printFunc:
+                  printFunc(runKey, results[runKey])
+   return results
+
+
+################################################################################
+def compareToBaseline(results, baseline, timeTol=0.5, minTimeSec=0.05):
+   """
+   Returns a list of (runKey, reason) for every run that got slower by more
+   than timeTol (ignoring runs faster than minTimeSec either way), picked a
+   lower-scoring selection, or no longer covers the target.
+   """
+   regressions = []
+   for runKey,res in results.iteritems():
+      if not runKey in baseline:
+         continue
+      base = baseline[runKey]
+      if base['covered'] and not res['covered']:
+         regressions.append((runKey, 'selection no longer covers target'))
+      if res['score'] < base['score']:
+         regressions.append((runKey, 'score %s < baseline %s' % \
+                                          (res['score'], base['score'])))
+      slowest = max(res['selectSec'], base['selectSec'])
+      if slowest > minTimeSec and \
+         res['selectSec'] > base['selectSec'] * (1+timeTol):
+         regressions.append((runKey, 'select %0.3fs > baseline %0.3fs' % \
+                                    (res['selectSec'], base['selectSec'])))
+   return regressions
+
+
+################################################################################
+def printResult(runKey, res):
+   print '%-36s %8.3fs %8.4fs %12s %8d %4d %14d' % (runKey, res['selectSec'],
+      res['feeSec'], str(res['score']), res['fee'], res['numInputs'],
+      res['change'])
+
+
+################################################################################
+if __name__ == '__main__':
+   benchParser = optparse.OptionParser(usage='%prog [options]')
+   benchParser.add_option('--profiles', dest='profiles', type='str',
+                          default=','.join(UTXO_PROFILES.keys()))
+   benchParser.add_option('--sizes', dest='sizes', type='str',
+                          default='100,1000,10000,50000')
+   benchParser.add_option('--engines', dest='engines', type='str',
+                          default=','.join(SELECT_ENGINES.keys()))
+   benchParser.add_option('--seed', dest='seed', type='int', default=0)
+   benchParser.add_option('--legacy-max', dest='legacyMax', type='int',
+                          default=5000)
+   benchParser.add_option('--baseline', dest='baseline', type='str',
+                          default=None, help='Compare against this file')
+   benchParser.add_option('--save-baseline', dest='saveBaseline', type='str',
+                          default=None, help='Write results to this file')
+   benchParser.add_option('--time-tolerance', dest='timeTol', type='float',
+                          default=0.5)
+   benchParser.add_option('--repeat', dest='repeat', type='int', default=3,
+                          help='Time each selection as the best of this many')
+   (opts, args) = benchParser.parse_args(BENCH_ARGV)
+
+   print '%-36s %9s %9s %12s %8s %4s %14s' % ('run', 'select', 'fees',
+                                 'score', 'fee', 'nIn', 'change')
+   results = runBenchmark(opts.profiles.split(','),
+                          [int(s) for s in opts.sizes.split(',')],
+                          opts.engines.split(','),
+                          opts.seed,
+                          opts.legacyMax,
+                          printResult,
+                          opts.repeat)
+
+   if opts.saveBaseline:
+      with open(opts.saveBaseline, 'w') as f:
+         json.dump(results, f, indent=1)
+      print 'Saved %d runs to %s' % (len(results), opts.saveBaseline)
+
+   if opts.baseline:
+      with open(opts.baseline, 'r') as f:
+         baseline = json.load(f)
+      regressions = compareToBaseline(results, baseline, opts.timeTol)
+      for runKey,reason in regressions:
+         print 'REGRESSION: %s: %s' % (runKey, reason)
+      if regressions:
+         sys.exit(1)
+      print 'No regressions against %s' % opts.baseline
@@ -212,6 +212,200 @@ def inverse_mod( a, m ):
    if ud > 0: return ud
    else: return ud + m
 
+def batch_inverse_mod( values, m ):
+   # Montgomery's trick:  one inverse_mod for the whole list.  No value
+   # may be 0 mod m
+   if not values: return []
+   prefix = []
+   acc = 1
+   for v in values:
+      prefix.append(acc)
+      acc = ( acc * v ) % m
+   inv = inverse_mod( acc, m )
+   result = [0] * len(values)
+   for i in xrange(len(values)-1, -1, -1):
+      result[i] = ( inv * prefix[i] ) % m
+      inv = ( inv * values[i] ) % m
+   return result
+
+# Jacobian coordinates for secp256k1 (a=0):  (X, Y, Z) stands for the affine
+# point (X/Z^2, Y/Z^3), and Z == 0 is the point at infinity.  Adding and
+# doubling need no modular inverse, so a whole scalar multiplication costs
+# one inverse at the end instead of one per step.  Intermediate points are
+# plain tuples and are not checked against the curve; the inputs and the
+# result are checked once, by Point().
+_JINF = (1L, 1L, 0L)
+
+def _jacobian_double( P ):
+   X1, Y1, Z1 = P
+   if Z1 == 0 or Y1 == 0: return _JINF
+   YY = ( Y1 * Y1 ) % _p
+   S = ( 4 * X1 * YY ) % _p
+   M = ( 3 * X1 * X1 ) % _p
+   X3 = ( M * M - 2 * S ) % _p
+   Y3 = ( M * ( S - X3 ) - 8 * YY * YY ) % _p
+   Z3 = ( 2 * Y1 * Z1 ) % _p
+   return ( X3, Y3, Z3 )
+
+def _jacobian_add( P, Q ):
+   X1, Y1, Z1 = P
+   X2, Y2, Z2 = Q
+   if Z1 == 0: return Q
+   if Z2 == 0: return P
+   Z1Z1 = ( Z1 * Z1 ) % _p
+   Z2Z2 = ( Z2 * Z2 ) % _p
+   U1 = ( X1 * Z2Z2 ) % _p
+   U2 = ( X2 * Z1Z1 ) % _p
+   S1 = ( Y1 * Z2 * Z2Z2 ) % _p
+   S2 = ( Y2 * Z1 * Z1Z1 ) % _p
+   if U1 == U2:
+      if S1 == S2: return _jacobian_double( P )
+      return _JINF
+   H = U2 - U1
+   R = S2 - S1
+   HH = ( H * H ) % _p
+   HHH = ( H * HH ) % _p
+   V = ( U1 * HH ) % _p
+   X3 = ( R * R - HHH - 2 * V ) % _p
+   Y3 = ( R * ( V - X3 ) - S1 * HHH ) % _p
+   Z3 = ( H * Z1 * Z2 ) % _p
+   return ( X3, Y3, Z3 )
+
+def _jacobian_add_affine( P, x2, y2 ):
+   # Same as _jacobian_add with Z2 == 1
+   X1, Y1, Z1 = P
+   if Z1 == 0: return ( x2, y2, 1L )
+   Z1Z1 = ( Z1 * Z1 ) % _p
+   U2 = ( x2 * Z1Z1 ) % _p
+   S2 = ( y2 * Z1 * Z1Z1 ) % _p
+   if X1 == U2:
+      if Y1 == S2: return _jacobian_double( P )
+      return _JINF
+   H = U2 - X1
+   R = S2 - Y1
+   HH = ( H * H ) % _p
+   HHH = ( H * HH ) % _p
+   V = ( X1 * HH ) % _p
+   X3 = ( R * R - HHH - 2 * V ) % _p
+   Y3 = ( R * ( V - X3 ) - Y1 * HHH ) % _p
+   Z3 = ( H * Z1 ) % _p
+   return ( X3, Y3, Z3 )
+
+def _jacobian_to_affine( P, zinv=None ):
+   X, Y, Z = P
+   if Z == 0: return None
+   if zinv is None: zinv = inverse_mod( Z, _p )
+   zinv2 = ( zinv * zinv ) % _p
+   return ( ( X * zinv2 ) % _p, ( Y * zinv2 * zinv ) % _p )
+
+def _jacobian_list_to_affine( points ):
+   zinvs = batch_inverse_mod( [ P[2] for P in points ], _p )
+   return [ _jacobian_to_affine( P, zi ) for P, zi in zip( points, zinvs ) ]
+
+def _wnaf( k, w ):
+   # Width-w NAF of k, least significant digit first.  Nonzero digits are
+   # odd, |d| < 2^(w-1), and at least w-1 zeros follow each of them
+   digits = []
+   full = 1 << w
+   half = 1 << (w-1)
+   while k:
+      if k & 1:
+         d = k & (full-1)
+         if d >= half: d -= full
+         k -= d
+      else:
+         d = 0
+      digits.append(d)
+      k >>= 1
+   return digits
+
+# Fixed-base table for G:  _G_COMB[i][j-1] = j * 16^i * G in affine
+# coordinates, so k*G is one mixed addition per nibble of k and no
+# doublings.  _G_ODD[j] = (2j+1) * G is for the G half of Shamir's trick.
+# Both are built on first use.
+G_COMB_BITS = 4
+G_WNAF_WIDTH = 7
+VAR_WNAF_WIDTH = 5
+_G_COMB = None
+_G_ODD = None
+
+def _get_g_comb():
+   global _G_COMB
+   if _G_COMB is None:
+      rows = []
+      base = ( _Gx, _Gy, 1L )
+      for i in xrange( ( 256 + G_COMB_BITS - 1 ) / G_COMB_BITS ):
+         row = [ base ]
+         for j in xrange( 2, 1 << G_COMB_BITS ):
+            row.append( _jacobian_add( row[-1], base ) )
+         rows.append( row )
+         base = _jacobian_add( row[-1], base )
+      flat = _jacobian_list_to_affine( [ P for row in rows for P in row ] )
+      n = ( 1 << G_COMB_BITS ) - 1
+      _G_COMB = [ flat[i:i+n] for i in xrange( 0, len(flat), n ) ]
+   return _G_COMB
+
+def _get_g_odd():
+   global _G_ODD
+   if _G_ODD is None:
+      _G_ODD = _jacobian_list_to_affine( \
+                  _odd_multiples( ( _Gx, _Gy, 1L ), G_WNAF_WIDTH ) )
+   return _G_ODD
+
+def _odd_multiples( P, w ):
+   P2 = _jacobian_double( P )
+   result = [ P ]
+   for i in xrange( ( 1 << (w-2) ) - 1 ):
+      result.append( _jacobian_add( result[-1], P2 ) )
+   return result
+
+def _jacobian_mul_g( k ):
+   k = k % _r
+   mask = ( 1 << G_COMB_BITS ) - 1
+   result = _JINF
+   for row in _get_g_comb():
+      j = k & mask
+      if j:
+         x, y = row[j-1]
+         result = _jacobian_add_affine( result, x, y )
+      k >>= G_COMB_BITS
+      if not k: break
+   return result
+
+def _jacobian_mul_add( kG, kP, P ):
+   """
+   Returns kG*G + kP*P in Jacobian coordinates, P being an affine (x, y).
+   Shamir's trick:  both wNAFs are walked together, so the two products
+   share one chain of doublings
+   """
+   nafG = _wnaf( kG % _r, G_WNAF_WIDTH ) if kG else []
+   nafP = _wnaf( kP % _r, VAR_WNAF_WIDTH ) if kP else []
+   oddG = _get_g_odd() if nafG else None
+   oddP = _odd_multiples( ( P[0], P[1], 1L ), VAR_WNAF_WIDTH ) if nafP else None
+   result = _JINF
+   for i in xrange( max( len(nafG), len(nafP) ) - 1, -1, -1 ):
+      result = _jacobian_double( result )
+      if i < len(nafG) and nafG[i]:
+         d = nafG[i]
+         if d > 0:
+            x, y = oddG[d >> 1]
+            result = _jacobian_add_affine( result, x, y )
+         else:
+            x, y = oddG[(-d) >> 1]
+            result = _jacobian_add_affine( result, x, _p - y )
+      if i < len(nafP) and nafP[i]:
+         d = nafP[i]
+         if d > 0:
+            result = _jacobian_add( result, oddP[d >> 1] )
+         else:
+            X, Y, Z = oddP[(-d) >> 1]
+            result = _jacobian_add( result, ( X, _p - Y, Z ) )
+   return result
+
+def _is_secp256k1( curve ):
+   return curve is not None and curve.p() == _p and \
+          curve.a() == _a and curve.b() == _b
+
 class CurveFp( object ):
    def __init__( self, p, a, b ):
       self.__p = p
@@ -268,6 +462,15 @@ class Point( object ):
       if e == 0: return INFINITY
       if self == INFINITY: return INFINITY
       assert e > 0
+      if _is_secp256k1( self.__curve ):
+         x, y = self.__x % _p, self.__y % _p
+         if x == _Gx and y == _Gy:
+            xy = _jacobian_to_affine( _jacobian_mul_g( e ) )
+         else:
+            xy = _jacobian_to_affine( _jacobian_mul_add( 0, e, ( x, y ) ) )
+         if xy is None: return INFINITY
+         return Point( self.__curve, xy[0], xy[1] )
+
       e3 = 3 * e
       negative_self = Point( self.__curve, self.__x, -self.__y, self.__order )
       i = leftmost_bit( e3 ) / 2
@@ -346,6 +549,13 @@ class Public_key( object ):
       c = inverse_mod( s, n )
       u1 = ( hashValue * c ) % n
       u2 = ( r * c ) % n
+      if _is_secp256k1( self.curve ) and G.x() == _Gx and G.y() == _Gy:
+         X, Y, Z = _jacobian_mul_add( u1, u2, ( self.point.x(), self.point.y() ) )
+         if Z == 0: return False
+         # x/Z^2 mod n == r, checked without inverting Z
+         zz = ( Z * Z ) % _p
+         if ( X - r * zz ) % _p == 0: return True
+         return r + n < _p and ( X - ( r + n ) * zz ) % _p == 0
       xy = u1 * G + u2 * self.point
       v = xy.x() % n
       return v == r
@@ -441,7 +651,9 @@ randrange = random.SystemRandom().randrange
 
 # Signing/verifying
 
-def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVersionNumber=0):
+def parse_sig_Bitcoin(signature, message, pureECDSASigning=False):
+   # Returns (r, s, e, R, compressed) with R the affine point the signature
+   # was made with, checked to be on the curve
    msg=message
    if not pureECDSASigning:
       msg=Hash(format_msg_to_sign(message))
@@ -458,6 +670,8 @@ def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVe
 
    hb = ord(sig[0])
    r,s = map(str_to_long,[sig[1:33],sig[33:65]])
+   if r < 1 or r >= order or s < 1 or s >= order:
+      raise Exception("vmB","Bad signature")
 
    if hb < 27 or hb >= 35:
       raise Exception("vmB","Bad first byte")
@@ -476,19 +690,30 @@ def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVe
 
    R = Point(curve, x, y, order)
    e = str_to_long(msg)
-   minus_e = -e % order
-   inv_r = inverse_mod(r,order)
-   Q = inv_r * ( R*s + G*minus_e )
-   public_key = Public_key(G, Q, compressed)
-   addr = public_key_to_bc_address(public_key.ser(), networkVersionNumber)
-   return addr
+   return r, s, e, (R.x(), R.y()), compressed
+
+def recover_pubkey_jacobian(r, s, e, R, inv_r):
+   # Q = inv_r * ( R*s + G*minus_e ), as one Shamir multiplication
+   minus_e = -e % _r
+   return _jacobian_mul_add( (minus_e * inv_r) % _r, (s * inv_r) % _r, R )
+
+def pubkey_to_address_Bitcoin(Qxy, compressed, networkVersionNumber=0):
+   if Qxy is None:
+      raise Exception("vmB","Bad signature")
+   Q = Point(curve_secp256k1, Qxy[0], Qxy[1])
+   public_key = Public_key(generator_secp256k1, Q, compressed)
+   return public_key_to_bc_address(public_key.ser(), networkVersionNumber)
+
+def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVersionNumber=0):
+   r, s, e, R, compressed = parse_sig_Bitcoin(signature, message, pureECDSASigning)
+   Q = recover_pubkey_jacobian(r, s, e, R, inverse_mod(r, _r))
+   return pubkey_to_address_Bitcoin(_jacobian_to_affine(Q), compressed, \
+                                    networkVersionNumber)
 
 def sign_message(secret, message, pureECDSASigning=False):
    if len(secret) == 32:
-      pkey = EC_KEY(str_to_long(secret))
       compressed = False
    elif len(secret) == 33:
-      pkey = EC_KEY(str_to_long(secret[:-1]))
       secret=secret[:-1]
       compressed = True
    else:
@@ -632,6 +857,42 @@ def verifySignature(b64sig, msg, signVer='v0', networkVersionNumber=0):
       msg = FormatText(msg, True)
    return verify_message_Bitcoin(b64sig, msg, networkVersionNumber = networkVersionNumber)
 
+def verifySignatures(batch):
+   # Bulk verifySignature().  Each entry of batch is a tuple of its
+   # arguments:  (b64sig, msg[, signVer[, networkVersionNumber]]).  Returns
+   # the signing address of each entry, or None where it doesn't verify.
+   # The modular inverses of all r's, and of all the Z's at the end, are
+   # done as one batch each
+   results = [None] * len(batch)
+   parsed = []
+   for i,args in enumerate(batch):
+      try:
+         b64sig, msg = args[0], args[1]
+         signVer = args[2] if len(args) > 2 else 'v0'
+         networkVersionNumber = args[3] if len(args) > 3 else 0
+         if signVer=='v1':
+            msg = FormatText(msg, True)
+         parsed.append((i, networkVersionNumber, parse_sig_Bitcoin(b64sig, msg)))
+      except Exception:
+         continue
+
+   inv_rs = batch_inverse_mod([sig[0] for i,nv,sig in parsed], _r)
+   recovered = []
+   for (i,networkVersionNumber,sig),inv_r in zip(parsed, inv_rs):
+      r, s, e, R, compressed = sig
+      Q = recover_pubkey_jacobian(r, s, e, R, inv_r)
+      if Q[2] != 0:
+         recovered.append((i, networkVersionNumber, compressed, Q))
+
+   zinvs = batch_inverse_mod([Q[2] for i,nv,c,Q in recovered], _p)
+   for (i,networkVersionNumber,compressed,Q),zinv in zip(recovered, zinvs):
+      try:
+         results[i] = pubkey_to_address_Bitcoin(_jacobian_to_affine(Q, zinv), \
+                                                compressed, networkVersionNumber)
+      except Exception:
+         continue
+   return results
+
 def ASv0(privkey, msg):
    return sign_message_Bitcoin(privkey, msg)
 
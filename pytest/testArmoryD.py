@@ -5,6 +5,7 @@ Created on Oct 8, 2013
 '''
 import sys
 sys.path.append('..')
+import json
 import os
 import time
 from pytest.Tiab import TiabTest
@@ -100,6 +101,34 @@ class ArmoryDTest(TiabTest):
       pyTx = PyTx().unserialize(hex_to_binary(actualRawTx))
       self.assertEquals(TX_ID1, binary_to_hex(pyTx.getHash(), BIGENDIAN))
 
+   def testGetrawtransactions(self):
+      rawTxMap = self.jsonServer.jsonrpc_getrawtransactions([TX_ID1, '00'*32])
+      self.assertEqual(rawTxMap[TX_ID1], RAW_TX1)
+      self.assertEqual(rawTxMap['00'*32], None)
+
+   def testBatchCall(self):
+      def runCall(call):
+         replies = []
+         self.jsonServer.runBatchCall(call).addCallback(replies.append)
+         return replies[0]
+
+      reply = json.loads(runCall({'jsonrpc': '2.0', 'id': 7, \
+                                  'method': 'getrawtransaction', \
+                                  'params': [TX_ID1]}))
+      self.assertEqual(reply['id'], 7)
+      self.assertEqual(reply['result'], RAW_TX1)
+      self.assertFalse('error' in reply)
+
+      reply = json.loads(runCall({'jsonrpc': '2.0', 'id': 8, \
+                                  'method': 'nosuchmethod'}))
+      self.assertFalse('result' in reply)
+      self.assertTrue(reply['error']['code'] < 0)
+
+      # Notifications get no reply
+      self.assertEqual(runCall({'jsonrpc': '2.0', \
+                                'method': 'getrawtransaction', \
+                                'params': [TX_ID1]}), None)
+
    def testBackupWallet(self):
       backupTestPath = os.path.join(self.armoryHomeDir, 'armory_%s_.wallet.backup.test' % TEST_WALLET_ID)
       # Remove backupTestPath in case it exists
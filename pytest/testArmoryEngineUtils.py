@@ -439,6 +439,74 @@ class ArmoryEngineTest(unittest.TestCase):
       self.assertEqual(scraddr, addrStr_to_scrAddr(scrAddr_to_addrStr(scraddr)))
 
 
+   #############################################################################
+   def testLRUCache(self):
+      cache = LRUCache(3)
+      for i in range(3):
+         cache.put(i, str(i))
+      self.assertEqual(cache.get(0), '0')   # 0 is now most-recently used
+      cache.put(3, '3')                     # evicts 1
+      self.assertFalse(1 in cache)
+      self.assertEqual(sorted(cache.keys()), [0, 2, 3])
+      self.assertEqual(cache.get(1, 'none'), 'none')
+      self.assertEqual(cache.pop(2), '2')
+      self.assertEqual(len(cache), 2)
+      cache.clear()
+      self.assertEqual(len(cache), 0)
+
+   #############################################################################
+   def testChopLogFile(self):
+      import tempfile
+      fd,logName = tempfile.mkstemp()
+      os.close(fd)
+      self.addCleanup(os.remove, logName)
+      with open(logName, 'w') as f:
+         for i in range(1000):
+            f.write('log line %04d\n' % i)
+
+      chopLogFile(logName, 10000)
+      with open(logName, 'r') as f:
+         lines = f.readlines()
+      self.assertTrue(os.path.getsize(logName) <= 10000)
+      self.assertEqual(lines[-1], 'log line 0999\n')
+      self.assertTrue(lines[0].startswith('log line '))
+
+      # Already under the limit:  untouched
+      chopLogFile(logName, 10000)
+      with open(logName, 'r') as f:
+         self.assertEqual(f.readlines(), lines)
+
+   #############################################################################
+   def testQueuedLogHandler(self):
+      class CollectHandler(logging.Handler):
+         def __init__(self):
+            logging.Handler.__init__(self)
+            self.lines = []
+         def emit(self, record):
+            self.lines.append(self.format(record))
+
+      collector = CollectHandler()
+      collector.setFormatter(logging.Formatter('%(message)s'))
+      queued = QueuedLogHandler(collector)
+      queued.setLevel(logging.ERROR)
+      rootLogger.addHandler(queued)
+      try:
+         LOGERROR('queued %d', 1)
+         try:
+            raise ValueError('queued exception')
+         except ValueError:
+            LOGEXCEPT('queued %s', 'except')
+         LOGINFO('below the handler level')
+      finally:
+         rootLogger.removeHandler(queued)
+         queued.stop()
+
+      self.assertEqual(len(collector.lines), 2)
+      self.assertTrue(collector.lines[0].endswith(' - queued 1'))
+      self.assertTrue(collector.lines[0].startswith('testArmoryEngineUtils.py:'))
+      self.assertTrue('ValueError: queued exception' in collector.lines[1])
+
+
 ################################################################################
 ################################################################################
 class BinaryPackerUnpackerTest(unittest.TestCase):
@@ -463,6 +531,24 @@ class BinaryPackerUnpackerTest(unittest.TestCase):
       bu.append(ts)
       self.assertEqual(bu.getBinaryString(), ts + ts)
 
+   #############################################################################
+   def testBinaryUnpackerBuffers(self):
+      ts = hex_to_binary('ff0100fd0203' + '0361626378')
+      for src in [ts, bytearray(ts), memoryview(ts)]:
+         bu = BinaryUnpacker(src)
+         self.assertEqual(bu.getMany([UINT8, UINT16]), (0xff, 1))
+         self.assertEqual(bu.get(VAR_INT), 0x0302)
+         self.assertEqual(bu.get(VAR_STR), 'abc')
+         self.assertEqual(bu.getRemainingBuffer().tobytes(), 'x')
+         self.assertEqual(bu.getRemainingString(), 'x')
+         self.assertRaises(UnpackerError, bu.get, UINT16)
+
+      bu = BinaryUnpacker(ts)
+      self.assertEqual(bu.getMany([(BINARY_CHUNK, 3), UINT8]), ('\xff\x01\x00', 0xfd))
+      self.assertRaises(UnpackerError, bu.getMany, [VAR_INT])
+      self.assertRaises(UnpackerError, BinaryUnpacker('\xfd\x01').get, VAR_INT)
+      self.assertRaises(UnpackerError, BinaryUnpacker('\x05ab').get, VAR_STR)
+
    #############################################################################
    def testBinaryPacker(self):
       UNKNOWN_TYPE = 100
@@ -510,6 +596,21 @@ class BinaryPackerUnpackerTest(unittest.TestCase):
       self.assertRaises(UnpackerError, bu.get, UNKNOWN_TYPE)
       self.assertRaises(UnpackerError, bu.get, BINARY_CHUNK, 1)
 
+   #############################################################################
+   def testBinaryPackerGrowth(self):
+      bp = BinaryPacker(sizeHint=4)
+      bp.putMany([UINT32, (BINARY_CHUNK, 4), UINT8], [7, 'ab', 1])
+      for i in range(100):
+         bp.put(VAR_STR, 'xyz')
+      self.assertEqual(bp.getSize(), 9 + 400)
+      ts = bp.getBinaryString()
+      self.assertEqual(len(ts), 9 + 400)
+      self.assertEqual(ts[:9], hex_to_binary('070000006162000001'))
+      self.assertEqual(ts[-4:], '\x03xyz')
+      self.assertRaises(PackerError, bp.put, UINT8, 256)
+      self.assertRaises(PackerError, bp.putMany, [UINT8, VAR_INT], [1, 2])
+      self.assertRaises(PackerError, bp.putMany, [UINT8, UINT8], [1])
+
 # Running tests with "python <module name>" will NOT work for any Armory tests
 # You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
 # if __name__ == "__main__":
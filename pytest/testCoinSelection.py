@@ -0,0 +1,88 @@
+################################################################################
+#
+# Copyright (C) 2011-2014, Armory Technologies, Inc.
+# Distributed under the GNU Affero General Public License (AGPL v3)
+# See LICENSE or http://www.gnu.org/licenses/agpl.html
+#
+################################################################################
+import sys
+sys.path.append('..')
+import unittest
+
+from armoryengine.ArmoryUtils import ONE_BTC, hash160_to_p2pkhash_script
+from extras.coinSelectionBench import UTXO_PROFILES, BENCH_TARGETS, \
+   generateUtxoSet, runSelection, compareToBaseline
+from armoryengine.CoinSelection import PySelectCoinsBnB, PySelectCoinsLegacy, \
+   PyEvalCoinSelect
+
+
+class CoinSelectionBenchTest(unittest.TestCase):
+
+   def testUtxoSetsAreReproducible(self):
+      for profile in UTXO_PROFILES:
+         a = generateUtxoSet(profile, 50, seed=3)
+         b = generateUtxoSet(profile, 50, seed=3)
+         c = generateUtxoSet(profile, 50, seed=4)
+         keyOf = lambda u: (u.getTxHash(), u.getValue(), u.getScript())
+         self.assertEqual([keyOf(u) for u in a], [keyOf(u) for u in b])
+         self.assertNotEqual([keyOf(u) for u in a], [keyOf(u) for u in c])
+
+
+   def testEnginesCoverTarget(self):
+      recip = hash160_to_p2pkhash_script('\x11'*20)
+      for profile in UTXO_PROFILES:
+         utxos = generateUtxoSet(profile, 300)
+         target = min(ONE_BTC/2, sum([u.getValue() for u in utxos])/4)
+         for engine in ['legacy', 'bnb']:
+            res = runSelection(engine, utxos, target, recip)
+            self.assertTrue(res['covered'])
+            self.assertTrue(res['numInputs'] > 0)
+            self.assertTrue(res['score'] > 0)
+
+
+   def testCompareToBaseline(self):
+      base = {'a/1/1/bnb': {'selectSec': 0.2, 'score': 100, 'covered': True}}
+      same = {'a/1/1/bnb': {'selectSec': 0.21, 'score': 100, 'covered': True}}
+      slow = {'a/1/1/bnb': {'selectSec': 0.5, 'score': 100, 'covered': True}}
+      worse = {'a/1/1/bnb': {'selectSec': 0.2, 'score': 90, 'covered': True}}
+      self.assertEqual(compareToBaseline(same, base), [])
+      self.assertEqual(len(compareToBaseline(slow, base)), 1)
+      self.assertEqual(len(compareToBaseline(worse, base)), 1)
+
+      # Tiny absolute times are too noisy to call a regression
+      fast = {'a/1/1/bnb': {'selectSec': 0.001, 'score': 100, 'covered': True}}
+      faster = {'a/1/1/bnb': {'selectSec': 0.01, 'score': 100, 'covered': True}}
+      self.assertEqual(compareToBaseline(faster, fast), [])
+
+
+class SelectCoinsBnBTest(unittest.TestCase):
+
+   def testScoreAtLeastLegacy(self):
+      for profile in UTXO_PROFILES:
+         utxos = generateUtxoSet(profile, 200)
+         balance = sum([u.getValue() for u in utxos])
+         for target in BENCH_TARGETS:
+            if 2*target > balance:
+               continue
+            for fee in [0, 10000]:
+               bnb = PySelectCoinsBnB(utxos, target, fee)
+               legacy = PySelectCoinsLegacy(utxos, target, fee)
+               self.assertTrue(sum([u.getValue() for u in bnb]) >= target+fee)
+               self.assertTrue(PyEvalCoinSelect(bnb, target, fee) >= \
+                               PyEvalCoinSelect(legacy, target, fee))
+
+
+   def testShortfall(self):
+      utxos = generateUtxoSet('exchange', 100)
+      balance = sum([u.getValue() for u in utxos])
+
+      # Not even the target is covered
+      self.assertEqual(PySelectCoinsBnB(utxos, balance+1, 0), [])
+
+      # The target is, but not the fee:  everything, confirmed coins first
+      # and largest first
+      select = PySelectCoinsBnB(utxos, balance-1000, 10000)
+      self.assertEqual(len(select), len(utxos))
+      keyOf = lambda u: (u.getNumConfirm()==0, -u.getValue())
+      self.assertEqual([keyOf(u) for u in select],
+                       sorted([keyOf(u) for u in utxos]))
@@ -0,0 +1,71 @@
+import sys
+sys.path.append('..')
+from pytest.Tiab import TiabTest
+import unittest
+
+from jasvet import *
+from jasvet import _jacobian_mul_g, _jacobian_mul_add, _jacobian_to_affine
+
+
+TEST_SECRET = '\x01'*32
+TEST_MSG = 'Hello world!\n'
+ORDER = generator_secp256k1.order()
+
+class JasvetTest(TiabTest):
+
+   def testScalarMult(self):
+      G = generator_secp256k1
+      G2 = G.double()
+      G3 = G2 + G
+      self.assertEqual((G2.x(), G2.y()), ((G*2).x(), (G*2).y()))
+      self.assertEqual((G3.x(), G3.y()), ((G*3).x(), (G*3).y()))
+      self.assertTrue(G*ORDER is INFINITY)
+
+      P = G*12345
+      for k in [1, 2, 15, 16, 17, ORDER-1, 0x123456789abcdef0123456789abcdef]:
+         # Fixed-base table and the wNAF paths agree
+         self.assertEqual(_jacobian_to_affine(_jacobian_mul_g(k)), \
+                          _jacobian_to_affine(_jacobian_mul_add(k, 0, None)))
+         # Shamir's trick against separate multiplications
+         R = G*k + P*(k+7)
+         self.assertEqual(_jacobian_to_affine(_jacobian_mul_add(k, k+7, \
+                                                         (P.x(), P.y()))), \
+                          (R.x(), R.y()))
+
+      self.assertEqual(_jacobian_mul_add(5*12345, ORDER-5, (P.x(), P.y()))[2], 0)
+
+   def testSignVerify(self):
+      sig = ASv0(TEST_SECRET, TEST_MSG)
+      self.assertEqual(verifySignature(sig['b64-signature'], TEST_MSG), \
+                       sig['address'])
+      self.assertNotEqual(verifySignature(sig['b64-signature'], 'Bye'), \
+                          sig['address'])
+
+      sig, msg = readSigBlock(ASv1CS(TEST_SECRET + '\x01', TEST_MSG))
+      addrComp = verifySignature(sig, msg, 'v1')
+      self.assertNotEqual(addrComp, verifySignature(sig, msg, 'v1', 111))
+      self.assertEqual(addrComp, public_key_to_bc_address( \
+                        GetPubKey(EC_KEY(str_to_long(TEST_SECRET), True), True)))
+
+   def testVerifySignatures(self):
+      batch = []
+      for i in range(4):
+         secret = chr(i+1)*32 + ('\x01' if i%2 else '')
+         sig = ASv0(secret, TEST_MSG + str(i))
+         batch.append((sig['b64-signature'], sig['message']))
+         sig, msg = readSigBlock(ASv1CS(secret, TEST_MSG + str(i)))
+         batch.append((sig, msg, 'v1', 111))
+      batch.append((batch[0][0], 'Wrong message'))
+      batch.append(('Not a signature', TEST_MSG))
+      batch.append((base64.b64encode('\x1b' + '\x00'*64), TEST_MSG))
+
+      expect = [verifySignature(*args) for args in batch[:-2]] + [None, None]
+      self.assertEqual(verifySignatures(batch), expect)
+      self.assertNotEqual(expect[-3], expect[0])
+      self.assertEqual(verifySignatures([]), [])
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
@@ -13,9 +13,10 @@ from armoryengine.MultiSigUtils import readLockboxesFile
 from CppBlockUtils import SecureBinaryData
 from armoryengine.ArmoryUtils import convertKeyDataToAddress, \
    hash256, binary_to_hex, hex_to_binary, CLI_OPTIONS, \
-   WalletLockError, InterruptTestError, MULTISIG_FILE_NAME
+   WalletLockError, InterruptTestError, MULTISIG_FILE_NAME, Hash160ToScrAddr
 from armoryengine.PyBtcWallet import PyBtcWallet
 from armoryengine.BDM import TheBDM
+from armoryengine.Transaction import TheScrAddrIndex
 
 
 sys.argv.append('--nologging')
@@ -88,6 +89,126 @@ class PyBtcWalletTest(TiabTest):
       lboxWltB = PyBtcWallet().readWalletFile(lboxWltBFile, doScanNow=True)
       self.assertTrue(lboxWltB.isWltSigningAnyLockbox(lockboxList))
       
+   def testLazyWalletLoad(self):
+      wlt2 = PyBtcWallet().readWalletFile(self.fileA)
+
+      # Nothing but the root is unserialized until it's used
+      self.assertEqual(wlt2.addrMap.getNumDecoded(), 1)
+      self.assertEqual(sorted(wlt2.addrMap.keys()), sorted(self.wlt.addrMap.keys()))
+      self.assertEqual(wlt2.lastComputedChainIndex, self.wlt.lastComputedChainIndex)
+      self.assertEqual(wlt2.chainIndexMap, self.wlt.chainIndexMap)
+      self.assertEqual(wlt2.linearAddr160List, self.wlt.linearAddr160List)
+
+      a160 = hex_to_binary(NEW_UNUSED_ADDR)
+      self.assertTrue(wlt2.hasAddr(a160))
+      self.assertEqual(wlt2.addrMap[a160].serialize(), self.wlt.addrMap[a160].serialize())
+      self.assertEqual(wlt2.addrMap.getNumDecoded(), 2)
+
+      for addr160,addrObj in self.wlt.addrMap.iteritems():
+         self.assertEqual(wlt2.addrMap[addr160].serialize(), addrObj.serialize())
+         self.assertEqual(wlt2.addrMap[addr160].walletByteLoc, addrObj.walletByteLoc)
+
+      # Registering the wallet indexes all of its addresses, new ones get
+      # added, and other reads of the same file leave the index alone
+      wltMap = {wlt2.uniqueIDB58: wlt2}
+      self.addCleanup(TheScrAddrIndex.removeWallet, wlt2.uniqueIDB58)
+      TheScrAddrIndex.addWallet(wlt2)
+      self.assertEqual(TheScrAddrIndex.getOwnerIn(Hash160ToScrAddr(a160), 
+                                                  wltMap), wlt2.uniqueIDB58)
+      new160 = wlt2.getNextUnusedAddress().getAddr160()
+      self.assertEqual(TheScrAddrIndex.getOwnerIn(Hash160ToScrAddr(new160), 
+                                                  wltMap), wlt2.uniqueIDB58)
+
+      wlt3 = PyBtcWallet().readWalletFile(self.fileA)
+      self.assertFalse(TheScrAddrIndex.isWalletRegistered(wlt3))
+      wlt3.getNextUnusedAddress()
+      self.assertEqual(TheScrAddrIndex.ownerMap[wlt2.uniqueIDB58], 
+            set([Hash160ToScrAddr(x) for x in wlt2.linearAddr160List]))
+
+      TheScrAddrIndex.removeWallet(wlt2.uniqueIDB58)
+      self.assertEqual(TheScrAddrIndex.getOwnerIn(Hash160ToScrAddr(a160), 
+                                                  wltMap), None)
+
+   def testBatchUpdateJournal(self):
+      fileJ = os.path.join(self.armoryHomeDir, 'armory_%s_journal.wallet' % self.wltID)
+      self.addCleanup(self.removeFileList, [fileJ])
+
+      def hashfile(fn):
+         f = open(fn,'rb')
+         d = hash256(f.read())
+         f.close()
+         return binary_to_hex(d[:8])
+
+      # Die after the main file got the batch but before the backup did
+      try:
+         self.wlt.interruptTestJournal = True
+         self.wlt.fillAddressPool(self.wlt.addrPoolSize + 10)
+      except InterruptTestError:
+         pass
+      self.wlt.interruptTestJournal = False
+      self.assertTrue(os.path.exists(fileJ))
+      self.assertNotEqual(hashfile(self.fileA), hashfile(self.fileB))
+
+      # The journal is replayed onto both files, and all the new addresses
+      # made it to disk
+      self.wlt.doWalletFileConsistencyCheck()
+      self.assertFalse(os.path.exists(fileJ))
+      self.assertEqual(hashfile(self.fileA), hashfile(self.fileB))
+      wlt2 = PyBtcWallet().readWalletFile(self.fileA)
+      self.assertEqual(wlt2.lastComputedChainIndex, self.wlt.lastComputedChainIndex)
+
+      # A torn journal means neither file was touched yet:  just drop it
+      mainHash = hashfile(self.fileA)
+      jfile = open(fileJ, 'wb')
+      jfile.write(self.wlt.packWalletJournal(0, 'garbage', [])[:-5])
+      jfile.close()
+      self.wlt.doWalletFileConsistencyCheck()
+      self.assertFalse(os.path.exists(fileJ))
+      self.assertEqual(mainHash, hashfile(self.fileA))
+      self.assertEqual(mainHash, hashfile(self.fileB))
+
+   def testLazyUnlock(self):
+      passphrase = SecureBinaryData('hello')
+      wltE = PyBtcWallet().createNewWallet(withEncrypt=True, \
+                                    plainRootKey=SecureBinaryData('\xbb'*32), \
+                                    securePassphrase=passphrase, \
+                                    chaincode=self.chainstr, \
+                                    IV=SecureBinaryData(hex_to_binary('88'*16)), \
+                                    shortLabel=self.shortlabel,
+                                    armoryHomeDir = self.armoryHomeDir)
+      self.addCleanup(self.removeFileList, [wltE.walletPath, 
+                                            wltE.getWalletPath('backup')])
+
+      # These addresses can't get private keys until the next unlock
+      wltE.lock()
+      wltE.fillAddressPool(wltE.addrPoolSize + 5)
+      a160 = wltE.getAddress160ByChainIndex(wltE.lastComputedChainIndex)
+      self.assertTrue(wltE.addrMap[a160].createPrivKeyNextUnlock)
+
+      wlt2 = PyBtcWallet().readWalletFile(wltE.walletPath)
+      wlt2.unlock(securePassphrase=passphrase, lazy=True)
+      self.assertFalse(wlt2.isLocked)
+      self.assertEqual(wlt2.addrMap.getNumDecoded(), 1)
+
+      wlt2.unlockAddresses([a160])
+      addrObj = wlt2.addrMap[a160]
+      self.assertFalse(addrObj.isLocked)
+      self.assertFalse(addrObj.createPrivKeyNextUnlock)
+      self.assertTrue(wlt2.addrMap.getNumDecoded() < len(wlt2.addrMap))
+
+      # Same key as a full unlock computes
+      wltE.unlock(securePassphrase=passphrase)
+      self.assertEqual(addrObj.binPrivKey32_Plain.toHexStr(),
+                       wltE.addrMap[a160].binPrivKey32_Plain.toHexStr())
+
+      wlt2.lock()
+      self.assertTrue(addrObj.isLocked)
+      self.assertEqual(addrObj.binPrivKey32_Plain.toHexStr(), '')
+
+      # The computed key was saved
+      wlt3 = PyBtcWallet().readWalletFile(wltE.walletPath)
+      self.assertFalse(wlt3.addrMap[a160].createPrivKeyNextUnlock)
+
    # Remove wallet files, need fresh dir for this test
    def testPyBtcWallet(self):
 
@@ -6,8 +6,9 @@ from CppBlockUtils import SecureBinaryData, CryptoECDSA, CryptoAES
 from armoryengine.PyBtcAddress import PyBtcAddress
 from armoryengine.ArmoryUtils import *
 from armoryengine.BinaryUnpacker import BinaryUnpacker
-from armoryengine.PyBtcWallet import PyBtcWallet
-from armoryengine.PyBtcWalletRecovery import PyBtcWalletRecovery, RECOVERMODE
+from armoryengine.PyBtcWallet import PyBtcWallet, WLT_DATATYPE_OPEVAL
+from armoryengine.PyBtcWalletRecovery import PyBtcWalletRecovery, RECOVERMODE, \
+   IncrementalWalletCheck
 import unittest
 import os
 
@@ -151,6 +152,53 @@ class PyBtcWalletRecoveryTest(TiabTest):
       self.assertTrue(len(rcvWltResult['negativeImports'])==99, \
                       "Missing neg Imports")
       
+
+class IncrementalWalletCheckTest(TiabTest):
+   def setUp(self):
+      self.wltPath = 'incremental_check.wallet'
+      self.wlt = PyBtcWallet().createNewWallet(self.wltPath, 
+                                 securePassphrase='testing', 
+                                 doRegisterWithBDM=False)
+      self.wlt.fillAddressPool(20)
+
+   def tearDown(self):
+      os.unlink(self.wltPath)
+      os.unlink(self.wltPath[:-7] + '_backup.wallet')
+
+   def testIncrementalWalletCheck(self):
+      checker = IncrementalWalletCheck(self.wltPath)
+      self.assertEqual(checker.run(), [])
+      self.assertEqual(checker.checkedOffset, os.path.getsize(self.wltPath))
+      self.assertEqual(checker.highestChainIndex, 
+                       self.wlt.lastComputedChainIndex)
+
+      # Only the new entries are verified on the next run
+      self.wlt.fillAddressPool(40)
+      self.assertEqual(checker.run(), [])
+      self.assertEqual(checker.highestChainIndex, 
+                       self.wlt.lastComputedChainIndex)
+
+      # Flip a byte inside an already-verified address entry
+      a160 = self.wlt.getAddress160ByChainIndex(10)
+      byteLoc = self.wlt.addrMap[a160].walletByteLoc + 100
+      with open(self.wltPath, 'r+b') as f:
+         f.seek(byteLoc)
+         oldByte = f.read(1)
+         f.seek(byteLoc)
+         f.write(chr(ord(oldByte) ^ 0xff))
+      self.assertTrue(len(checker.run()) > 0)
+
+   def testIncrementalCheckOpEval(self):
+      checker = IncrementalWalletCheck(self.wltPath)
+      self.assertEqual(checker.run(), [])
+
+      # An OP_EVAL entry can't be stepped over, so it needs the full check
+      with open(self.wltPath, 'ab') as f:
+         f.write(chr(WLT_DATATYPE_OPEVAL) + '\x00'*40)
+      errors = checker.run()
+      self.assertEqual(len(errors), 1)
+      self.assertTrue(errors[0].startswith('Found OP_EVAL data entry'))
+
 # Running tests with "python <module name>" will NOT work for any Armory tests
 # You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
 # if __name__ == "__main__":
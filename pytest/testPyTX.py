@@ -7,14 +7,18 @@ import sys
 sys.path.append('..')
 import unittest
 from armoryengine.ArmoryUtils import hex_to_binary, binary_to_hex, hex_to_int, \
-   ONE_BTC
+   ONE_BTC, script_to_scrAddr, Hash160ToScrAddr, hash160, \
+   hash160_to_p2pkhash_script, SecureBinaryData, CryptoECDSA
 from armoryengine.BinaryUnpacker import BinaryUnpacker
 from armoryengine.Block import PyBlock
 from armoryengine.PyBtcAddress import PyBtcAddress
 from armoryengine.Script import PyScriptProcessor
 from armoryengine.Transaction import PyTx, PyTxIn, PyOutPoint, PyTxOut, \
    PyCreateAndSignTx, getMultisigScriptInfo, BlockComponent,\
-   PyCreateAndSignTx_old
+   PyCreateAndSignTx_old, TxSigHashCache, WalletLedgerIndex, TxFactsCache, \
+   MergedLedger, ScrAddrIndex, ZeroConfDispatcher, UnsignedTxInput, \
+   UnsignedTransaction, DecoratedTxOut, SIG_WORKER_MIN_TASKS
+import armoryengine.Transaction
 from pytest.Tiab import TiabTest
 
 
@@ -112,6 +116,25 @@ tx2Fake = PyTx().unserialize(hex_to_binary( (
 
 ALL_ZERO_OUTPOINT = hex_to_binary('00' * 36)
 
+class FakeLedgerEntry(object):
+   def __init__(self, blk, idx):
+      self.blk, self.idx = blk, idx
+   def getValue(self):     return self.blk
+   def getBlockNum(self):  return self.blk
+   def getTxHash(self):    return '%032d' % (self.blk*10 + self.idx)
+   def getIndex(self):     return self.idx
+   def getTxTime(self):    return 0
+   def isValid(self):      return True
+   def isCoinbase(self):   return False
+   def isSentToSelf(self): return False
+   def isChangeBack(self): return False
+
+class FakeCppWallet(object):
+   def __init__(self):
+      self.ledger, self.zcLedger = [], []
+   def getTxLedger(self):         return self.ledger
+   def getZeroConfLedger(self):   return self.zcLedger
+
 class PyTXTest(TiabTest):
    
    def testMinimizeDERSignaturePadding(self):
@@ -285,6 +308,297 @@ class PyTXTest(TiabTest):
       self.assertEqual(outpoint.txHash, outpointFromCpp.txHash)
       self.assertEqual(outpoint.txOutIndex, outpointFromCpp.txOutIndex)
    '''
+   def testTxSigHashCache(self):
+      tx = PyTx()
+      tx.version  = 1
+      tx.lockTime = 12345
+      tx.inputs   = []
+      for i in range(4):
+         txin = PyTxIn()
+         txin.outpoint  = PyOutPoint(hex_to_binary('%02x' % (i+1) * 32), i)
+         txin.binScript = hex_to_binary('99' * (i*30))
+         txin.intSeq    = hex_to_int('ff'*4) - i
+         tx.inputs.append(txin)
+      txout = PyTxOut()
+      txout.value = 50 * ONE_BTC
+      txout.binScript = hex_to_binary('76a914' + 'aa'*20 + '88ac')
+      tx.outputs = [txout]
+
+      sigHashCache = TxSigHashCache(tx)
+      prevScript = hex_to_binary('76a914' + 'bb'*20 + '88ac')
+      for i in range(len(tx.inputs)):
+         self.assertEqual(sigHashCache.getTxInIndex(tx.inputs[i].outpoint), i)
+
+         # The long way:  blank all scripts, insert the one being spent
+         txCopy = tx.copy()
+         for txin in txCopy.inputs:
+            txin.binScript = ''
+         txCopy.inputs[i].binScript = prevScript
+         expectMsg = txCopy.serialize() + hex_to_binary('01000000')
+         self.assertEqual(sigHashCache.getPreHashMsg(i, prevScript)[0], 
+                                                                  expectMsg)
+
+      self.assertEqual(sigHashCache.getTxInIndex(PyOutPoint('\x00'*32, 0)), -1)
+
+   def testWalletLedgerIndex(self):
+      cppWlt = FakeCppWallet()
+      cppWlt.ledger = [FakeLedgerEntry(b, i) for b in range(5) for i in (1,2)]
+      ledgerIndex = WalletLedgerIndex(cppWlt)
+      self.assertEqual(ledgerIndex.getNumEntries(), 10)
+
+      page, cursor = ledgerIndex.getPage(4, 3)
+      self.assertEqual([le.getSortKey() for le in page], 
+                       [(1,2), (2,1), (2,2), (3,1)])
+      self.assertEqual(cursor, '3:1')
+
+      # New entries get appended, and the cursor picks up where it left off
+      cppWlt.ledger.append(FakeLedgerEntry(5, 1))
+      cppWlt.zcLedger = [FakeLedgerEntry(2**32-1, 0)]
+      self.assertEqual(ledgerIndex.refresh(), 1)
+      page, cursor = ledgerIndex.getPage(10, cursor=cursor)
+      self.assertEqual([le.getBlockNum() for le in page], [3,4,4,5,2**32-1])
+      self.assertEqual(cursor, '5:1')
+      page, cursor = ledgerIndex.getPage(10, cursor=cursor, withZeroConf=False)
+      self.assertEqual((page, cursor), ([], '5:1'))
+
+      # A reorg replaces entries below the tip, forcing a rebuild
+      cppWlt.ledger = cppWlt.ledger[:8] + [FakeLedgerEntry(7, 3)]
+      self.assertEqual(ledgerIndex.refresh(), 9)
+      self.assertEqual(ledgerIndex.getPage(1, 8)[0][0].getSortKey(), (7,3))
+      self.assertRaises(ValueError, ledgerIndex.getPage, 1, 0, 'junk')
+
+   def testMergedLedger(self):
+      wltA, wltB = FakeCppWallet(), FakeCppWallet()
+      wltA.ledger = [FakeLedgerEntry(b, 1) for b in (1,3,5)]
+      wltB.ledger = [FakeLedgerEntry(b, 2) for b in (2,4)]
+      keyFunc = lambda wltID,le: (le.getBlockNum(), le.getTxHash(), wltID)
+      merged = MergedLedger()
+      merged.update({'A': wltA, 'B': wltB}, 0, keyFunc, reverse=True)
+      self.assertEqual(len(merged), 5)
+      self.assertEqual([le.getBlockNum() for w,le in merged.getSlice(0, 3)],
+                       [5,4,3])
+
+      # Deltas get inserted in place, and only those wallets are reported
+      wltB.ledger.append(FakeLedgerEntry(6, 2))
+      wltA.zcLedger = [FakeLedgerEntry(2**32-1, 0)]
+      changed = merged.update({'A': wltA, 'B': wltB}, 0, keyFunc, reverse=True)
+      self.assertEqual(changed, set(['A', 'B']))
+      self.assertEqual([w for w,le in merged.getSlice(0, 2)], ['A', 'B'])
+      self.assertEqual(merged.update({'A': wltA, 'B': wltB}, 0, keyFunc), 
+                                                                     set())
+      self.assertEqual(merged.getSlice(0, 1)[0][1].getBlockNum(), 1)
+
+      # Zero-conf entries leave once they're mined, hidden wallets drop out
+      wltA.zcLedger = []
+      wltA.ledger.append(FakeLedgerEntry(7, 1))
+      merged.update({'A': wltA}, 0, keyFunc)
+      self.assertEqual([le.getBlockNum() for w,le in merged.getSlice(0, 10)],
+                       [1,3,5,7])
+
+   def testTxFactsCache(self):
+      class FakeTxOut(object):
+         def __init__(self, val):   self.val = val
+         def getScrAddressStr(self): return '\x00' + '%020d' % self.val
+         def getValue(self):        return self.val
+
+      class FakeTx(object):
+         def getNumTxOut(self):     return 2
+         def getTxOutCopy(self, i): return FakeTxOut(100*(i+1))
+         def getSize(self):         return 250
+         def getBlockTxIndex(self): return 1
+
+      class FakeHeader(object):
+         def __init__(self, hgt):   self.hgt = hgt
+         def isInitialized(self):   return self.hgt is not None
+         def getThisHash(self):     return '%032d' % self.hgt
+         def getBlockHeight(self):  return self.hgt
+         def getTimestamp(self):    return 1000 + self.hgt
+
+      class FakeBDM(object):
+         def __init__(self):
+            self.branchHeights = []
+            self.heights = {}
+            self.requests = []
+         def getLastReorg(self, sinceCount=None):
+            if sinceCount is None:
+               sinceCount = len(self.branchHeights) - 1
+            newer = self.branchHeights[max(sinceCount, 0):]
+            return (len(self.branchHeights), min(newer) if newer else -1)
+         def getTopBlockHeight(self):  return 100
+         def getTxDataBatch(self, txHashList, withSenders=False):
+            self.requests.append(list(txHashList))
+            return dict([(h, [FakeTx(), FakeHeader(self.heights[h]), 10, \
+                              [['\x00'*21, 310]]]) for h in txHashList])
+
+      fakeBDM = FakeBDM()
+      fakeBDM.heights = {'deep': 50, 'shallow': 97, 'zc': None}
+      realBDM = armoryengine.Transaction.TheBDM
+      armoryengine.Transaction.TheBDM = fakeBDM
+      try:
+         cache = TxFactsCache(maxSize=10, safeDepth=6)
+         facts = cache.getTxFactsBatch(['deep', 'shallow', 'zc'])
+         self.assertEqual(len(fakeBDM.requests), 1)
+         self.assertEqual(facts['deep'].fee, 10)
+         self.assertEqual(facts['deep'].valueIn, 310)
+         self.assertEqual(facts['deep'].outputs[1][1], 200)
+         self.assertEqual(facts['shallow'].blockTime, 1097)
+         self.assertFalse(facts['zc'].isConfirmed())
+
+         # Confirmed tx are served from the cache, unconfirmed ones aren't
+         cache.getTxFactsBatch(['deep', 'shallow', 'zc'])
+         self.assertEqual(fakeBDM.requests[-1], ['zc'])
+
+         # A shallow reorg only drops what's above the safe depth
+         fakeBDM.branchHeights.append(99)
+         cache.getTxFactsBatch(['deep', 'shallow'])
+         self.assertEqual(fakeBDM.requests[-1], ['shallow'])
+
+         # A deep one drops everything above the branch point
+         fakeBDM.branchHeights.append(40)
+         cache.getTxFacts('deep')
+         self.assertEqual(fakeBDM.requests[-1], ['deep'])
+
+         # Two reorgs between lookups:  the deeper one still counts
+         numRequests = len(fakeBDM.requests)
+         fakeBDM.branchHeights.extend([40, 99])
+         cache.getTxFacts('deep')
+         self.assertEqual(len(fakeBDM.requests), numRequests+1)
+         self.assertEqual(fakeBDM.requests[-1], ['deep'])
+      finally:
+         armoryengine.Transaction.TheBDM = realBDM
+
+   def testScrAddrIndex(self):
+      index = ScrAddrIndex()
+      scrAddrA = Hash160ToScrAddr('\xaa'*20)
+      scrAddrB = Hash160ToScrAddr('\xbb'*20)
+      index.addScrAddrList('WltA', [scrAddrA, scrAddrB])
+      index.addScrAddr('WltB', scrAddrB)
+      self.assertEqual(index.getOwners(scrAddrB), set(['WltA', 'WltB']))
+      self.assertEqual(index.getOwnerIn(scrAddrB, {'WltB': None}), 'WltB')
+      self.assertEqual(index.getOwnerIn(scrAddrB, {}), None)
+      self.assertEqual(index.getOwnerIn('\x00'*21, {'WltA': None}), None)
+
+      # Re-reading a wallet replaces what it had
+      index.addScrAddrList('WltA', [scrAddrA], replace=True)
+      self.assertEqual(index.getOwners(scrAddrB), set(['WltB']))
+      index.removeOwner('WltB')
+      self.assertEqual(index.getOwnersForList([scrAddrA, scrAddrB]), 
+                       set(['WltA']))
+      self.assertEqual(index.getAllOwners(), set(['WltA']))
+
+   def testParallelSigning(self):
+      numIn = SIG_WORKER_MIN_TASKS + 4
+      privKeys = [SecureBinaryData(chr(i+1)*32) for i in range(numIn)]
+      pubKeys = [CryptoECDSA().ComputePublicKey(k).toBinStr() for k in privKeys]
+
+      # One tx paying each key, which the USTX then spends in full
+      txin = PyTxIn()
+      txin.outpoint  = PyOutPoint().unserialize(hex_to_binary('00'*36))
+      txin.binScript = hex_to_binary('99'*4)
+      txin.intSeq    = hex_to_int('ff'*4)
+      supportTx = PyTx()
+      supportTx.version  = 1
+      supportTx.inputs   = [txin]
+      supportTx.outputs  = []
+      supportTx.lockTime = 0
+      for pub in pubKeys:
+         txout = PyTxOut()
+         txout.value = ONE_BTC
+         txout.binScript = hash160_to_p2pkhash_script(hash160(pub))
+         supportTx.outputs.append(txout)
+      rawSupportTx = supportTx.serialize()
+
+      def makeUSTX():
+         ustxiList = [UnsignedTxInput(rawSupportTx, i, None, pubKeys[i]) \
+                                                      for i in range(numIn)]
+         dtxo = DecoratedTxOut(hash160_to_p2pkhash_script(hash160(pubKeys[0])), 
+                               numIn*ONE_BTC - 10000)
+         return UnsignedTransaction().createFromUnsignedTxIO(ustxiList, [dtxo])
+
+      # Input 3 gets the wrong key, and one index is out of range
+      keyList = [(i, privKeys[i]) for i in range(numIn)]
+      keyList[3] = (3, privKeys[4])
+      keyList.insert(7, (numIn+5, privKeys[0]))
+
+      ustxSerial,ustxParallel = makeUSTX(),makeUSTX()
+      errSerial = ustxSerial.createAndInsertSignaturesForInputs(keyList, 
+                                                             numWorkers=1)
+      errParallel = ustxParallel.createAndInsertSignaturesForInputs(keyList, 
+                                                             numWorkers=4)
+      self.assertEqual([iin for iin,err in errSerial], [3, numIn+5])
+      self.assertEqual(errParallel, errSerial)
+
+      # The signatures themselves differ (random k), but each one has to
+      # sign the same message with the same key as the serial path's
+      sigHashCache = ustxSerial.getSigHashCache()
+      for iin in range(numIn):
+         ustxiS = ustxSerial.ustxInputs[iin]
+         ustxiP = ustxParallel.ustxInputs[iin]
+         if iin==3:
+            self.assertEqual(ustxiP.signatures, ustxiS.signatures)
+            continue
+         self.assertEqual(ustxiP.signatures[0][-1], ustxiS.signatures[0][-1])
+         self.assertTrue(ustxiS.verifyTxSignature(ustxSerial.pytxObj, 
+                        ustxiP.signatures[0], pubKeys[iin], sigHashCache))
+
+      # Break one signature:  both verify paths have to agree on everything
+      sig = ustxParallel.ustxInputs[5].signatures[0]
+      ustxParallel.ustxInputs[5].signatures[0] = \
+                                    sig[:10] + chr(ord(sig[10])^1) + sig[11:]
+      for ustx in (ustxSerial, ustxParallel):
+         resSerial = ustx.verifySigsEachInput(numWorkers=1)
+         self.assertEqual(ustx.verifySigsEachInput(numWorkers=4), resSerial)
+      self.assertEqual([valid for valid,err in resSerial], 
+                       [iin not in (3,5) for iin in range(numIn)])
+      self.assertEqual(resSerial[5], (False, 'Missing or invalid signature'))
+
+   def testZeroConfDispatcher(self):
+      class FakeFacts(object):
+         def __init__(self, scrAddrList):
+            self.outputs = [[scrAddr, 0] for scrAddr in scrAddrList]
+
+      class FakeTxFactsCache(object):
+         def __init__(self):
+            self.factsMap = {}
+         def getTxFactsBatch(self, txHashList):
+            return dict([(h, self.factsMap[h]) for h in txHashList \
+                                                   if h in self.factsMap])
+
+      tx1 = PyTx().unserialize(tx1raw)
+      outScrAddr = script_to_scrAddr(tx1.outputs[0].getScript())
+      prevOut = tx1.inputs[0].outpoint
+      prevScrAddr = Hash160ToScrAddr('\xbb'*20)
+
+      index = ScrAddrIndex()
+      index.addScrAddr('A', outScrAddr)
+      index.addScrAddr('B', prevScrAddr)
+      index.addScrAddr('C', Hash160ToScrAddr('\xcc'*20))
+
+      fakeCache = FakeTxFactsCache()
+      fakeCache.factsMap[prevOut.txHash] = \
+               FakeFacts([''] * prevOut.txOutIndex + [prevScrAddr])
+      realCache = armoryengine.Transaction.TheTxFactsCache
+      armoryengine.Transaction.TheTxFactsCache = fakeCache
+      try:
+         dispatcher = ZeroConfDispatcher(index)
+         affected, txOwnerList = dispatcher.dispatch([tx1raw])
+         self.assertEqual(affected, set(['A', 'B']))
+         self.assertEqual(txOwnerList, [[tx1.getHash(), set(['A', 'B'])]])
+
+         # Spending a zero-conf tx we just saw doesn't need the DB
+         tx2 = tx1.copy()
+         tx2.inputs[0].outpoint = PyOutPoint(tx1.getHash(), 0)
+         self.assertEqual(dispatcher.dispatch([tx2.serialize()])[0], 
+                          set(['A']))
+
+         # If we can't tell who owned a spent output, everyone is affected
+         fakeCache.factsMap = {}
+         dispatcher = ZeroConfDispatcher(index)
+         self.assertEqual(dispatcher.dispatch([tx1raw])[0], 
+                          set(['A', 'B', 'C']))
+      finally:
+         armoryengine.Transaction.TheTxFactsCache = realCache
+
    def testBogusBlockComponent(self):
       class TestBlockComponent(BlockComponent):
          pass
@@ -11,7 +11,8 @@ from random import shuffle
 import unittest
 
 from armoryengine.ArmoryUtils import FiniteField, FiniteFieldError, SplitSecret, \
-   hex_to_binary, RightNow, binary_to_hex, ReconstructSecret
+   hex_to_binary, RightNow, binary_to_hex, ReconstructSecret, \
+   testReconstructSecrets
 
 
 sys.argv.append('--nologging')
@@ -58,6 +59,8 @@ class SplitSecretTest(TiabTest):
       self.assertEqual(ff1.mtrxmult(TEST_2_BY_3_MTRX, TEST_2_BY_3_MTRX), TEST_MULT_VECT_RESULT3)
       self.assertEqual(ff1.mtrxadjoint(TEST_MTRX), TEST_MULT_VECT_RESULT4)
       self.assertEqual(ff1.mtrxinv(TEST_MTRX), TEST_MULT_VECT_RESULT5)
+      self.assertEqual(ff1.batchinv([TEST_A, 0, TEST_B]), \
+                       [ff1.powinv(TEST_A), 0, ff1.powinv(TEST_B)])
 
    def testSplitSecret(self):
       self.callSplitSecret('9f', 2,3)
@@ -67,10 +70,21 @@ class SplitSecretTest(TiabTest):
       self.callSplitSecret('9f', 6,7)
       self.callSplitSecret('9f'*16, 3,5, 16)
       self.callSplitSecret('9f'*16, 7,10, 16)
+      self.callSplitSecret('9f'*16, 12,15, 16)
       self.assertRaises(FiniteFieldError, SplitSecret, '9f'*16, 3, 5, 8)
       self.assertRaises(FiniteFieldError, SplitSecret, '9f', 5,4)
       self.assertRaises(FiniteFieldError, SplitSecret, '9f', 1,1)
 
+
+   def testReconstructSecrets(self):
+      secret = hex_to_binary('9f'*32)
+      fragMap = dict(enumerate(SplitSecret(secret, 5, 9)))
+      isRandom, results = testReconstructSecrets(fragMap, 5, 200)
+      self.assertFalse(isRandom)
+      self.assertEqual(len(results), 126)
+      for subset,recon in results:
+         self.assertEqual(recon, secret)
+
    
    def callSplitSecret(self, secretHex, M, N, nbytes=1):
       secret = hex_to_binary(secretHex)
@@ -4848,6 +4848,7 @@ class DlgRemoveWallet(ArmoryDialog):
                os.remove(thepath)
                os.remove(thepathBackup)
                self.main.walletMap[wltID] = newWlt
+               TheScrAddrIndex.addWallet(newWlt)
                self.main.statusBar().showMessage(\
                      'Wallet %s was replaced with a watching-only wallet.' % wltID, 10000)
             elif self.radioDelete.isChecked():